@@ -11,7 +11,7 @@ V6.7 (Compatibility Fix): 修复了因 text_factory 参数在旧版Python中不
 import sqlite3
 import os
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 import json
 import argparse
@@ -31,6 +31,17 @@ import shlex
 import logging
 import time
 import subprocess
+import itertools
+import heapq
+import tempfile
+import shutil
+import collections
+import copy
+import codecs
+import gzip
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # --- 日志记录器设置 ---
 logger = logging.getLogger('ARK-1')
@@ -50,8 +61,7 @@ def get_resource_path(relative_path):
 connected_clients = set()
 PROFILE_MGR = None
 CONFIG_MGR = None
-DB_CON, GROUP_INFO_DB_CON, PROFILE_DB_CON = None, None, None
-DB_CONNECTIONS = {}
+DB_POOL = None
 WORK_DIR = "."
 LOG_TO_CONSOLE = False # 控制WebSocket日志是否在控制台打印
 global_args = None
@@ -118,6 +128,11 @@ except ImportError:
     print("请使用 'pip install blackboxprotobuf' 命令进行安装。")
     exit(1)
 
+try:
+    import zstandard  # 可选依赖, 仅 zstd 压缩输出需要
+except ImportError:
+    zstandard = None
+
 # --- 常量定义 ---
 _DB_FILENAME = "nt_msg.decrypt.db"
 _PROFILE_DB_FILENAME = "profile_info.decrypt.db"
@@ -126,13 +141,59 @@ _OUTPUT_DIR_NAME = "output_chats"
 _CONFIG_FILENAME = "export_config.json"
 _TEMPLATE_DIR_NAME = "html_templates"
 _NON_FRIENDS_CACHE_FILENAME = "non_friends_cache.json"
+_DECODE_CACHE_FILENAME = "decoded_cache.db"
+_FILE_HASH_CACHE_FILENAME = "file_hash_cache.json"
+_MESSAGE_INDEX_FILENAME = "msg_index.db"
+_EXPORT_STATE_FILENAME = "export_state.json"
+_SEARCH_INDEX_FILENAME = "search_index.db"
 _TIMELINE_FILENAME_BASE = "chat_logs_timeline"
+_ARCHIVE_FILENAME_BASE = "chat_archive"
+_HTML_SHARD_DIR_NAME = "shards"
+_COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+_RAW_EXPORT_FORMATS = [f"{fmt}{suffix}" for fmt in ('json', 'jsonl', 'csv') for suffix in ('', '.gz', '.zst')]
 _LIB_DIR_NAME = "lib"
 
 DB_PATH, PROFILE_DB_PATH, GROUP_INFO_DB_PATH = "", "", ""
 OUTPUT_DIR, CONFIG_PATH, TEMPLATE_DIR_PATH, NON_FRIENDS_CACHE_PATH = "", "", "", ""
-
-SALVAGE_CACHE, MESSAGE_CONTENT_CACHE = {}, {}
+DECODE_CACHE_PATH = ""
+DECODE_CACHE = None
+FILE_HASH_CACHE_PATH = ""
+FILE_HASH_CACHE = None
+MESSAGE_INDEX_PATH = ""
+MESSAGE_INDEX = None
+EXPORT_STATE_PATH = ""
+EXPORT_STATE = None
+SEARCH_INDEX_PATH = ""
+SEARCH_INDEX = None
+
+_DECODE_BATCH_SIZE = 500
+_FETCH_ARRAY_SIZE = 1000
+_MERGE_FETCH_SIZE = 64
+_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+_HASH_BUFFER_SIZE = 1024 * 1024
+_COPY_BUFFER_SIZE = 1024 * 1024
+_TEXT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+_REPLY_LOOKUP_LIMIT = 8
+_ARCHIVE_INSERT_BATCH = 5000
+_SEARCH_PROGRESS_INTERVAL = 2.0
+_CHAT_STATS_CACHE_MAX = 64
+_CHAT_STATS_CACHE = collections.OrderedDict()  # {(会话类型, 会话ID, 起止时间, 消息库指纹, 解析配置指纹): 统计结果}, 按最近使用排序
+_CHAT_STATS_LOCK = threading.Lock()  # 统计在线程池中执行, 读写缓存时加锁
+_WEEKDAY_NAMES = ['周日', '周一', '周二', '周三', '周四', '周五', '周六']
+_WORD_CLOUD_TOP = 100
+_WORD_CLOUD_PATTERN = re.compile(r'[\u4e00-\u9fa5]+|[a-zA-Z0-9]+')
+_WORD_CLOUD_STOPWORDS = frozenset([
+    '的', '是', '了', '我', '你', '他', '她', '它', '我们', '你们', '他们', '她们', '它们', '这', '那', '个', '在', '有', '和', '也', '都', '不', '很', '啊', '哦', '嗯', '吗', '呢', '吧', '就', '可以', '一个', '什么', '怎么', '好', '谢谢', '哈哈', '呵呵', '啦', '呀', '嗯嗯', '哈', '行', '请', '给', '说', '看', '想', '要', '会', '能', '去', '来', '到', '从', '把', '被', '对', '与', '及', '而', '或', '但', '所以', '因为', '如果', '虽然', '然后', '不过', '但是', '因此', '而且', '还有', '就是', '不是', '没有', '不能', '不要', '不用',
+    'a', 'an', 'the', 'is', 'to', 'in', 'on', 'of', 'and', 'or', 'but', 'for', 'with', 'by', 'at', 'from', 's', 't', 'can', 'will', 'just', 'don', 'should', 'now', 'so', 'if', 'that', 'it', 'what', 'who', 'when', 'where', 'why', 'how', 'some', 'any', 'all', 'one', 'no',
+    'cdnurl', 'filekey', 'stodownload', 'url', 'http', 'https', 'com', 'cn', 'org', 'www', 'qq',
+])
+_TIME_GROUP_GAP = 15 * 60  # 相邻消息间隔超过 15 分钟即开始新的时间组
+_TIMESTAMP_CACHE_MAX_DAYS = 4096
+_FINGERPRINT_SAMPLE_PAGES = 16
+_DECODE_POOL, _DECODE_POOL_KEY = None, None  # 新的解码任务使用的进程池及其 (进程数, 资料对象) 键
+_DECODE_POOL_USERS = {}  # {进程池: 正在使用它的解码任务数}, 被替换的进程池在最后一个使用者结束后才关闭
+_DECODE_POOL_LOCK = threading.Lock()
+_WORKER_PROFILE_MGR = None
 
 # --- 数据库表与字段常量 ---
 TABLE_NAME_C2C, TABLE_NAME_GROUP = "c2c_msg_table", "group_msg_table"
@@ -161,9 +222,22 @@ class ConfigManager:
         self.default_config = {
             'show_recall': True, 'show_recall_suffix': True, 'show_poke': True,
             'show_voice_to_text': True, 'export_non_friends': True, 'export_format': 'md',
-            'html_template': 'default.html', 'show_media_info': False, 'name_style': 'default',
+            'html_template': 'default.html', 'html_shard_by': 'month', 'search_index_warmup': False,
+            'compression': 'none', 'compression_level': 6, 'compression_threads': 0, 'show_media_info': False, 'name_style': 'default',
             'name_format': '', 'add_file_header': True, 'parse_protobuf_fields': True,
-            'api_export_action': 'save'  # 'save' or 'download'
+            'api_export_action': 'save',  # 'save' or 'download'
+            'fast_pb_decoder': True,  # 使用已知结构的快速解码器, 结构不符时回退到 blackboxprotobuf
+            'decode_cache': True,  # 将消息解析结果缓存到磁盘, 重复导出时跳过 protobuf 解码
+            'decode_workers': 0,  # 并行解码的子进程数, 0 或 1 表示在主进程内解码
+            'decode_chunk_size': 2000,  # 每个子进程任务包含的消息条数
+            'hash_warmup': True,  # 启动时在后台线程预先计算数据库文件的 SHA-256
+            'cache_validation': 'fast',  # 缓存校验方式: 'fast' 快速指纹 / 'strict' 完整 SHA-256
+            'message_index': True,  # 为消息表构建 (会话, 时间) 伴随索引, 按会话查询时直接定位消息
+            'db_pool_size': 8,  # 每个数据库同时打开的只读连接数上限 (每个线程一个连接)
+            'db_pragmas': {'query_only': 1, 'cache_size': -32768, 'mmap_size': 268435456, 'temp_store': 'MEMORY'},  # 每个只读连接建立时执行的 PRAGMA
+            'timeline_engine': 'merge',  # 时间线查询方式: 'merge' 按会话多路归并 / 'union' UNION ALL 后统一排序
+            'reply_cache_max_bytes': _TEXT_CACHE_MAX_BYTES,  # 每次导出/查询中用于还原引用原文的消息文本缓存上限 (字节)
+            'reply_origin_lookup': True  # 引用原文不在本次导出范围内时, 按 (会话, 时间戳, 发送者) 查询并解码原消息
         }
         self.config = self.load_config()
 
@@ -190,6 +264,7 @@ class ConfigManager:
 
     def save_config(self, new_config=None):
         if new_config: self.config.update(new_config)
+        if PROFILE_MGR: PROFILE_MGR.clear_name_tables()
         save_path = self.config_path
         if getattr(sys, 'frozen', False):
             save_path = os.path.join(os.path.dirname(sys.executable), _CONFIG_FILENAME)
@@ -214,10 +289,12 @@ class ProfileManager:
         self.friend_groups, self.chat_groups = {}, {}
         self.qq_to_uid_map = {}
         self.uin_to_uid_map = {}
+        self.name_tables = {}
 
     def load_data(self):
         msg = f"\n正在从 '{os.path.basename(self.profile_db_path.replace('file:', '').split('?')[0])}' 加载用户信息..."
         print(msg); logger.info(msg.strip())
+        self.clear_name_tables()
         con = None
         try:
             # V6.7 FIX: Set text_factory after connection for compatibility with older Python versions.
@@ -240,11 +317,12 @@ class ProfileManager:
         
         self.discover_chat_groups_from_map()
         
-        if self.group_info_db_path and GROUP_INFO_DB_CON:
+        group_info_con = DB_POOL.get(_GROUP_INFO_DB_FILENAME) if self.group_info_db_path and DB_POOL else None
+        if group_info_con:
             msg = f"正在从 '{os.path.basename(self.group_info_db_path.replace('file:', '').split('?')[0])}' 加载群组信息..."
             print(msg); logger.info(msg)
             try:
-                self._load_group_data(GROUP_INFO_DB_CON.cursor())
+                self._load_group_data(group_info_con.cursor())
                 print("群组信息加载完毕。"); logger.info("群组信息加载完毕。")
             except sqlite3.Error as e:
                  err_msg = f"\n读取群组数据库时发生错误: {e}"
@@ -412,7 +490,7 @@ class ProfileManager:
     def load_non_friends(self, config_mgr):
         if not config_mgr.config.get('export_non_friends', True):
             self.non_friend_uids = []; return
-        msg_db_hash = _calculate_sha256(DB_PATH)
+        msg_db_hash = _db_fingerprint(DB_PATH, config_mgr.config.get('cache_validation', 'fast'))
         try:
             if os.path.exists(NON_FRIENDS_CACHE_PATH):
                 with open(NON_FRIENDS_CACHE_PATH, 'r', encoding='utf-8') as f:
@@ -481,8 +559,27 @@ class ProfileManager:
             return custom_format.format(nickname=nickname or "N/A", remark=remark or "N/A", qq=str(qq), uid=uid)
         return default_name
 
-    def get_filename(self, uid, timestamp_str, export_format='md'):
-        ext = f".{export_format}"
+    def name_table(self, style='default', custom_format=""):
+        """返回 (style, custom_format) 对应的 DisplayNameTable, 同一命名方式的导出共用一张表。"""
+        key = (style, custom_format)
+        table = self.name_tables.get(key)
+        if table is None: table = self.name_tables[key] = DisplayNameTable(self, style, custom_format)
+        return table
+
+    def clear_name_tables(self):
+        """用户资料重新加载或命名方式被修改后, 丢弃已解析的显示名称。"""
+        self.name_tables = {}
+
+    def decode_snapshot(self):
+        """返回仅包含消息解码所需数据的副本, 供解码子进程使用。群成员等大体积数据不参与消息解码, 不予复制。"""
+        snapshot = copy.copy(self)
+        snapshot.chat_groups = {uid: {k: v for k, v in g.items() if k in ('id', 'uin', 'name')} for uid, g in self.chat_groups.items()}
+        snapshot.friend_groups, snapshot.non_friend_uids = {}, []
+        snapshot.name_tables = {}
+        return snapshot
+
+    def get_filename(self, uid, timestamp_str, export_format='md', compression=None):
+        ext = _output_extension(export_format, compression)
         user = self.all_users.get(uid)
         if not user: return f"{uid}{timestamp_str}{ext}"
         qq, nickname, remark = str(user.get('qq', uid)), user.get('nickname', ''), user.get('remark', '')
@@ -492,17 +589,710 @@ class ProfileManager:
         safe_remark_part = re.sub(r'[\\/*?:"<>|]', "_", remark_part)
         return f"{qq}{is_non_friend_tag}_{safe_name_part}{safe_remark_part}{timestamp_str}{ext}"
 
+class DisplayNameTable:
+    """
+    固定命名方式下的显示名称表。写入器每条消息都要解析发送者 (时间线模式下还有接收者) 的名称,
+    每个 (UID, 群) 只经 get_display_name 解析一次, 之后只需一次字典查找。
+    """
+    def __init__(self, profile_mgr, style, custom_format):
+        self.profile_mgr, self.style, self.custom_format = profile_mgr, style, custom_format
+        self.senders, self.receivers = {}, {}
+
+    def sender(self, uid, group_uid=None):
+        key = (uid, group_uid)
+        name = self.senders.get(key)
+        if name is None:
+            name = self.senders[key] = self.profile_mgr.get_display_name(get_placeholder(uid), self.style, self.custom_format, group_uid=group_uid)
+        return name
+
+    def receiver(self, chat_type, s_uid, p_uid):
+        """时间线模式下消息的接收方: 私聊为对方 (自己发出时) 或自己, 群聊为 "群聊(群名)"。"""
+        key = (chat_type, p_uid, s_uid == p_uid)
+        name = self.receivers.get(key)
+        if name is None:
+            name = ""
+            if chat_type == 'c2c':
+                receiver_uid = self.profile_mgr.my_uid if s_uid == p_uid else p_uid
+                name = self.profile_mgr.get_display_name(get_placeholder(receiver_uid), self.style, self.custom_format)
+            elif chat_type == 'group':
+                group = self.profile_mgr.chat_groups.get(p_uid)
+                name = f"群聊({group.get('name', p_uid)})" if group else f"群聊({p_uid})"
+            self.receivers[key] = name
+        return name
+
+class DecodedMessageCache:
+    """
+    消息解析结果的磁盘缓存 (与 non_friends_cache.json 同目录的 SQLite 文件)。
+    以消息体摘要和解码相关配置的指纹为键；数据库文件发生变化时整体失效。
+    """
+    # 影响 decode_message_content 输出的配置项
+    DECODE_CONFIG_KEYS = ('show_recall', 'show_recall_suffix', 'show_poke', 'show_voice_to_text', 'show_media_info', 'fast_pb_decoder')
+    # 缓存内容的格式版本, 片段结构变化时递增, 使旧格式的条目不再命中
+    FORMAT_VERSION = 2
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.con = None
+        self.lock = threading.Lock()
+
+    def open(self, db_fingerprint):
+        self.close()
+        try:
+            con = sqlite3.connect(self.cache_path, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=OFF")
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS decoded (config_fp TEXT, digest BLOB, parts TEXT, PRIMARY KEY (config_fp, digest)) WITHOUT ROWID")
+            row = con.execute("SELECT value FROM meta WHERE key = 'db_fingerprint'").fetchone()
+            if not row or row[0] != db_fingerprint:
+                if row:
+                    msg = "消息数据库已变化，解析缓存已清空。"
+                    print(msg); logger.info(msg)
+                con.execute("DELETE FROM decoded")
+                con.execute("INSERT OR REPLACE INTO meta VALUES ('db_fingerprint', ?)", (db_fingerprint,))
+            con.commit()
+            self.con = con
+        except sqlite3.Error as e:
+            warn_msg = f"警告: 无法打开解析缓存 '{self.cache_path}'，将不使用缓存: {e}"
+            print(warn_msg); logger.warning(warn_msg)
+            self.con = None
+
+    def close(self):
+        with self.lock:
+            if self.con:
+                self.con.close()
+                self.con = None
+
+    @classmethod
+    def config_fingerprint(cls, export_config, name_style, name_format, is_timeline):
+        relevant = {key: export_config.get(key) for key in cls.DECODE_CONFIG_KEYS}
+        relevant.update({'name_style': name_style, 'name_format': name_format, 'is_timeline': bool(is_timeline), 'format': cls.FORMAT_VERSION})
+        return hashlib.sha1(json.dumps(relevant, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_many(self, config_fp, digests):
+        """批量查询, 返回 {digest: parts}。未命中的摘要不在结果中。"""
+        if not self.con or not digests: return {}
+        found = {}
+        with self.lock:
+            if not self.con: return {}
+            for i in range(0, len(digests), 500):
+                chunk = digests[i:i + 500]
+                placeholders = ', '.join('?' for _ in chunk)
+                cur = self.con.execute(f"SELECT digest, parts FROM decoded WHERE config_fp = ? AND digest IN ({placeholders})", [config_fp, *chunk])
+                for digest, parts_json in cur:
+                    found[digest] = segments_from_json(json.loads(parts_json))
+        return found
+
+    def put_many(self, config_fp, items):
+        """批量写入 [(digest, parts), ...]。"""
+        if not self.con or not items: return
+        with self.lock:
+            if not self.con: return
+            try:
+                self.con.executemany("INSERT OR REPLACE INTO decoded VALUES (?, ?, ?)",
+                                     [(config_fp, digest, json.dumps([p.to_json() for p in parts] if parts is not None else None, ensure_ascii=False)) for digest, parts in items])
+                self.con.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"写入解析缓存失败: {e}")
+
+class ReadOnlyConnectionPool:
+    """
+    只读数据库连接池。sqlite3 连接不在线程间共享：每个线程按需获得各数据库各自的只读连接，
+    同一线程内重复获取时复用该连接；每个数据库的连接总数不超过 max_size，
+    线程调用 release() 或线程结束后归还名额。
+    """
+    _PRAGMA_NAME = re.compile(r'^[A-Za-z_]+$')
+
+    def __init__(self, db_paths, pragmas=None, max_size=8, on_connect=None, timeout=60):
+        self.db_paths = dict(db_paths)  # {数据库文件名: 路径}
+        self.pragmas = dict(pragmas or {})
+        self.max_size = max(int(max_size), 1)
+        self.on_connect = on_connect  # 新连接建立后的回调 (db_name, con)
+        self.timeout = timeout
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.owners = {name: {} for name in self.db_paths}  # {数据库文件名: {线程: 连接}}
+
+    @property
+    def db_names(self): return list(self.db_paths)
+
+    def _connect(self, db_name):
+        con = sqlite3.connect(f"file:{self.db_paths[db_name]}?mode=ro", uri=True, check_same_thread=False)
+        # V6.7 FIX: Set text_factory after connection for compatibility with older Python versions.
+        con.text_factory = lambda b: b.decode('utf-8', 'ignore')
+        for name, value in self.pragmas.items():
+            if not self._PRAGMA_NAME.match(str(name)):
+                logger.warning(f"忽略无效的 PRAGMA 名称: {name}"); continue
+            try: con.execute(f"PRAGMA {name} = {value if isinstance(value, (int, float)) else repr(str(value))}")
+            except sqlite3.Error as e: logger.warning(f"PRAGMA {name} 设置失败: {e}")
+        if self.on_connect: self.on_connect(db_name, con)
+        return con
+
+    def _prune_dead_threads(self, db_name):
+        owners = self.owners[db_name]
+        for thread in [t for t in owners if not t.is_alive()]:
+            owners.pop(thread).close()
+
+    def get(self, db_name=_DB_FILENAME):
+        """返回当前线程的只读连接；数据库不存在时返回 None，连接数已满时等待其他线程归还。"""
+        conns = self.local.__dict__.setdefault('conns', {})
+        con = conns.get(db_name)
+        if con is not None: return con
+        if db_name not in self.db_paths: return None
+        thread, deadline = threading.current_thread(), time.monotonic() + self.timeout
+        with self.cond:
+            owners = self.owners[db_name]
+            while len(owners) >= self.max_size:
+                self._prune_dead_threads(db_name)
+                if len(owners) < self.max_size: break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: raise sqlite3.OperationalError(f"数据库 '{db_name}' 的连接数已达上限 {self.max_size}")
+                self.cond.wait(min(remaining, 1.0))
+            con = owners[thread] = self._connect(db_name)
+        conns[db_name] = con
+        return con
+
+    def connections(self):
+        """返回当前线程的 {数据库文件名: 连接}。"""
+        return {name: self.get(name) for name in self.db_paths}
+
+    def release(self):
+        """关闭当前线程持有的全部连接并归还名额。"""
+        conns = self.local.__dict__.pop('conns', {})
+        if not conns: return
+        thread = threading.current_thread()
+        with self.cond:
+            for db_name, con in conns.items():
+                self.owners.get(db_name, {}).pop(thread, None)
+                con.close()
+            self.cond.notify_all()
+
+    def close_all(self):
+        """
+        停用连接池: 关闭当前线程及已结束线程持有的连接。其他仍在运行的线程 (导出、检索等) 可能正在读取,
+        其连接不在此处关闭, 由这些线程结束任务时调用 release() 关闭。
+        """
+        current = threading.current_thread()
+        with self.cond:
+            for owners in self.owners.values():
+                for thread in [t for t in owners if t is current or not t.is_alive()]:
+                    owners.pop(thread).close()
+            self.cond.notify_all()
+        self.local.__dict__.pop('conns', None)
+
+class MessageIndexStore:
+    """
+    消息库的伴随索引 (与 non_friends_cache.json 同目录的 msg_index.db)。
+    消息库以只读方式打开，无法依赖或新建其中的索引；本库为 c2c/group 消息表保存 (peer, ts, rid) 索引，
+    按消息库指纹构建一次，ATTACH 到消息库连接后，按会话查询时可按时间顺序直接定位 rowid。
+    """
+    SCHEMA = "msgidx"
+    INDEXED_TABLES = {TABLE_NAME_C2C: ("c2c_idx", COL_C2C_PEER_UID), TABLE_NAME_GROUP: ("group_idx", COL_GROUP_ID_UID)}
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.available = set()
+
+    def build(self, db_path, db_fingerprint):
+        """指纹与上次构建时一致则直接复用，否则重新构建。返回索引是否可用。"""
+        con = None
+        try:
+            con = sqlite3.connect(f"file:{self.index_path}", uri=True)
+            con.execute("PRAGMA journal_mode=OFF")
+            con.execute("PRAGMA synchronous=OFF")
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            meta = dict(con.execute("SELECT key, value FROM meta").fetchall())
+            if meta.get('db_fingerprint') == db_fingerprint and 'tables' in meta:
+                self.available = set(json.loads(meta['tables']))
+                return bool(self.available)
+
+            msg = "正在为消息数据库构建伴随索引 (仅在数据库变化后执行一次)..."
+            print(msg); logger.info(msg)
+            start_time = time.perf_counter()
+            con.execute("DELETE FROM meta"); con.commit()
+            con.execute("ATTACH DATABASE ? AS src", (f"file:{db_path}?mode=ro",))
+            available = []
+            for table, (idx_table, peer_col) in self.INDEXED_TABLES.items():
+                con.execute(f"DROP TABLE IF EXISTS {idx_table}")
+                try:
+                    con.execute(f"CREATE TABLE {idx_table} (peer, ts INTEGER, rid INTEGER, PRIMARY KEY (peer, ts, rid)) WITHOUT ROWID")
+                    con.execute(f"INSERT INTO {idx_table} SELECT `{peer_col}`, `{COL_TIMESTAMP}`, rowid FROM src.{table} "
+                                f"WHERE `{peer_col}` IS NOT NULL AND `{COL_TIMESTAMP}` IS NOT NULL ORDER BY 1, 2, 3")
+                    available.append(table)
+                except sqlite3.Error as e:
+                    con.execute(f"DROP TABLE IF EXISTS {idx_table}")
+                    warn_msg = f"警告: 无法为 {table} 构建伴随索引: {e}"
+                    print(warn_msg); logger.warning(warn_msg)
+            con.commit()
+            con.execute("DETACH DATABASE src")
+            con.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [('db_fingerprint', db_fingerprint), ('tables', json.dumps(available))])
+            con.commit()
+            self.available = set(available)
+            msg = f"伴随索引构建完成，耗时 {time.perf_counter() - start_time:.1f} 秒。"
+            print(msg); logger.info(msg)
+            return bool(self.available)
+        except sqlite3.Error as e:
+            warn_msg = f"警告: 构建伴随索引失败，将直接查询消息表: {e}"
+            print(warn_msg); logger.warning(warn_msg)
+            self.available = set()
+            return False
+        finally:
+            if con: con.close()
+
+    def attach(self, con):
+        """以只读方式将索引库 ATTACH 到消息库连接 (该连接须以 uri=True 打开)。"""
+        try:
+            con.execute(f"ATTACH DATABASE ? AS {self.SCHEMA}", (f"file:{self.index_path}?mode=ro",))
+            return True
+        except sqlite3.Error as e:
+            warn_msg = f"警告: 无法挂载伴随索引: {e}"
+            print(warn_msg); logger.warning(warn_msg)
+            return False
+
+    def table_for(self, table_name):
+        """返回消息表对应的索引表全名；该表没有可用索引时返回 None。"""
+        if table_name not in self.available: return None
+        return f"{self.SCHEMA}.{self.INDEXED_TABLES[table_name][0]}"
+
+class FileHashCache:
+    """
+    按 (路径, 文件大小, 修改时间) 缓存数据库文件的 SHA-256，并持久化到 file_hash_cache.json。
+    同一会话中每个文件只计算一次哈希；文件未变化时，下次启动直接复用上次的结果。
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f).get('files', {})
+        except (json.JSONDecodeError, IOError, AttributeError) as e:
+            warn_msg = f"警告：读取文件哈希缓存失败: {e}"
+            print(warn_msg); logger.warning(warn_msg)
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            data = {'files': dict(self.entries)}
+        try:
+            with open(self.cache_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        except IOError as e:
+            logger.warning(f"无法写入文件哈希缓存: {e}")
+
+    def get(self, filepath):
+        """返回文件的 SHA-256；其他线程正在计算同一文件时等待其结果，不重复读取文件。"""
+        path = os.path.abspath(filepath)
+        while True:
+            try: st = os.stat(path)
+            except OSError: return "N/A"
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry and entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+                    return entry['sha256']
+                event = self.pending.get(path)
+                is_owner = event is None
+                if is_owner: event = self.pending[path] = threading.Event()
+            if not is_owner:
+                event.wait(); continue
+            try:
+                logger.info(f"正在计算 '{os.path.basename(path)}' 的 SHA-256...")
+                digest = _calculate_sha256(path)
+                try: unchanged = (os.stat(path).st_size, os.stat(path).st_mtime_ns) == (st.st_size, st.st_mtime_ns)
+                except OSError: unchanged = False
+                if digest != "N/A" and unchanged:
+                    with self.lock:
+                        self.entries[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': digest}
+                    self.save()
+                return digest
+            finally:
+                with self.lock: self.pending.pop(path, None)
+                event.set()
+
+    def warm_up(self, filepaths):
+        """在后台线程中预先计算哈希，首次导出时无需等待。"""
+        def worker():
+            for path in filepaths: self.get(path)
+            logger.info("数据库文件哈希预计算完成。")
+        threading.Thread(target=worker, name="hash-warmup", daemon=True).start()
+
+class MessageTextCache:
+    """
+    引用原文缓存: 以 (会话, 时间戳) 为键记录已解码消息的纯文本以及解码失败时抢救出的文本, 供之后引用该消息的回复还原原文。
+    会话为 (chat_type, peer_id) 元组; 经 SQL 查询仍找不到的原消息也记录下来, 不再重复查询。
+    每个会话导出或聊天记录查询各自创建一个实例, 用完即释放; 按估算的字节数做 LRU 淘汰, 并统计命中、未命中与淘汰次数。
+    """
+    ENTRY_OVERHEAD = 120
+    totals = collections.Counter()
+    totals_lock = threading.Lock()
+
+    def __init__(self, max_bytes=_TEXT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def put(self, kind, conversation, ts, text):
+        """kind 为 'text' (正常解码的原文)、'salvage' (解码失败时抢救出的文本) 或 'missing' (查询不到原消息)。"""
+        key = (kind, conversation, ts)
+        previous = self.entries.pop(key, None)
+        if previous: self.size -= previous[1]
+        cost = sys.getsizeof(text) + self.ENTRY_OVERHEAD
+        self.entries[key] = (text, cost)
+        self.size += cost
+        while self.size > self.max_bytes and self.entries:
+            _, (_, evicted_cost) = self.entries.popitem(last=False)
+            self.size -= evicted_cost
+            self.evictions += 1
+
+    def contains(self, kind, conversation, ts):
+        return (kind, conversation, ts) in self.entries
+
+    def lookup(self, conversation, ts):
+        """优先返回正常解码的原文, 其次是抢救出的文本; 都没有时返回 None。"""
+        for kind in ('text', 'salvage'):
+            entry = self.entries.get((kind, conversation, ts))
+            if entry and entry[0]:
+                self.entries.move_to_end((kind, conversation, ts))
+                self.hits += 1
+                return entry[0]
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries), 'bytes': self.size}
+
+    @classmethod
+    def total_stats(cls):
+        """返回本次运行以来已释放实例的累计命中、未命中、淘汰次数与命中率。"""
+        with cls.totals_lock:
+            hits, misses, evictions = cls.totals['hits'], cls.totals['misses'], cls.totals['evictions']
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None}
+
+    def close(self):
+        """释放缓存内容, 并将本实例的计数累加到 MessageTextCache.totals。"""
+        with self.totals_lock:
+            self.totals.update(hits=self.hits, misses=self.misses, evictions=self.evictions)
+        if self.hits or self.misses or self.evictions:
+            logger.debug(f"引用原文缓存: {self.stats()}")
+        self.entries.clear()
+        self.size = 0
+
+class ExportStateStore:
+    """
+    增量导出状态，持久化到 export_state.json。
+    每个 (会话, 导出格式, 输出目录, 起始时间, 解析配置) 记录一条: 输出文件的路径、大小与正文所在位置，
+    已导出的最后一条消息 (时间戳及该时间戳下的 rowid)，以及在文件末尾续写所需的写入器状态。
+    """
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            if os.path.exists(self.state_path):
+                with open(self.state_path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f).get('conversations', {})
+        except (json.JSONDecodeError, IOError, AttributeError) as e:
+            warn_msg = f"警告：读取增量导出状态失败，将完整导出: {e}"
+            print(warn_msg); logger.warning(warn_msg)
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            data = {'conversations': dict(self.entries)}
+        try:
+            with open(self.state_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        except IOError as e:
+            logger.warning(f"无法写入增量导出状态: {e}")
+
+    @staticmethod
+    def key_for(config, chat_type, peer_id, out_dir):
+        export_config = config['export_config']
+        options = [DecodedMessageCache.config_fingerprint(export_config, config['name_style'], config['name_format'], False),
+                   export_config.get('html_template'), export_config.get('add_file_header')]
+        options_fp = hashlib.sha1(json.dumps(options).encode('utf-8')).hexdigest()
+        return "|".join([chat_type, str(peer_id), config.get('export_format', 'md'), os.path.abspath(out_dir), str(config['start_ts'] or 0), options_fp])
+
+    def get(self, key):
+        """返回可续写的状态副本；没有记录，或上次的输出文件已被删除、修改时返回空字典。"""
+        with self.lock:
+            entry = copy.deepcopy(self.entries.get(key, {}))
+        layout = entry.get('layout')
+        try:
+            if layout and os.path.getsize(layout['path']) == layout['size']: return entry
+        except OSError:
+            pass
+        return {}
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+
+class SearchIndexStore:
+    """
+    聊天记录全文检索的伴随库 (与 msg_index.db 同目录的 search_index.db)。
+    经导出所用的解码流程 (含解析缓存) 得到消息文本后写入 FTS5 索引, 优先使用 trigram 分词以便按任意中文子串检索;
+    每个会话记录已索引的最后一条消息, 消息库指纹变化后只为各会话补充新消息, 解析配置变化时重建。
+    构建在后台线程中进行并报告进度, 检索时只读取已建好的部分 (WAL 模式, 读写互不阻塞)。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS conversations (chat_type TEXT, peer TEXT, last_ts INTEGER, last_rids TEXT, PRIMARY KEY (chat_type, peer));
+        CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, chat_type TEXT, peer TEXT, sender TEXT, ts INTEGER, text TEXT);
+        CREATE INDEX IF NOT EXISTS docs_conversation ON docs (chat_type, peer, ts);
+        CREATE INDEX IF NOT EXISTS docs_sender ON docs (sender, ts);
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.thread, self.stop_event = None, threading.Event()
+        self.listeners = []
+        self.status = {'state': 'idle', 'done': 0, 'total': 0, 'indexed': 0}
+
+    def _open(self, export_config):
+        """打开索引库; 解析配置与上次构建时不同则清空重建。返回 (连接, 分词方式)。"""
+        con = sqlite3.connect(self.index_path, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL"); con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(self.SCHEMA)
+        config_fp = DecodedMessageCache.config_fingerprint(export_config, 'default', '', False)
+        meta = dict(con.execute("SELECT key, value FROM meta").fetchall())
+        if meta.get('config_fp') != config_fp:
+            con.executescript("DROP TABLE IF EXISTS docs_fts; DELETE FROM docs; DELETE FROM conversations; DELETE FROM meta;")
+            con.execute("INSERT INTO meta VALUES ('config_fp', ?)", (config_fp,))
+            meta = {}
+        tokenizer = meta.get('tokenizer')
+        if tokenizer is None:
+            for tokenizer in ('trigram', 'unicode61', 'none'):
+                if tokenizer == 'none': break
+                try:
+                    con.execute(f"CREATE VIRTUAL TABLE docs_fts USING fts5(text, content='docs', content_rowid='id', tokenize='{tokenizer}')")
+                    break
+                except sqlite3.OperationalError: continue
+            con.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (tokenizer,))
+        con.commit()
+        return con, tokenizer
+
+    def _report(self, **changes):
+        with self.lock:
+            self.status.update(changes)
+            status, listeners = dict(self.status), list(self.listeners)
+        for listener in listeners:
+            try: listener(status)
+            except Exception as e: logger.debug(f"全文检索进度回调失败: {e}")
+
+    def build(self, export_config):
+        """
+        为所有会话补充新消息的索引; 消息库指纹与上次构建完成时一致则直接返回。
+        结束时 (完成、被 stop() 中止或出错) 总会报告最终状态 ready / stopped / error, 并移除全部进度监听。
+        """
+        con, final_state, error = None, 'error', None
+        try:
+            db_fingerprint = _db_fingerprint(DB_PATH, export_config.get('cache_validation', 'fast'))
+            con, tokenizer = self._open(export_config)
+            if dict(con.execute("SELECT key, value FROM meta").fetchall()).get('db_fingerprint') == db_fingerprint:
+                final_state = 'ready'; return
+
+            conversations = []
+            for chat_type, table, peer_col in (('c2c', TABLE_NAME_C2C, COL_C2C_PEER_UID), ('group', TABLE_NAME_GROUP, COL_GROUP_ID_UID)):
+                index_table = MESSAGE_INDEX.table_for(table) if MESSAGE_INDEX else None
+                query = f"SELECT DISTINCT peer FROM {index_table}" if index_table else f"SELECT DISTINCT `{peer_col}` FROM {table} WHERE `{peer_col}` IS NOT NULL"
+                conversations.extend((chat_type, peer) for (peer,) in DB_POOL.get().execute(query))
+            msg = f"正在后台为 {len(conversations)} 个会话更新全文检索索引..."
+            print(msg); logger.info(msg)
+            start_time, last_report = time.perf_counter(), 0.0
+            self._report(state='building', done=0, total=len(conversations), indexed=0)
+            decode_config = {'name_style': 'default', 'name_format': '', 'export_config': export_config, 'is_timeline': False}
+            indexed = 0
+            for done, (chat_type, peer) in enumerate(conversations, 1):
+                if self.stop_event.is_set():
+                    final_state = 'stopped'; return
+                state = con.execute("SELECT last_ts, last_rids FROM conversations WHERE chat_type = ? AND peer = ?", (chat_type, peer)).fetchone()
+                high_water = {'last_ts': state[0], 'last_rids': json.loads(state[1])} if state else {'last_ts': None, 'last_rids': []}
+                rows = _iter_new_rows(_query_conversation_rows(chat_type, peer, None, None, resume=high_water), high_water)
+                first_id = con.execute("SELECT COALESCE(MAX(id), 0) FROM docs").fetchone()[0]
+                records = _iter_decoded_records(rows, PROFILE_MGR, decode_config, is_group=chat_type == 'group')
+                while True:
+                    chunk = list(itertools.islice(records, _ARCHIVE_INSERT_BATCH))
+                    if not chunk: break
+                    batch = [(chat_type, peer, s_uid, ts, text) for ts, s_uid, _, _, parts in chunk for text in (_split_message_parts(parts)[0],) if text]
+                    con.executemany("INSERT INTO docs (chat_type, peer, sender, ts, text) VALUES (?, ?, ?, ?, ?)", batch)
+                    indexed += len(batch)
+                if tokenizer != 'none':
+                    con.execute("INSERT INTO docs_fts (rowid, text) SELECT id, text FROM docs WHERE id > ?", (first_id,))
+                con.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)", (chat_type, peer, high_water['last_ts'], json.dumps(high_water['last_rids'])))
+                con.commit()
+                if time.perf_counter() - last_report >= _SEARCH_PROGRESS_INTERVAL or done == len(conversations):
+                    last_report = time.perf_counter()
+                    self._report(done=done, indexed=indexed)
+            con.execute("INSERT OR REPLACE INTO meta VALUES ('db_fingerprint', ?)", (db_fingerprint,))
+            con.commit()
+            msg = f"全文检索索引更新完成，新增 {indexed} 条消息，耗时 {time.perf_counter() - start_time:.1f} 秒。"
+            print(msg); logger.info(msg)
+            final_state = 'ready'
+        except Exception as e:
+            error = str(e)
+            warn_msg = f"警告: 构建全文检索索引失败: {e}"
+            print(warn_msg); logger.warning(warn_msg)
+        finally:
+            if con: con.close()
+            if DB_POOL: DB_POOL.release()
+            self._report(state=final_state, error=error)
+            with self.lock: self.listeners.clear()
+
+    def start_build(self, export_config, listener=None):
+        """在后台线程中构建索引; 已在构建时不重复启动。listener(status) 接收之后的进度。返回当前状态。"""
+        with self.lock:
+            if listener: self.listeners.append(listener)
+            if self.thread is None or not self.thread.is_alive():
+                self.stop_event.clear()
+                self.thread = threading.Thread(target=self.build, args=(export_config,), name="search-index", daemon=True)
+                self.thread.start()
+            return dict(self.status)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self.listeners: self.listeners.remove(listener)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None: self.thread.join()
+
+    def search(self, query, chat_type=None, peer=None, sender=None, start_ts=None, end_ts=None, limit=50, offset=0):
+        """
+        检索已建好索引的消息, 按时间倒序返回 (总命中数, [(chat_type, peer, sender, ts, text), ...])。
+        trigram 分词下至少 3 个字符的关键词走 FTS5 索引, 更短的关键词 (或 FTS5 不可用时) 在过滤后的消息上做子串匹配。
+        """
+        if not os.path.exists(self.index_path): return 0, []
+        con = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True, timeout=30)
+        try:
+            try: tokenizer = dict(con.execute("SELECT key, value FROM meta").fetchall()).get('tokenizer', 'none')
+            except sqlite3.OperationalError: return 0, []  # 索引库刚由首次构建创建, 表结构尚未写入
+            clauses, params = [], []
+            if tokenizer != 'none' and (tokenizer != 'trigram' or len(query) >= 3):
+                source = "docs_fts JOIN docs AS d ON d.id = docs_fts.rowid"
+                clauses.append("docs_fts MATCH ?"); params.append('"' + query.replace('"', '""') + '"')
+            else:
+                source = "docs AS d"
+                clauses.append("d.text LIKE ? ESCAPE '\\'"); params.append('%' + re.sub(r'([\\%_])', r'\\\1', query) + '%')
+            for clause, value in (("d.chat_type = ?", chat_type), ("d.peer = ?", peer), ("d.sender = ?", sender), ("d.ts >= ?", start_ts), ("d.ts <= ?", end_ts)):
+                if value is not None: clauses.append(clause); params.append(value)
+            where = " AND ".join(clauses)
+            total = con.execute(f"SELECT COUNT(*) FROM {source} WHERE {where}", params).fetchone()[0]
+            hits = con.execute(f"SELECT d.chat_type, d.peer, d.sender, d.ts, d.text FROM {source} WHERE {where} ORDER BY d.ts DESC, d.id DESC LIMIT ? OFFSET ?",
+                               params + [int(limit), int(offset)]).fetchall()
+            return total, hits
+        finally:
+            con.close()
+
 # --- Utility Functions ---
+def _sqlite_fast_fingerprint(filepath, sample_pages=_FINGERPRINT_SAMPLE_PAGES):
+    """
+    由文件大小、修改时间、SQLite 文件头中的变更计数器以及均匀抽样的若干页内容计算快速指纹。
+    只读取少量页面，耗时与数据库大小基本无关。
+    """
+    try:
+        st = os.stat(filepath)
+        digest = hashlib.blake2b(f"{st.st_size}:{st.st_mtime_ns}".encode(), digest_size=16)
+        with open(filepath, "rb") as f:
+            header = f.read(100)
+            digest.update(header[24:28]) # 文件变更计数器, 每次写事务提交时递增
+            page_size = int.from_bytes(header[16:18], "big") if header.startswith(b"SQLite format 3\x00") else 4096
+            if page_size == 1: page_size = 65536
+            page_count = max(-(-st.st_size // page_size), 1)
+            for i in range(sample_pages):
+                f.seek(i * (page_count - 1) // max(sample_pages - 1, 1) * page_size)
+                digest.update(f.read(page_size))
+        return f"fast:{digest.hexdigest()}"
+    except (OSError, ValueError): return "N/A"
+
+def _db_fingerprint(filepath, mode='fast'):
+    """
+    返回用于判断缓存是否失效的数据库指纹。
+    mode 为 'fast' 时使用快速指纹；为 'strict' 时使用完整文件的 SHA-256。
+    """
+    if mode == 'strict': return _cached_sha256(filepath)
+    return _sqlite_fast_fingerprint(filepath)
+
 def _calculate_sha256(filepath):
     sha256_hash = hashlib.sha256()
+    buffer = bytearray(_HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
     try:
-        with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
+        with open(filepath, "rb", buffering=0) as f:
+            while True:
+                size = f.readinto(buffer)
+                if not size: break
+                sha256_hash.update(view[:size])
         return sha256_hash.hexdigest()
     except Exception: return "N/A"
+def _cached_sha256(filepath):
+    """优先从文件哈希缓存中读取 SHA-256。"""
+    return FILE_HASH_CACHE.get(filepath) if FILE_HASH_CACHE else _calculate_sha256(filepath)
+class TimestampFormatter:
+    """
+    按本地时区格式化消息时间戳。每个本地日期只调用一次 datetime 计算当天零点与次日零点的时间戳并缓存日期字符串,
+    当天内的 HH:MM:SS 由距零点的秒数直接算出。
+    当天长度不是 86400 秒或零点前后 UTC 偏移不同 (夏令时切换日) 时, 该日的消息仍逐条经 datetime 格式化。
+    """
+    def __init__(self, max_days=_TIMESTAMP_CACHE_MAX_DAYS):
+        self.max_days = max_days
+        self.days = {}
+        self.current = None
+        self.offset = 0
+
+    def _load_day(self, ts):
+        """返回 (零点时间戳, 次日零点时间戳, 日期字符串, 是否为普通的 86400 秒日, UTC 偏移)。"""
+        local = time.localtime(ts)
+        date_str = f"{local.tm_year:04d}-{local.tm_mon:02d}-{local.tm_mday:02d}"
+        start = int(ts) - (local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec)
+        first, last = time.localtime(start), time.localtime(start + 86399)
+        if first[:6] == local[:3] + (0, 0, 0) and last[:6] == local[:3] + (23, 59, 59) and first.tm_gmtoff == last.tm_gmtoff:
+            return start, start + 86400, date_str, True, local.tm_gmtoff
+        midnight = datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0, microsecond=0)
+        return midnight.timestamp(), (midnight + timedelta(days=1)).timestamp(), date_str, False, local.tm_gmtoff
+
+    def _day(self, ts):
+        day = self.current
+        if day and day[0] <= ts < day[1]: return day
+        key = (int(ts) + self.offset) // 86400
+        day = self.days.get(key)
+        if not (day and day[0] <= ts < day[1]):
+            day = self._load_day(ts)
+            self.offset = day[4]
+            if len(self.days) >= self.max_days: self.days.clear()
+            self.days[(int(day[0]) + day[4]) // 86400] = day
+        self.current = day
+        return day
+
+    def split(self, ts):
+        """返回 (YYYY-MM-DD, HH:MM:SS)。"""
+        day = self._day(ts)
+        if not (day[3] and day[0] <= ts < day[1]):
+            dt = datetime.fromtimestamp(ts)
+            return dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S")
+        minutes, seconds = divmod(int(ts - day[0]), 60)
+        hours, minutes = divmod(minutes, 60)
+        return day[2], f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+    def format(self, ts):
+        """返回 YYYY-MM-DD HH:MM:SS, 与 format_timestamp 的默认格式一致。"""
+        try: date_str, time_str = self.split(ts)
+        except (TypeError, ValueError): return f"时间戳({ts})"
+        return f"{date_str} {time_str}"
+
+TIMESTAMP_FORMATTER = TimestampFormatter()
+
 def get_placeholder(value, placeholder="N/A"): return value if value and str(value) != "0" else placeholder
 def format_timestamp(ts, fmt="%Y-%m-%d %H:%M:%S"):
+    if fmt == "%Y-%m-%d %H:%M:%S": return TIMESTAMP_FORMATTER.format(ts)
     try: return datetime.fromtimestamp(ts).strftime(fmt)
     except (TypeError, ValueError): return f"时间戳({ts})"
 def _sanitize_newlines(text: str): return str(text).replace("\n", "[%\\n%]")
@@ -533,7 +1323,7 @@ def _parse_flexible_timestamp(time_str, is_end_time=False):
 
 def get_db_fields():
     all_cols = set()
-    for db_con in DB_CONNECTIONS.values():
+    for db_con in DB_POOL.connections().values():
         if not db_con: continue
         try:
             cur = db_con.cursor()
@@ -575,6 +1365,151 @@ def _extract_readable_text(data: bytes) -> str or None:
         return max(fragments, key=len).strip() if fragments else None
     except Exception: return None
 
+# --- Protobuf 快速解码 ---
+# 40800 消息容器的已知结构。值为线类型 (0: varint, 2: length-delimited)，
+# 值为 dict 时表示嵌套消息并按该结构递归解析；未列出的字段按线类型原样保留。
+_PB_WIRE_VARINT, _PB_WIRE_FIXED64, _PB_WIRE_LEN, _PB_WIRE_FIXED32 = 0, 1, 2, 5
+_PB_SEGMENT_SCHEMA = {
+    int(f): _PB_WIRE_VARINT for f in (
+        PB_MSG_TYPE, PB_MSG_SUBTYPE, PB_IMG_WIDTH, PB_IMG_HEIGHT, PB_VID_DURATION, PB_VID_WIDTH, PB_VID_HEIGHT,
+        PB_CALL_TYPE, PB_IMAGE_IS_FLASH, PB_REDPACKET_TYPE, PB_VOICE_DURATION, PB_INTERACTIVE_EMOJI_ID,
+        PB_INTERACTIVE_EMOJI_ID_IN_QUOTE, PB_REPLY_ORIGIN_TS)
+}
+_PB_SEGMENT_SCHEMA.update({
+    int(f): _PB_WIRE_LEN for f in (
+        PB_EMOJI_DESC, PB_STICKER_DESC, PB_APOLLO_TEXT, PB_TEXT_CONTENT, PB_ARK_JSON, PB_RECALLER_NAME, PB_RECALLER_UID,
+        PB_RECALL_SUFFIX, PB_FILE_NAME, PB_CALL_STATUS, PB_MARKET_FACE_TEXT, PB_VOICE_TO_TEXT, PB_GIFT_TEXT,
+        PB_LOCATION_SHARE_TEXT, PB_REPLY_ORIGIN_SENDER_UID, PB_REPLY_ORIGIN_RECEIVER_UID, PB_REPLY_ORIGIN_SUMMARY_TEXT,
+        PB_GRAYTIP_INTERACTIVE_XML)
+})
+_PB_SEGMENT_SCHEMA[48403] = {int(PB_REDPACKET_TITLE): _PB_WIRE_LEN}
+_PB_SEGMENT_SCHEMA[int(PB_REPLY_ORIGIN_OBJ)] = _PB_SEGMENT_SCHEMA # 引用原消息对象与普通消息段结构相同
+_PB_MSG_SCHEMA = {int(PB_MSG_CONTAINER): _PB_SEGMENT_SCHEMA}
+_PB_FIELD_KEYS = {}
+
+class _PBLayoutError(ValueError):
+    """数据与已知的消息结构不符, 需要回退到通用解析。"""
+
+def _read_pb_varint(data, pos):
+    result, shift = 0, 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80: return result, pos
+        shift += 7
+        if shift > 63: raise _PBLayoutError("varint 过长")
+
+def _fast_decode_pb(data, schema):
+    """
+    按已知结构解析 protobuf 数据, 返回与 blackboxprotobuf 相同形状的字典:
+    字段号为字符串键, 重复字段为列表, varint 按 int64 解释, 字符串保留为 bytes。
+    与结构不符或数据损坏时抛出 _PBLayoutError。
+    """
+    result = {}
+    pos, end = 0, len(data)
+    while pos < end:
+        tag, pos = _read_pb_varint(data, pos)
+        field, wire = tag >> 3, tag & 7
+        expected = schema.get(field)
+        if wire == _PB_WIRE_VARINT:
+            if expected is not None and expected != _PB_WIRE_VARINT: raise _PBLayoutError(f"字段 {field} 类型不符")
+            value, pos = _read_pb_varint(data, pos)
+            if value > 0x7fffffffffffffff: value -= 1 << 64
+        elif wire == _PB_WIRE_LEN:
+            if expected is not None and expected != _PB_WIRE_LEN and not isinstance(expected, dict):
+                raise _PBLayoutError(f"字段 {field} 类型不符")
+            length, pos = _read_pb_varint(data, pos)
+            stop = pos + length
+            if stop > end: raise _PBLayoutError("长度越界")
+            value = data[pos:stop]
+            pos = stop
+            if isinstance(expected, dict): value = _fast_decode_pb(value, expected)
+        elif wire == _PB_WIRE_FIXED32 or wire == _PB_WIRE_FIXED64:
+            if expected is not None: raise _PBLayoutError(f"字段 {field} 类型不符")
+            stop = pos + (4 if wire == _PB_WIRE_FIXED32 else 8)
+            if stop > end: raise _PBLayoutError("长度越界")
+            value = int.from_bytes(data[pos:stop], 'little')
+            pos = stop
+        else:
+            raise _PBLayoutError(f"不支持的线类型 {wire}")
+
+        key = _PB_FIELD_KEYS.get(field)
+        if key is None: key = _PB_FIELD_KEYS.setdefault(field, str(field))
+        if key in result:
+            existing = result[key]
+            if isinstance(existing, list): existing.append(value)
+            else: result[key] = [existing, value]
+        else:
+            result[key] = value
+    return result
+
+def _decode_msg_container(content, use_fast_decoder=True):
+    """解码 40800 消息体。优先使用已知结构的快速解码器，结构未知时回退到 blackboxprotobuf。"""
+    if use_fast_decoder:
+        try:
+            decoded = _fast_decode_pb(content, _PB_MSG_SCHEMA)
+            if PB_MSG_CONTAINER in decoded: return decoded
+        except (_PBLayoutError, IndexError, TypeError):
+            pass
+    decoded, _ = blackboxprotobuf.decode_message(content)
+    return decoded
+
+class Segment:
+    """
+    消息片段基类。decode_message_content 返回片段对象列表, 写入器按类型直接取用字段,
+    不再从拼好的字符串中用正则识别引用, 文本中保留原始换行, 由各写入器按输出格式处理。
+    片段可被 pickle (解码进程池), 也可经 to_json / segments_from_json 存入解析缓存。
+    各子类以 render() 给出片段的纯文本形式。
+    """
+    __slots__ = ()
+    TAG = None
+
+    def to_json(self): return [self.TAG, *(getattr(self, name) for name in self.__slots__)]
+    def __eq__(self, other): return type(self) is type(other) and self.to_json() == other.to_json()
+    def __repr__(self): return f"{type(self).__name__}{tuple(self.to_json()[1:])!r}"
+    def __str__(self): return self.render()
+
+class TextSegment(Segment):
+    """文字消息, 以及抢救出的文本与解码失败提示。"""
+    __slots__ = ('text',)
+    TAG = 't'
+    def __init__(self, text): self.text = text
+    def render(self): return self.text
+
+class MediaSegment(Segment):
+    """图片、表情、文件、语音、卡片、撤回提示等以占位文本表示的片段, kind 为 protobuf 中的消息类型。"""
+    __slots__ = ('kind', 'text')
+    TAG = 'm'
+    def __init__(self, kind, text): self.kind, self.text = kind, text
+    def render(self): return self.text
+
+class ReplySegment(Segment):
+    """引用: 原消息的时间戳、发送者、接收者 (仅时间线模式, 否则为 None) 与原文。"""
+    __slots__ = ('ts', 'sender', 'receiver', 'origin')
+    TAG = 'r'
+    def __init__(self, ts, sender, receiver, origin): self.ts, self.sender, self.receiver, self.origin = ts, sender, receiver, origin
+
+    def quote(self):
+        """引用块中显示的内容。"""
+        target = f"{self.sender} -> {self.receiver}" if self.receiver is not None else self.sender
+        return f"{format_timestamp(self.ts)} {target}: {self.origin}"
+
+    def render(self): return f"[引用->{self.quote()}]"
+
+class GrayTipSegment(Segment):
+    """拍一拍/戳一戳等互动灰条提示。"""
+    __slots__ = ('actor', 'verb', 'target', 'suffix')
+    TAG = 'g'
+    def __init__(self, actor, verb, target, suffix): self.actor, self.verb, self.target, self.suffix = actor, verb, target, suffix
+    def render(self): return f"{self.actor} {self.verb} {self.target}{self.suffix}"
+
+_SEGMENT_TYPES = {cls.TAG: cls for cls in (TextSegment, MediaSegment, ReplySegment, GrayTipSegment)}
+
+def segments_from_json(data):
+    """由 [片段.to_json(), ...] 还原片段列表。"""
+    return [_SEGMENT_TYPES[item[0]](*item[1:]) for item in data] if data is not None else None
+
 def _parse_single_segment(segment: dict, export_config: dict) -> str:
     if not isinstance(segment, dict): return ""
     msg_type = segment.get(PB_MSG_TYPE)
@@ -625,13 +1560,13 @@ def _parse_single_segment(segment: dict, export_config: dict) -> str:
         rp_map = {2: "普通红包", 6: "口令红包", 15: "语音红包"}
         return f"[{rp_map.get(rp_type, '红包')}] {title}"
             
-    if msg_type == 11 and PB_MARKET_FACE_TEXT in segment: return _sanitize_newlines(segment[PB_MARKET_FACE_TEXT].decode("utf-8", "ignore"))
-    if msg_type == 27: return _sanitize_newlines(segment.get(PB_GIFT_TEXT, b'').decode('utf-8', 'ignore')) or "[礼物]"
-    if msg_type == 28: return f"[{_sanitize_newlines(segment.get(PB_LOCATION_SHARE_TEXT, b'').decode('utf-8', 'ignore'))}]" or "[位置共享]"
-    if PB_TEXT_CONTENT in segment: return _sanitize_newlines(segment.get(PB_TEXT_CONTENT, b"").decode("utf-8", "ignore"))
+    if msg_type == 11 and PB_MARKET_FACE_TEXT in segment: return segment[PB_MARKET_FACE_TEXT].decode("utf-8", "ignore")
+    if msg_type == 27: return segment.get(PB_GIFT_TEXT, b'').decode('utf-8', 'ignore') or "[礼物]"
+    if msg_type == 28: return f"[{segment.get(PB_LOCATION_SHARE_TEXT, b'').decode('utf-8', 'ignore')}]" or "[位置共享]"
+    if PB_TEXT_CONTENT in segment: return segment.get(PB_TEXT_CONTENT, b"").decode("utf-8", "ignore")
     return f"[{MSG_TYPE_MAP.get(msg_type, '消息')}]"
 
-def _decode_interactive_gray_tip(segment: dict, profile_mgr, name_style, name_format) -> dict or None:
+def _decode_interactive_gray_tip(segment: dict, profile_mgr, name_style, name_format) -> GrayTipSegment or None:
     try:
         xml = segment.get(PB_GRAYTIP_INTERACTIVE_XML, b"").decode("utf-8", "ignore")
         uids = re.findall(r'<qq uin="([^"]+)"', xml)
@@ -639,12 +1574,12 @@ def _decode_interactive_gray_tip(segment: dict, profile_mgr, name_style, name_fo
         if len(uids) >= 2 and len(texts) >= 1:
             actor = profile_mgr.get_display_name(uids[0], name_style, name_format)
             target = profile_mgr.get_display_name(uids[1], name_style, name_format)
-            verb = _sanitize_newlines(texts[0] or "戳了戳")
-            suffix = _sanitize_newlines(texts[1]) if len(texts) > 1 else ""
-            return {"type": "interactive_tip", "actor": actor, "target": target, "verb": verb, "suffix": suffix}
+            verb = texts[0] or "戳了戳"
+            suffix = texts[1] if len(texts) > 1 else ""
+            return GrayTipSegment(actor, verb, target, suffix)
     except Exception: return None
 
-def decode_gray_tip(segment: dict, profile_mgr, name_style, name_format, export_config) -> dict or str or None:
+def decode_gray_tip(segment: dict, profile_mgr, name_style, name_format, export_config) -> GrayTipSegment or str or None:
     interactive = _decode_interactive_gray_tip(segment, profile_mgr, name_style, name_format)
     if interactive: return interactive if export_config.get('show_poke') else None
     
@@ -656,7 +1591,7 @@ def decode_gray_tip(segment: dict, profile_mgr, name_style, name_format, export_
             display_name = (segment.get(PB_RECALLER_NAME) or b'').decode('utf-8', 'ignore') or recaller_uid
         recall_suffix = ""
         if export_config.get('show_recall_suffix'):
-            recall_suffix = _sanitize_newlines((segment.get(PB_RECALL_SUFFIX) or b'').decode('utf-8', 'ignore'))
+            recall_suffix = (segment.get(PB_RECALL_SUFFIX) or b'').decode('utf-8', 'ignore')
         return f"[{display_name} 撤回了一条消息{f' {recall_suffix}' if recall_suffix else ''}]"
     return None
 
@@ -672,16 +1607,21 @@ def decode_ark_message(segment: dict) -> str or None:
         if app == "com.tencent.music.lua" and data.get("view") == "music":
             music_data = data.get('meta', {}).get('music', {})
             return f"[分享] {get_placeholder(music_data.get('title'))} - {get_placeholder(music_data.get('desc'))}"
-        if any(k in prompt for k in ["推荐联系人", "QQ小程序", "聊天记录"]): return _sanitize_newlines(prompt)
+        if any(k in prompt for k in ["推荐联系人", "QQ小程序", "聊天记录"]): return prompt
         return None
     except Exception: return "[卡片-解析失败]"
 
-def decode_message_content(content, timestamp, profile_mgr, name_style, name_format, export_config, is_timeline=False) -> list or None:
+def decode_message_content(content, timestamp, profile_mgr, name_style, name_format, export_config, is_timeline=False, text_cache=None, conversation=None) -> list or None:
+    """
+    解析一条消息的 protobuf 内容, 返回消息片段 (Segment) 列表。
+    text_cache 为当前会话的 MessageTextCache, conversation 为消息所在的 (chat_type, peer_id):
+    回复消息先从缓存中查找原文, 未命中时按 (会话, 时间戳, 发送者) 查询原消息; 解码失败时抢救出的文本也记入缓存。
+    """
     if not content: return None
     try:
-        decoded, _ = blackboxprotobuf.decode_message(content)
+        decoded = _decode_msg_container(content, export_config.get('fast_pb_decoder', True))
         segments_data = decoded.get(PB_MSG_CONTAINER)
-        if segments_data is None: return ["[结构错误: 未找到消息容器]"]
+        if segments_data is None: return [TextSegment("[结构错误: 未找到消息容器]")]
         segments = segments_data if isinstance(segments_data, list) else [segments_data]
         parts = []
         for seg in segments:
@@ -690,18 +1630,20 @@ def decode_message_content(content, timestamp, profile_mgr, name_style, name_for
             part = None
             if msg_type not in MSG_TYPE_MAP: continue
             
-            if msg_type == 1: part = _sanitize_newlines(seg.get(PB_TEXT_CONTENT, b"").decode("utf-8", "ignore"))
+            if msg_type == 1: part = seg.get(PB_TEXT_CONTENT, b"").decode("utf-8", "ignore")
             elif msg_type == 7:
                 ts = seg.get(PB_REPLY_ORIGIN_TS)
-                origin_content = MESSAGE_CONTENT_CACHE.get(ts) or SALVAGE_CACHE.get(ts)
+                s_uid = seg.get(PB_REPLY_ORIGIN_SENDER_UID, b"").decode("utf-8")
+                origin_content = text_cache.lookup(conversation, ts) if text_cache else None
+                if not origin_content and text_cache and conversation and export_config.get('reply_origin_lookup', True):
+                    origin_content = _resolve_reply_origin(text_cache, conversation, ts, s_uid, profile_mgr, name_style, name_format, export_config, is_timeline)
                 if not origin_content:
-                    origin_content = _sanitize_newlines(seg.get(PB_REPLY_ORIGIN_SUMMARY_TEXT, b"").decode("utf-8", "ignore"))
+                    origin_content = seg.get(PB_REPLY_ORIGIN_SUMMARY_TEXT, b"").decode("utf-8", "ignore")
                     if not origin_content and seg.get(PB_REPLY_ORIGIN_OBJ):
                         origin_objs = seg.get(PB_REPLY_ORIGIN_OBJ)
                         origin_objs = origin_objs if isinstance(origin_objs, list) else [origin_objs]
                         origin_content = " ".join(filter(None, [_parse_single_segment(o, export_config) for o in origin_objs]))
-                s_uid = seg.get(PB_REPLY_ORIGIN_SENDER_UID, b"").decode("utf-8")
-                sender = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format)
+                sender, receiver = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format), None
                 if is_timeline:
                     r_uid = seg.get(PB_REPLY_ORIGIN_RECEIVER_UID, b"").decode("utf-8")
                     receiver_user = profile_mgr.all_users.get(r_uid)
@@ -710,40 +1652,41 @@ def decode_message_content(content, timestamp, profile_mgr, name_style, name_for
                     else: 
                         receiver_group = profile_mgr.chat_groups.get(r_uid)
                         receiver = receiver_group.get('name', r_uid) if receiver_group else r_uid
-                    part = f"[引用->{format_timestamp(ts)} {sender} -> {receiver}: {origin_content}]"
-                else: part = f"[引用->{format_timestamp(ts)} {sender}: {origin_content}]"
+                part = ReplySegment(ts, sender, receiver, origin_content)
             elif msg_type == 21:
                 status = seg.get(PB_CALL_STATUS, b"").decode("utf-8", "ignore")
                 call_type = "视频通话" if seg.get(PB_CALL_TYPE) == 2 else "语音通话"
                 part = f"[{call_type}] {status}"
             elif msg_type == 4:
                 text_raw = seg.get(PB_VOICE_TO_TEXT, b"").decode("utf-8", "ignore")
-                part = f"[语音] 转文字：{_sanitize_newlines(text_raw)}" if text_raw and export_config.get('show_voice_to_text') else "[语音]"
+                part = f"[语音] 转文字：{text_raw}" if text_raw and export_config.get('show_voice_to_text') else "[语音]"
             elif msg_type == 8: part = decode_gray_tip(seg, profile_mgr, name_style, name_format, export_config)
             elif msg_type == 10: part = decode_ark_message(seg)
             else: part = _parse_single_segment(seg, export_config)
-            if part: parts.append(part)
+            if not part: continue
+            if isinstance(part, str): part = TextSegment(part) if msg_type == 1 else MediaSegment(msg_type, part)
+            parts.append(part)
         return parts or None
     except Exception:
         salvaged = _extract_readable_text(content)
         if salvaged:
-            SALVAGE_CACHE[timestamp] = salvaged
-            return [_sanitize_newlines(salvaged)]
-        return [f"[解码失败-B64] {base64.b64encode(content).decode('ascii')}"]
+            if text_cache: text_cache.put('salvage', conversation, timestamp, salvaged)
+            return [TextSegment(salvaged)]
+        return [TextSegment(f"[解码失败-B64] {base64.b64encode(content).decode('ascii')}")]
 
 # --- 文件写入函数 ---
-def _generate_text_header(config: dict, rows: list, scope_info: dict) -> str:
+def _generate_text_header(config: dict, scope_info: dict, start_ts, end_ts) -> str:
     """根据导出配置和范围，动态生成用于TXT/MD的文件头字符串"""
-    if not config['export_config'].get('add_file_header', False) or not rows:
+    if not config['export_config'].get('add_file_header', False) or start_ts is None:
         return ""
         
     profile_mgr = config['profile_mgr']
     
-    msg_db_hash = _calculate_sha256(DB_PATH)
-    profile_db_hash = _calculate_sha256(PROFILE_DB_PATH)
+    msg_db_hash = _cached_sha256(DB_PATH)
+    profile_db_hash = _cached_sha256(PROFILE_DB_PATH)
     gen_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    start_time, end_time = format_timestamp(rows[0][0]), format_timestamp(rows[-1][0])
+    start_time, end_time = format_timestamp(start_ts), format_timestamp(end_ts)
     my_info = profile_mgr.all_users.get(profile_mgr.my_uid, {})
     master_name, master_qq = my_info.get('nickname', '未知'), my_info.get('qq', '未知')
     
@@ -804,9 +1747,9 @@ def _generate_text_header(config: dict, rows: list, scope_info: dict) -> str:
     )
     return header
 
-def _generate_html_header(config: dict, rows: list, scope_info: dict) -> str:
+def _generate_html_header(config: dict, scope_info: dict, start_ts, end_ts) -> str:
     """根据导出配置和范围，动态生成文件头的HTML字符串"""
-    if not config['export_config'].get('add_file_header', False) or not rows:
+    if not config['export_config'].get('add_file_header', False) or start_ts is None:
         return ""
         
     profile_mgr = config['profile_mgr']
@@ -814,11 +1757,11 @@ def _generate_html_header(config: dict, rows: list, scope_info: dict) -> str:
     def safe_escape(value):
         return html.escape(html.unescape(str(value)))
 
-    msg_db_hash = _calculate_sha256(DB_PATH)
-    profile_db_hash = _calculate_sha256(PROFILE_DB_PATH)
+    msg_db_hash = _cached_sha256(DB_PATH)
+    profile_db_hash = _cached_sha256(PROFILE_DB_PATH)
     gen_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    start_time = format_timestamp(rows[0][0])
-    end_time = format_timestamp(rows[-1][0])
+    start_time = format_timestamp(start_ts)
+    end_time = format_timestamp(end_ts)
 
     my_info = profile_mgr.all_users.get(profile_mgr.my_uid, {})
     master_name = my_info.get('nickname', '未知')
@@ -893,86 +1836,55 @@ def _generate_html_header(config: dict, rows: list, scope_info: dict) -> str:
     )
     return header_html
 
-def _write_txt(f, rows, profile_mgr, config):
-    """将聊天记录写入纯文本文件"""
+def _write_txt(f, records, profile_mgr, config):
+    """将已解析的聊天记录写入纯文本文件"""
     name_style = config.get('name_style', 'default')
     name_format = config.get('name_format', '')
+    names = profile_mgr.name_table(name_style, name_format)
     count = 0
     is_timeline = config['is_timeline']
-    is_group = config.get('is_group', False)
 
-    for row in rows:
-        ts, s_uid, p_uid, content = row[:4]
-        chat_type = row[4] if is_timeline else ('group' if is_group else 'c2c')
+    for ts, s_uid, p_uid, chat_type, parts in records:
         group_uid = p_uid if chat_type == 'group' else None
-
-        parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, config['export_config'], is_timeline)
-        if not parts: continue
-        
-        is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
-        text = " ".join(str(p) for p in parts if not isinstance(p, dict))
-        
-        if not is_reply: MESSAGE_CONTENT_CACHE[ts] = text
-        
         time = format_timestamp(ts)
         first_part = parts[0]
 
-        if isinstance(first_part, dict) and first_part.get("type") == "interactive_tip":
-            body = f"{first_part['actor']} {first_part['verb']} {first_part['target']}{first_part['suffix']}"
-            line = f"[{time}] [系统提示]: {body}\n"
+        if isinstance(first_part, GrayTipSegment):
+            line = f"[{time}] [系统提示]: {_sanitize_newlines(first_part.render())}\n"
         else:
-            sender = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format, group_uid=group_uid)
+            text = _sanitize_newlines(" ".join(p.render() for p in parts if not isinstance(p, GrayTipSegment)))
+            sender = names.sender(s_uid, group_uid)
             if sender == "N/A": sender = "[系统提示]"
             
             if is_timeline:
-                receiver_name = ""
-                if chat_type == 'c2c':
-                    receiver_uid = profile_mgr.my_uid if s_uid == p_uid else p_uid
-                    receiver_name = profile_mgr.get_display_name(get_placeholder(receiver_uid), name_style, name_format)
-                elif chat_type == 'group':
-                    group = profile_mgr.chat_groups.get(p_uid)
-                    receiver_name = f"群聊({group.get('name', p_uid)})" if group else f"群聊({p_uid})"
-                line = f"[{time}] {sender} -> {receiver_name}: {text}\n"
+                line = f"[{time}] {sender} -> {names.receiver(chat_type, s_uid, p_uid)}: {text}\n"
             else:
                 line = f"[{time}] {sender}: {text}\n"
         f.write(line)
         count += 1
     return count
 
-def _write_md(f, rows, profile_mgr, config):
-    """将聊天记录写入Markdown文件"""
+def _write_md(f, records, profile_mgr, config, state=None):
+    """将已解析的聊天记录写入Markdown文件。state 为增量续写时上次结束的写入器状态, 写完后更新为本次结束时的状态。"""
     name_style = config.get('name_style', 'default')
     name_format = config.get('name_format', '')
+    names = profile_mgr.name_table(name_style, name_format)
+    state = {} if state is None else state
     count = 0
-    last_date = None
-    last_sender_key = None
-    last_element_was_quote = False
+    last_date = state.get('last_date')
+    last_sender_key = state.get('last_sender_key')
+    last_element_was_quote = state.get('last_element_was_quote', False)
     is_timeline = config['is_timeline']
-    is_group = config.get('is_group', False)
 
-    for row in rows:
-        ts, s_uid, p_uid, content = row[:4]
-        chat_type = row[4] if is_timeline else ('group' if is_group else 'c2c')
+    for ts, s_uid, p_uid, chat_type, parts in records:
         group_uid = p_uid if chat_type == 'group' else None
-        
-        parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, config['export_config'], is_timeline)
-        if not parts: continue
-        
-        dt_object = datetime.fromtimestamp(ts)
-        current_date, current_time = dt_object.strftime("%Y-%m-%d"), dt_object.strftime("%H:%M:%S")
+        current_date, current_time = TIMESTAMP_FORMATTER.split(ts)
 
-        sender_display = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format, group_uid=group_uid)
+        sender_display = names.sender(s_uid, group_uid)
         if sender_display == "N/A":
             sender_key = "[系统提示]"
         elif is_timeline:
-            receiver_name = ""
-            if chat_type == 'c2c':
-                receiver_uid = profile_mgr.my_uid if s_uid == p_uid else p_uid
-                receiver_name = profile_mgr.get_display_name(get_placeholder(receiver_uid), name_style, name_format)
-            elif chat_type == 'group':
-                group = profile_mgr.chat_groups.get(p_uid)
-                receiver_name = f"群聊({group.get('name', p_uid)})" if group else f"群聊({p_uid})"
-            sender_key = f"{sender_display} -> {receiver_name}"
+            sender_key = f"{sender_display} -> {names.receiver(chat_type, s_uid, p_uid)}"
         else:
             sender_key = sender_display
 
@@ -986,21 +1898,8 @@ def _write_md(f, rows, profile_mgr, config):
             f.write(f"### {sender_key}\n")
             last_sender_key, last_element_was_quote = sender_key, False
 
-        main_text_parts, quote_content = [], ""
-        is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
-        
-        if not is_reply and isinstance(parts[0], dict) and parts[0].get("type") == "interactive_tip":
-            tip = parts[0]
-            main_text_parts.append(f"{tip['actor']} {tip['verb']} {tip['target']}{tip['suffix']}")
-        else:
-            for p in parts:
-                p_str = str(p)
-                match = re.search(r'\[引用->(.*)\]', p_str)
-                if match: quote_content = match.group(1)
-                else: main_text_parts.append(p_str)
-        
-        main_text = " ".join(main_text_parts)
-        if not is_reply: MESSAGE_CONTENT_CACHE[ts] = main_text
+        main_text, quote_content = _split_message_parts(parts)
+        main_text, quote_content = _sanitize_newlines(main_text), _sanitize_newlines(quote_content)
         if sender_key == "[系统提示]" and main_text.startswith('[') and main_text.endswith(']'): main_text = main_text[1:-1]
 
         f.write(f"* {current_time} {main_text}\n")
@@ -1011,135 +1910,550 @@ def _write_md(f, rows, profile_mgr, config):
             last_element_was_quote = False
         
         count += 1
+    state.update(last_date=last_date, last_sender_key=last_sender_key, last_element_was_quote=last_element_was_quote)
     return count
 
-def _write_html(f, rows, profile_mgr, config, scope_info):
-    """将聊天记录写入HTML文件"""
+class HtmlTemplate:
+    """
+    预先解析的HTML模板: 在 {{file_header}} 与 {{chat_content}} 处切分为静态片段与占位符,
+    写入时按顺序输出静态片段、文件头和聊天内容, 不再对整篇文档做字符串替换。
+    """
+    _SLOT_PATTERN = re.compile(r'\{\{(file_header|chat_content)\}\}')
+
+    def __init__(self, source):
+        tokens = self._SLOT_PATTERN.split(source)
+        self.pieces = [(i % 2 == 1, token) for i, token in enumerate(tokens) if token]  # [(是否为占位符, 静态文本或占位符名)]
+        self.content_slots = tokens[1::2].count('chat_content')
+
+    def _render(self, pieces, header_html):
+        return ''.join(header_html if is_slot else text for is_slot, text in pieces if not (is_slot and text == 'chat_content'))
+
+    def split(self, header_html):
+        """返回第一个 {{chat_content}} 之前与之后的文本 (仅在 content_slots == 1 时用于增量续写)。"""
+        slots = [i for i, (is_slot, text) in enumerate(self.pieces) if is_slot and text == 'chat_content']
+        cut = slots[0] if slots else len(self.pieces)
+        return self._render(self.pieces[:cut], header_html), self._render(self.pieces[cut + 1:], header_html)
+
+    def write(self, f, header_html, content_file):
+        """将文件头与已写入临时文件的聊天内容填入模板, 聊天内容按块复制, 不整体读入内存。"""
+        for is_slot, text in self.pieces:
+            if not is_slot: f.write(text)
+            elif text == 'file_header': f.write(header_html)
+            else:
+                content_file.seek(0)
+                shutil.copyfileobj(content_file, f, _COPY_BUFFER_SIZE)
+
+_HTML_TEMPLATE_CACHE = {}  # {模板路径: ((修改时间, 大小), HtmlTemplate)}
+
+# 分片HTML外壳页中的加载脚本: 展开某天时才以 <script> 方式载入所在分片 (本地打开时 fetch 受同源限制)
+_HTML_SHARD_LOADER = """<script>
+(function () {
+    var loaded = {}, pending = {};
+    function fill(details) {
+        var days = loaded[details.dataset.shardKey], body = details.querySelector('.chat-day-content');
+        if (!days || !details.open || body.dataset.loaded) return;
+        body.innerHTML = days[details.dataset.date] || '';
+        body.dataset.loaded = '1';
+    }
+    window.arkShardLoaded = function (key, days) {
+        loaded[key] = days;
+        document.querySelectorAll('details.date-block[data-shard-key="' + key + '"]').forEach(fill);
+    };
+    document.addEventListener('toggle', function (event) {
+        var details = event.target;
+        if (!details.open || !details.dataset || !details.dataset.shard) return;
+        var key = details.dataset.shardKey;
+        if (loaded[key]) return fill(details);
+        if (pending[key]) return;
+        pending[key] = true;
+        var script = document.createElement('script');
+        script.src = details.dataset.shard;
+        document.body.appendChild(script);
+    }, true);
+    function openFromHash() {
+        var target = document.getElementById(decodeURIComponent(location.hash.slice(1)));
+        if (target && target.tagName === 'DETAILS') { target.open = true; target.scrollIntoView(); }
+    }
+    window.addEventListener('hashchange', openFromHash);
+    document.addEventListener('DOMContentLoaded', openFromHash);
+})();
+</script>"""
+
+def _load_html_template(config):
+    """
+    返回 (HtmlTemplate, 错误页面)；读取失败时模板为 None。
+    解析结果按模板路径缓存, 模板文件的修改时间或大小变化后重新读取。
+    """
     template_filename = config['export_config'].get('html_template', 'default.html')
     template_path = os.path.join(TEMPLATE_DIR_PATH, template_filename)
-
     try:
+        stat = os.stat(template_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = _HTML_TEMPLATE_CACHE.get(template_path)
+        if cached and cached[0] == signature: return cached[1], None
         with open(template_path, 'r', encoding='utf-8') as tpl_f:
-            template_str = tpl_f.read()
+            template = HtmlTemplate(tpl_f.read())
+        _HTML_TEMPLATE_CACHE[template_path] = (signature, template)
+        return template, None
     except FileNotFoundError:
-        f.write(f"<h1>错误</h1><p>HTML模板文件 '{template_filename}' 未在 '{TEMPLATE_DIR_PATH}' 文件夹中找到。</p>")
-        return 0
+        return None, f"<h1>错误</h1><p>HTML模板文件 '{template_filename}' 未在 '{TEMPLATE_DIR_PATH}' 文件夹中找到。</p>"
     except Exception as e:
-        f.write(f"<h1>错误</h1><p>读取HTML模板文件时出错: {e}</p>")
-        return 0
+        return None, f"<h1>错误</h1><p>读取HTML模板文件时出错: {e}</p>"
 
+def _write_html(f, records, profile_mgr, config, state=None):
+    """
+    将已解析的聊天记录写入HTML片段 (即模板中的 {{chat_content}} 部分)。
+    state 为增量续写时上次结束的写入器状态, 写完后更新为本次结束时的状态,
+    其中 open_end 为收尾标签之前的位置, 续写时从该处接着写入。
+    """
     name_style, name_format = config.get('name_style', 'default'), config.get('name_format', '')
+    names = profile_mgr.name_table(name_style, name_format)
     def safe_escape(value): return html.escape(html.unescape(str(value)))
     
-    header_html = _generate_html_header(config, rows, scope_info)
-    content_html_parts, last_date, last_sender_key = [], None, None
+    state = {} if state is None else state
+    count, last_date, last_sender_key = 0, state.get('last_date'), state.get('last_sender_key')
     is_timeline = config['is_timeline']
-    is_group = config.get('is_group', False)
+
+    def emit(fragment):
+        if count or last_date: f.write('\n')
+        f.write(fragment)
 
     def close_open_tags():
-        if last_sender_key: content_html_parts.append('</div></div>') 
-        if last_date: content_html_parts.append('</div></details>')
+        if last_sender_key: emit('</div></div>')
+        if last_date: emit('</div></details>')
 
-    for row in rows:
-        ts, s_uid, p_uid, content = row[:4]
-        chat_type = row[4] if is_timeline else ('group' if is_group else 'c2c')
+    for ts, s_uid, p_uid, chat_type, parts in records:
         group_uid = p_uid if chat_type == 'group' else None
-        parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, config['export_config'], is_timeline)
-        if not parts: continue
-        
-        dt_object = datetime.fromtimestamp(ts)
-        current_date, current_time = dt_object.strftime("%Y-%m-%d"), dt_object.strftime("%H:%M:%S")
+        current_date, current_time = TIMESTAMP_FORMATTER.split(ts)
 
-        sender_display = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format, group_uid=group_uid)
+        sender_display = names.sender(s_uid, group_uid)
         if sender_display == "N/A":
             sender_key = "[系统提示]"
         elif is_timeline:
-            receiver_name = ""
-            if chat_type == 'c2c':
-                receiver_uid = profile_mgr.my_uid if s_uid == p_uid else p_uid
-                receiver_name = profile_mgr.get_display_name(get_placeholder(receiver_uid), name_style, name_format)
-            elif chat_type == 'group':
-                group = profile_mgr.chat_groups.get(p_uid)
-                receiver_name = f"群聊({group.get('name', p_uid)})" if group else f"群聊({p_uid})"
-            sender_key = f"{sender_display} -> {receiver_name}"
+            sender_key = f"{sender_display} -> {names.receiver(chat_type, s_uid, p_uid)}"
         else:
             sender_key = sender_display
 
         if current_date != last_date:
             close_open_tags()
-            content_html_parts.append(f'<details class="date-block" open><summary>{current_date}</summary><div class="chat-day-content">')
+            emit(f'<details class="date-block" open><summary>{current_date}</summary><div class="chat-day-content">')
             last_date, last_sender_key = current_date, None
         
         if sender_key != last_sender_key:
-            if last_sender_key: content_html_parts.append('</div></div>')
+            if last_sender_key: emit('</div></div>')
             speaker_class = "is-self" if s_uid == profile_mgr.my_uid else "is-other"
             if sender_key == "[系统提示]":
-                content_html_parts.append('<div class="system-message-container"><div class="message-block">')
+                emit('<div class="system-message-container"><div class="message-block">')
             else:
-                content_html_parts.append(f'<div class="sender-message-group {speaker_class}">')
-                content_html_parts.append(f'<div class="sender">{safe_escape(sender_key)}</div>')
-                content_html_parts.append('<div class="message-block">')
+                emit(f'<div class="sender-message-group {speaker_class}">')
+                emit(f'<div class="sender">{safe_escape(sender_key)}</div>')
+                emit('<div class="message-block">')
             last_sender_key = sender_key
 
-        main_text_parts, quote_content = [], ""
-        is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
-
-        if not is_reply and isinstance(parts[0], dict) and parts[0].get("type") == "interactive_tip":
-            tip = parts[0]
-            main_text_parts.append(f"{safe_escape(tip['actor'])} {safe_escape(tip['verb'])} {safe_escape(tip['target'])}{safe_escape(tip['suffix'])}")
-        else:
-            for p in parts:
-                p_str = str(p)
-                match = re.search(r'\[引用->(.*)\]', p_str)
-                if match: quote_content = match.group(1)
-                else: main_text_parts.append(p_str)
-        
-        main_text = " ".join(main_text_parts)
-        if not is_reply: MESSAGE_CONTENT_CACHE[ts] = main_text
-        escaped_main_text = safe_escape(main_text).replace('[%\\n%]', '<br>')
+        main_text, quote_content = _split_message_parts(parts)
+        escaped_main_text = safe_escape(main_text).replace('\n', '<br>')
         
         if sender_key == "[系统提示]":
              if escaped_main_text.startswith('[') and escaped_main_text.endswith(']'): escaped_main_text = escaped_main_text[1:-1]
-             content_html_parts.append(f'<div class="sys-message">{escaped_main_text}</div>')
+             emit(f'<div class="sys-message">{escaped_main_text}</div>')
         else:
-            content_html_parts.append(f'<div class="message-item"><span class="timestamp">{current_time}</span><span class="message-content">{escaped_main_text}</span></div>')
+            emit(f'<div class="message-item"><span class="timestamp">{current_time}</span><span class="message-content">{escaped_main_text}</span></div>')
 
         if quote_content:
-            escaped_quote = safe_escape(quote_content).replace('[%\\n%]', '<br>')
-            content_html_parts.append(f'<div class="reply-container"><blockquote>{escaped_quote}</blockquote></div>')
+            escaped_quote = safe_escape(quote_content).replace('\n', '<br>')
+            emit(f'<div class="reply-container"><blockquote>{escaped_quote}</blockquote></div>')
+        count += 1
 
+    state.update(last_date=last_date, last_sender_key=last_sender_key, open_end=f.tell())
     close_open_tags()
-    final_html = template_str.replace('{{file_header}}', header_html).replace('{{chat_content}}', '\n'.join(content_html_parts))
-    f.write(final_html)
-    return len(rows)
+    return count
 
-def process_and_write(output_path, rows, profile_mgr, config, scope_info):
-    """处理并写入文件，返回 (写入的条目数, 文件路径)"""
-    export_format = config.get('export_format', 'md')
-    is_timeline = config.get('is_timeline', False)
-    is_group = scope_info.get('type') == 'group'
+def _render_html_day(records, profile_mgr, config):
+    """渲染同一天的消息, 返回 (该日 chat-day-content 内部的HTML, 消息数)。"""
+    buf = io.StringIO()
+    count = _write_html(buf, records, profile_mgr, config)
+    day_html = buf.getvalue()
+    opening = '<div class="chat-day-content">'
+    start, end = day_html.index(opening) + len(opening), day_html.rindex('</div></details>')
+    return day_html[start:end].strip('\n'), count
 
-    valid_rows = [row for row in rows if decode_message_content(row[3], row[0], profile_mgr, config['name_style'], config['name_format'], config['export_config'], is_timeline)]
-    if not valid_rows:
-        return 0, None
+def _write_html_shards(shard_dir, records, profile_mgr, config):
+    """
+    分片HTML: 按月 (html_shard_by 为 'day' 时按天) 将各日的消息写入 JSONP 分片文件 shard_dir/<键>.js,
+    每次只在内存中保留一天的内容。返回 (消息数, 日期索引 [(日期, 分片键, 消息数)])。
+    """
+    by_day = config['export_config'].get('html_shard_by', 'month') == 'day'
+    total, index, shard_file, shard_key = 0, [], None, None
+    try:
+        for date, day_records in itertools.groupby(records, key=lambda record: TIMESTAMP_FORMATTER.split(record[0])[0]):
+            content, count = _render_html_day(day_records, profile_mgr, config)
+            if not count: continue
+            key = date if by_day else date[:7]
+            if key != shard_key:
+                if shard_file: shard_file.write('\n});\n'); shard_file.close()
+                os.makedirs(shard_dir, exist_ok=True)
+                shard_file = open(os.path.join(shard_dir, f"{key}.js"), "w", encoding="utf-8", newline='')
+                shard_file.write(f"arkShardLoaded({json.dumps(key)}, {{")
+                shard_key, separator = key, ''
+            content_json = json.dumps(content, ensure_ascii=False).replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+            shard_file.write(f"{separator}\n{json.dumps(date)}: {content_json}")
+            separator = ','
+            index.append((date, key, count))
+            total += count
+    finally:
+        if shard_file:
+            shard_file.write('\n});\n')
+            shard_file.close()
+    return total, index
+
+def _write_html_shard_index(f, index, shard_dir_name):
+    """写入分片HTML外壳页的聊天内容部分: 按月的日期导航、折叠的各日占位块与加载脚本。"""
+    months = {}
+    for date, _, count in index:
+        first_date, month_count = months.get(date[:7], (date, 0))
+        months[date[:7]] = (first_date, month_count + count)
+    links = ' '.join(f'<a href="#d-{first_date}">{month} ({count})</a>' for month, (first_date, count) in months.items())
+    f.write(f'<nav class="shard-index" style="margin-bottom: 1em; line-height: 2;">{links}</nav>\n')
+    for date, key, count in index:
+        f.write(f'<details class="date-block" id="d-{date}" data-date="{date}" data-count="{count}" data-shard-key="{key}" '
+                f'data-shard="{shard_dir_name}/{key}.js"><summary>{date}</summary><div class="chat-day-content"></div></details>\n')
+    f.write(_HTML_SHARD_LOADER)
+
+def _split_message_parts(parts):
+    """将消息片段拆为 (正文, 引用内容)，供 Markdown/HTML 写入器分别排版；以互动提示开头的消息只取该提示。"""
+    if isinstance(parts[0], GrayTipSegment): return parts[0].render(), ""
+    main_text_parts, quote_content = [], ""
+    for p in parts:
+        if isinstance(p, ReplySegment): quote_content = p.quote()
+        else: main_text_parts.append(p.render())
+    return " ".join(main_text_parts), quote_content
+
+def _message_plain_text(parts):
+    """返回消息作为引用原文时显示的纯文本；引用消息本身返回 None。"""
+    first_part = parts[0]
+    if isinstance(first_part, ReplySegment): return None
+    if isinstance(first_part, GrayTipSegment): return first_part.render()
+    return " ".join(p.render() for p in parts if not isinstance(p, GrayTipSegment))
+
+def _message_display_text(parts):
+    """返回消息在聊天记录视图与 API 中显示的纯文本；引用消息包含引用部分。"""
+    if isinstance(parts[0], ReplySegment): return " ".join(p.render() for p in parts if not isinstance(p, GrayTipSegment))
+    return _message_plain_text(parts)
+
+def _remember_message_text(text_cache, conversation, ts, parts):
+    """记录非引用消息的纯文本，供之后引用该消息的回复还原原文。"""
+    text = _message_plain_text(parts)
+    if text is not None: text_cache.put('text', conversation, ts, text)
+
+def _resolve_reply_origin(text_cache, conversation, ts, sender_uid, profile_mgr, name_style, name_format, export_config, is_timeline):
+    """
+    引用原文不在缓存中时 (原消息在导出范围之外或尚未导出), 经由伴随索引按 (会话, 时间戳) 查询原消息,
+    优先取发送者一致的一条解码为纯文本 (与缓存一样, 找不到发送者一致的消息时退回同一时间戳的其他消息)。结果记入 text_cache, 查询不到的情况也会记录, 每条原消息只查询、解码一次。
+    """
+    if ts is None or DB_POOL is None or text_cache.contains('missing', conversation, ts): return None
+    chat_type, peer_id = conversation
+    query, params = _conversation_query(chat_type, peer_id, [COL_SENDER_UID, COL_MSG_CONTENT], [('=', ts)], limit=_REPLY_LOOKUP_LIMIT)
+    try:
+        rows = DB_POOL.get().execute(query, params).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"查询引用原消息失败: {e}")
+        rows = []
+    rows.sort(key=lambda row: row[0] != sender_uid)
+    for _, content in rows:
+        parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, export_config, is_timeline)
+        text = _message_plain_text(parts) if parts else None
+        if text:
+            text_cache.put('text', conversation, ts, text)
+            return text
+    text_cache.put('missing', conversation, ts, '')
+    return None
+
+def _has_reply_part(parts):
+    return any(isinstance(p, ReplySegment) for p in parts)
+
+def _init_decode_worker(profile_snapshot):
+    """解码子进程初始化: 保存主进程传入的用户资料快照。"""
+    global _WORKER_PROFILE_MGR
+    _WORKER_PROFILE_MGR = profile_snapshot
 
+def _decode_chunk_in_worker(items, name_style, name_format, export_config, is_timeline):
+    """解码子进程入口: 按顺序解码 (content, ts) 列表并返回对应的解析结果。引用消息由主进程重新解码, 这里不需要引用原文缓存。"""
+    return [decode_message_content(content, ts, _WORKER_PROFILE_MGR, name_style, name_format, export_config, is_timeline)
+            for content, ts in items]
+
+def _acquire_decode_pool(workers, profile_mgr):
+    """
+    取得可复用的解码进程池并登记一个使用者, 用完须调用 _release_decode_pool()。
+    进程数或用户资料对象变化时新建进程池, 保证子进程使用的资料快照与主进程一致;
+    被替换的旧进程池不会打断仍在使用它的解码任务, 由最后一个使用者释放时关闭。
+    """
+    global _DECODE_POOL, _DECODE_POOL_KEY
+    key, retired = (workers, id(profile_mgr)), None
+    with _DECODE_POOL_LOCK:
+        if _DECODE_POOL is None or _DECODE_POOL_KEY != key:
+            retired = _retire_decode_pool_locked()
+            try:
+                _DECODE_POOL = ProcessPoolExecutor(max_workers=workers, initializer=_init_decode_worker, initargs=(profile_mgr.decode_snapshot(),))
+                _DECODE_POOL_KEY = key
+                msg = f"已启动 {workers} 个解码子进程。"
+                print(msg); logger.info(msg)
+            except (OSError, ValueError, NotImplementedError) as e:
+                warn_msg = f"警告: 无法启动解码子进程, 将在主进程内解码: {e}"
+                print(warn_msg); logger.warning(warn_msg)
+        pool = _DECODE_POOL
+        if pool is not None: _DECODE_POOL_USERS[pool] = _DECODE_POOL_USERS.get(pool, 0) + 1
+    if retired: retired.shutdown(wait=True)
+    return pool
+
+def _release_decode_pool(pool):
+    """注销一个使用者; 已被替换的进程池在没有使用者后关闭。"""
+    with _DECODE_POOL_LOCK:
+        _DECODE_POOL_USERS[pool] -= 1
+        if _DECODE_POOL_USERS[pool] > 0: return
+        del _DECODE_POOL_USERS[pool]
+        if pool is _DECODE_POOL: return
+    pool.shutdown(wait=True)
+
+def _retire_decode_pool_locked():
+    """(持有 _DECODE_POOL_LOCK 时调用) 撤下当前进程池; 没有使用者时返回它由调用方在锁外关闭, 否则留给最后一个使用者关闭。"""
+    global _DECODE_POOL, _DECODE_POOL_KEY
+    pool = _DECODE_POOL
+    _DECODE_POOL, _DECODE_POOL_KEY = None, None
+    return pool if pool is not None and pool not in _DECODE_POOL_USERS else None
+
+def shutdown_decode_pool():
+    """撤下当前解码进程池。正在使用它的解码任务不受影响, 进程池在它们结束后关闭。"""
+    with _DECODE_POOL_LOCK:
+        pool = _retire_decode_pool_locked()
+    if pool: pool.shutdown(wait=True)
+
+def _iter_decoded_records(rows, profile_mgr, config, is_group=False):
+    """
+    逐行解码消息，产出 (ts, s_uid, p_uid, chat_type, parts) 形式的解析记录。
+    每条消息只解码一次；解析为空的消息直接跳过。
+    启用解析缓存时按批次查询磁盘缓存，命中的消息不再解析 protobuf。
+    引用消息的原文依赖上下文，不写入缓存。
+    配置 decode_workers > 1 时，未命中缓存的消息按批次交给解码进程池并行解码，
+    结果按原始顺序取回；引用消息依赖主进程中已解码的上文，仍在主进程内按顺序重新解码。
+    引用原文缓存 (MessageTextCache) 随本次调用创建，解码结束后释放。
+    """
+    name_style, name_format = config['name_style'], config['name_format']
+    export_config, is_timeline = config['export_config'], config.get('is_timeline', False)
+    default_chat_type = 'group' if is_group else 'c2c'
+    cache = DECODE_CACHE if export_config.get('decode_cache', True) and DECODE_CACHE and DECODE_CACHE.con else None
+    config_fp = DecodedMessageCache.config_fingerprint(export_config, name_style, name_format, is_timeline) if cache else None
+    workers = config['decode_workers'] if config.get('decode_workers') is not None else export_config.get('decode_workers', 0)
+    chunk_size = config['decode_chunk_size'] if config.get('decode_chunk_size') is not None else export_config.get('decode_chunk_size', 2000)
+    text_cache = MessageTextCache(export_config.get('reply_cache_max_bytes', _TEXT_CACHE_MAX_BYTES))
+    pool = _acquire_decode_pool(workers, profile_mgr) if workers > 1 else None
+    batch_size = max(chunk_size, 1) if pool else _DECODE_BATCH_SIZE
+    max_pending = workers * 2 if pool else 0
+
+    def submit(batch):
+        digests = [hashlib.blake2b(row[3], digest_size=16).digest() if cache and isinstance(row[3], bytes) else None for row in batch]
+        cached = cache.get_many(config_fp, list({d for d in digests if d})) if cache else {}
+        future = None
+        if pool:
+            items = [(row[3], row[0]) for row, digest in zip(batch, digests) if digest not in cached]
+            if items: future = pool.submit(_decode_chunk_in_worker, items, name_style, name_format, export_config, is_timeline)
+        return batch, digests, cached, future
+
+    def collect(batch, digests, cached, future):
+        decoded = iter(future.result()) if future else None
+        new_entries = {}
+        for row, digest in zip(batch, digests):
+            ts, s_uid, p_uid, content = row[:4]
+            chat_type = row[4] if is_timeline else default_chat_type
+            if digest in cached:
+                parts = cached[digest]
+            else:
+                parts = next(decoded) if decoded else None
+                if decoded is None or (parts and _has_reply_part(parts)):
+                    parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, export_config, is_timeline, text_cache, (chat_type, p_uid))
+                if digest and not (parts and _has_reply_part(parts)):
+                    new_entries[digest] = parts
+            if not parts: continue
+            _remember_message_text(text_cache, (chat_type, p_uid), ts, parts)
+            yield ts, s_uid, p_uid, chat_type, parts
+        if new_entries: cache.put_many(config_fp, list(new_entries.items()))
+
+    rows, pending = iter(rows), collections.deque()
+    try:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if batch: pending.append(submit(batch))
+            if pending and (not batch or len(pending) > max_pending):
+                yield from collect(*pending.popleft())
+            elif not batch: return
+    finally:
+        for *_, future in pending:
+            if future: future.cancel()
+        if pool: _release_decode_pool(pool)
+        text_cache.close()
+
+def _iter_cursor_rows(cur, arraysize=_FETCH_ARRAY_SIZE):
+    """按 arraysize 分批从游标取行，避免 fetchall() 将整个会话一次性读入内存。"""
+    cur.arraysize = arraysize
+    while True:
+        rows = cur.fetchmany()
+        if not rows: return
+        yield from rows
+
+def _peek_rows(rows):
+    """取出首行以判断结果是否为空，返回 (首行, 仍包含首行的行迭代器)；无数据时首行为 None。"""
+    rows = iter(rows)
+    first = next(rows, None)
+    return first, (itertools.chain((first,), rows) if first is not None else rows)
+
+def _iter_new_rows(rows, high_water):
+    """
+    跳过上次已处理的消息 (行末须带 rowid), 并把 high_water ({'last_ts', 'last_rids'}) 更新为读取到的最后一个时间戳及该时间戳下的全部 rowid。
+    增量导出与全文检索索引共用。
+    """
+    prev_ts, prev_rids = high_water['last_ts'], set(high_water['last_rids'])
+    for row in rows:
+        ts, rid = row[0], row[4]
+        if ts == prev_ts and rid in prev_rids: continue
+        if ts == high_water['last_ts']: high_water['last_rids'].append(rid)
+        else: high_water['last_ts'], high_water['last_rids'] = ts, [rid]
+        yield row
+
+def _output_extension(export_format, compression=None):
+    """导出文件的扩展名 (压缩输出时追加 .gz / .zst)。分片HTML输出为以文件名命名的目录 (内含 index.html 与分片), 没有扩展名。"""
+    if export_format == 'html-sharded': return ""
+    return f".{export_format}{_COMPRESSION_SUFFIXES.get(compression, '')}"
+
+def _split_format_compression(export_format, default_compression=None):
+    """拆分带压缩后缀的导出格式, 如 'md.gz' -> ('md', 'gzip')；没有后缀时使用配置项 compression。"""
+    for codec, suffix in _COMPRESSION_SUFFIXES.items():
+        if export_format and export_format.endswith(suffix): return export_format[:-len(suffix)], codec
+    return export_format, (default_compression if default_compression in _COMPRESSION_SUFFIXES else None)
+
+def _check_compression(compression, send_status):
+    """zstd 依赖可选的 zstandard 库, 未安装时改用 gzip。"""
+    if compression == 'zstd' and zstandard is None:
+        send_status("提示: 未安装 zstandard 库 (pip install zstandard), 本次改用 gzip 压缩。")
+        return 'gzip'
+    return compression
+
+def _open_export_file(path, compression=None, export_config=None, encoding='utf-8-sig'):
+    """
+    以文本方式打开导出文件, 默认 UTF-8 (带 BOM); JSONL 需逐行可解析, 应传入 encoding='utf-8'。
+    compression 为 'gzip' / 'zstd' 时写入的内容经流式压缩后落盘,
+    压缩级别取配置项 compression_level, zstd 的压缩线程数取 compression_threads。
+    """
+    export_config = export_config or {}
+    level = export_config.get('compression_level', 6)
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding=encoding, newline='', compresslevel=max(0, min(int(level), 9)))
+    if compression == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=int(level), threads=int(export_config.get('compression_threads', 0)))
+        return io.TextIOWrapper(compressor.stream_writer(open(path, 'wb')), encoding=encoding, newline='')
+    return open(path, 'w', encoding=encoding, newline='')
+
+def _append_export_file(output_path, export_format, template, header, layout, body):
+    """
+    增量续写: 写入重新生成的文件头, 按字节原样复制旧文件中已有的正文, 再写入新正文 (HTML 还需补上模板尾部)。
+    先写入临时文件再替换原文件, 返回新文件中正文的起始偏移。
+    """
+    if export_format == 'html':
+        prefix, suffix = template.split(header)
+    else:
+        prefix, suffix = header, ''
+    part_path = output_path + ".part"
+    with open(part_path, "wb") as f, open(layout['path'], "rb") as old:
+        f.write(codecs.BOM_UTF8 + prefix.encode('utf-8'))
+        body_start = f.tell()
+        old.seek(layout['body_start'])
+        remaining = layout['open_end'] - layout['body_start']
+        while remaining > 0:
+            chunk = old.read(min(remaining, _COPY_BUFFER_SIZE))
+            if not chunk: break
+            f.write(chunk); remaining -= len(chunk)
+        body.seek(0)
+        for chunk in iter(lambda: body.read(_COPY_BUFFER_SIZE), ''):
+            f.write(chunk.encode('utf-8'))
+        f.write(suffix.encode('utf-8'))
+    os.replace(part_path, output_path)
+    return body_start
+
+def process_and_write(output_path, rows, profile_mgr, config, scope_info, resume=None):
+    """
+    解码、过滤并写入文件，返回 (写入的条目数, 文件路径)。
+    消息逐条解码并写入临时缓冲区 (超过 _SPOOL_MAX_SIZE 时转存磁盘)，内存占用与会话大小无关。
+    文件头中的起止时间要在写完正文后才能确定，因此确认存在有效消息后再创建目标文件并写入文件头与正文。
+    resume 为增量导出状态 (此时每行末尾须带 rowid)。其中记录了上次写入的文件时, 跳过已导出的消息,
+    沿用旧文件的正文并在其后续写新消息, 文件头按新的时间范围重新生成; 写入完成后 resume 更新为本次的状态。
+    分片HTML (html-sharded) 的 output_path 为输出目录, 消息写入其中的分片文件, 外壳页 index.html 只含日期索引。
+    """
+    export_format = config.get('export_format', 'md')
+    sharded = export_format == 'html-sharded'
+    if sharded:
+        output_dir, output_path = output_path, os.path.join(output_path, "index.html")
+    is_group = scope_info.get('type') == 'group'
     write_config = {**config, 'is_group': is_group}
 
-    with open(output_path, "w", encoding="utf-8-sig", newline='') as f:
-        if export_format == 'html':
-            count = _write_html(f, valid_rows, profile_mgr, write_config, scope_info)
+    template = None
+    if export_format in ('html', 'html-sharded'):
+        template, error_html = _load_html_template(config)
+        if template is None:
+            if sharded: os.makedirs(output_dir, exist_ok=True)
+            with _open_export_file(output_path, config.get('compression'), config['export_config']) as f: f.write(error_html)
+            return 0, output_path
+        if resume is not None and template.content_slots != 1: resume = None
+    layout = resume.get('layout') if resume else None
+
+    time_span = [layout['first_ts'], layout['last_record_ts']] if layout else [None, None]
+    def track_time_span(records):
+        for record in records:
+            if time_span[0] is None: time_span[0] = record[0]
+            time_span[1] = record[0]
+            yield record
+
+    high_water = {'last_ts': resume.get('last_ts'), 'last_rids': list(resume.get('last_rids', []))} if resume is not None else None
+    writer_state = copy.deepcopy(layout['writer']) if layout else {}
+    records = track_time_span(_iter_decoded_records(_iter_new_rows(rows, high_water) if high_water else rows, profile_mgr, config, is_group))
+    with tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE, mode="w+", encoding="utf-8", newline='') as body:
+        if sharded:
+            count, shard_index = _write_html_shards(os.path.join(output_dir, _HTML_SHARD_DIR_NAME), records, profile_mgr, write_config)
+            _write_html_shard_index(body, shard_index, _HTML_SHARD_DIR_NAME)
+        elif export_format == 'html':
+            count = _write_html(body, records, profile_mgr, write_config, writer_state)
+        elif export_format == 'md':
+            count = _write_md(body, records, profile_mgr, write_config, writer_state)
         else:
-            f.write(_generate_text_header(write_config, valid_rows, scope_info))
-            if export_format == 'md':
-                count = _write_md(f, valid_rows, profile_mgr, write_config)
-            else:
-                count = _write_txt(f, valid_rows, profile_mgr, write_config)
-    
+            count = _write_txt(body, records, profile_mgr, write_config)
+        body_open_end = writer_state.pop('open_end', None)
+        if body_open_end is None: body_open_end = body.tell()
+        if not count:
+            if layout: resume.update(high_water)
+            return 0, (layout['path'] if layout else None)
+
+        header = _generate_html_header(write_config, scope_info, *time_span) if template else _generate_text_header(write_config, scope_info, *time_span)
+        if layout:
+            body_start = _append_export_file(output_path, export_format, template, header, layout, body)
+            body_open_end += body_start + layout['open_end'] - layout['body_start']
+        else:
+            with _open_export_file(output_path, config.get('compression'), config['export_config']) as f:
+                if template:
+                    template.write(f, header, body)
+                else:
+                    f.write(header)
+                    body.seek(0)
+                    shutil.copyfileobj(body, f)
+            prefix = template.split(header)[0] if template else header
+            body_start = len(codecs.BOM_UTF8) + len(prefix.encode('utf-8'))
+            body_open_end += body_start
+
+    if resume is not None:
+        resume.update(high_water)
+        resume['layout'] = {'path': output_path, 'size': os.path.getsize(output_path), 'body_start': body_start, 'open_end': body_open_end,
+                            'writer': writer_state, 'first_ts': time_span[0], 'last_record_ts': time_span[1]}
     return count, output_path
 
 def _write_json(f, rows_as_dicts):
-    """将字典列表写入JSON文件，并处理bytes类型。"""
-    processed_rows = []
+    """将字典序列逐条写入JSON数组文件，并处理bytes类型。输出格式与 json.dump(..., indent=4) 相同。"""
+    count = 0
     for row in rows_as_dicts:
         processed_row = {}
         for key, value in row.items():
@@ -1147,18 +2461,36 @@ def _write_json(f, rows_as_dicts):
                 processed_row[key] = base64.b64encode(value).decode('ascii')
             else:
                 processed_row[key] = value
-        processed_rows.append(processed_row)
+        f.write(",\n" if count else "[\n")
+        f.write(textwrap.indent(json.dumps(processed_row, indent=4, ensure_ascii=False), "    "))
+        count += 1
     
-    json.dump(processed_rows, f, indent=4, ensure_ascii=False)
-    return len(processed_rows)
+    f.write("\n]" if count else "[]")
+    return count
+
+def _jsonl_default(value):
+    """JSONL 编码器的回退: bytes (包括嵌套在 Protobuf 解析结果中的) 编码为 Base64。"""
+    if isinstance(value, (bytes, bytearray)): return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+_JSONL_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_jsonl_default)
+
+def _write_jsonl(f, rows_as_dicts):
+    """将字典序列逐条写入JSON Lines文件 (每行一个紧凑的JSON对象), 不复制行数据, bytes 值在编码时直接转为 Base64。"""
+    count = 0
+    encode = _JSONL_ENCODER.encode
+    for row in rows_as_dicts:
+        f.write(encode(row)); f.write("\n")
+        count += 1
+    return count
 
 def _write_csv(f, rows_as_dicts, field_names):
-    """将字典列表写入CSV文件。"""
-    if not rows_as_dicts: return 0
+    """将字典序列逐条写入CSV文件。"""
+    count = 0
     writer = csv.DictWriter(f, fieldnames=field_names)
-    writer.writeheader()
     
     for row in rows_as_dicts:
+        if not count: writer.writeheader()
         processed_row = {}
         for key, value in row.items():
             if isinstance(value, bytes):
@@ -1169,7 +2501,8 @@ def _write_csv(f, rows_as_dicts, field_names):
             else:
                 processed_row[key] = value
         writer.writerow(processed_row)
-    return len(rows_as_dicts)
+        count += 1
+    return count
 
 # --- WebSocket Handlers ---
 async def send_json(websocket, data):
@@ -1232,52 +2565,60 @@ async def handle_get_initial_data(websocket):
 
 async def handle_get_db_fields(websocket): await send_json(websocket, {"type": "db_fields", "fields": DB_FIELDS_CACHE})
 
+def _scan_all_db_schemas():
+    """扫描当前线程持有的全部数据库连接的表结构; 从连接池取连接可能等待, 须在线程池中调用。"""
+    return {name: _scan_db_schema(con) for name, con in DB_POOL.connections().items() if con}
+
 async def handle_get_db_info(websocket):
-    db_info_payload = {}
-    for name, con in DB_CONNECTIONS.items():
-        if con:
-            db_info_payload[name] = _scan_db_schema(con)
-    await send_json(websocket, {"type": "db_info", "data": db_info_payload})
+    db_info_payload = await _run_in_db_executor(_scan_all_db_schemas)
+    await send_json(websocket, {"type": "db_info", "data": db_info_payload, "text_cache": MessageTextCache.total_stats()})
 
 async def handle_get_chat_history(websocket, data):
+    if not all([data.get("type"), data.get("id"), DB_POOL]): return
+    history, prepend = await _run_in_db_executor(_load_chat_history, data)
+    await send_json(websocket, {"type": "chat_history", "history": history, "prepend": prepend, "is_date_jump": bool(data.get("from_ts"))})
+
+def _load_chat_history(data):
+    """
+    读取并解码 Web UI 聊天记录视图所需的一页消息，返回 (history, prepend)。可选的 limit 为向前翻页时每页条数 (默认200, 最多2000)。
+    from_ts 跳转时默认读取其后一天的消息, 可用 to_ts 指定结束时间。
+    """
     chat_type, chat_id = data.get("type"), data.get("id")
     before_ts, from_ts = data.get("before_ts"), data.get("from_ts")
-    if not all([chat_type, chat_id, DB_CON]): return
 
-    cur, history, params, prepend = DB_CON.cursor(), [], [chat_id], False
-    table_name, peer_col, group_uid_for_name = (TABLE_NAME_C2C, COL_C2C_PEER_UID, None) if chat_type == 'friend' else (TABLE_NAME_GROUP, COL_GROUP_ID_UID, chat_id)
-    query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_MSG_CONTENT}` FROM {table_name} WHERE `{peer_col}` = ?"
-    
-    order_clause = f"ORDER BY `{COL_TIMESTAMP}` DESC"
-    limit_clause = "LIMIT 200"
+    cur, history, time_conditions, prepend = DB_POOL.get().cursor(), [], [], False
+    group_uid_for_name = None if chat_type == 'friend' else chat_id
+    try: limit = min(max(int(data.get("limit") or 200), 1), 2000)
+    except (TypeError, ValueError): limit = 200
+    descending = True
 
     if before_ts: 
-        query += f" AND `{COL_TIMESTAMP}` < ?"
-        params.append(before_ts)
+        time_conditions.append(('<', before_ts))
         prepend = True
     elif from_ts:
-        end_ts = from_ts + 86400 # 修复：获取一整天的数据
-        query += f" AND `{COL_TIMESTAMP}` BETWEEN ? AND ?"
-        params.extend([from_ts, end_ts])
-        order_clause = f"ORDER BY `{COL_TIMESTAMP}` ASC"
-        limit_clause = "LIMIT 2000" # 增加单日消息上限
+        end_ts = data.get("to_ts") or from_ts + 86400 # 修复：获取一整天的数据
+        time_conditions.extend([('>=', from_ts), ('<=', end_ts)])
+        descending = False
+        limit = 2000 # 增加单日消息上限
     
-    query += f" {order_clause} {limit_clause}"
+    query, params = _conversation_query('c2c' if chat_type == 'friend' else 'group', chat_id,
+                                        [COL_TIMESTAMP, COL_SENDER_UID, COL_MSG_CONTENT], time_conditions, descending, limit)
 
     cur.execute(query, params)
     results = cur.fetchall()
-    if order_clause.endswith("DESC"): results.reverse()
+    if descending: results.reverse()
     
+    text_cache = MessageTextCache(CONFIG_MGR.config.get('reply_cache_max_bytes', _TEXT_CACHE_MAX_BYTES))
+    conversation = ('c2c' if chat_type == 'friend' else 'group', chat_id)
     for ts, s_uid, content in results:
-        parts = decode_message_content(content, ts, PROFILE_MGR, 'default', '', CONFIG_MGR.config)
+        parts = decode_message_content(content, ts, PROFILE_MGR, 'default', '', CONFIG_MGR.config, text_cache=text_cache, conversation=conversation)
         if not parts: continue
-        is_system_tip = isinstance(parts[0], dict) and parts[0].get('type') == 'interactive_tip'
-        if is_system_tip: text_parts = [f"{parts[0]['actor']} {parts[0]['verb']} {parts[0]['target']}{parts[0]['suffix']}"]
-        else: text_parts = [str(p) for p in parts if not isinstance(p, dict)]
-        final_text = " ".join(text_parts)
+        _remember_message_text(text_cache, conversation, ts, parts)
+        is_system_tip = isinstance(parts[0], GrayTipSegment)
+        final_text = _message_display_text(parts)
         
         msg_obj = {
-            "ts": ts, "s_uid": s_uid, "text": html.escape(final_text).replace('[%\\n%]', '<br>'),
+            "ts": ts, "s_uid": s_uid, "text": html.escape(final_text).replace('\n', '<br>'),
             "sender_name": PROFILE_MGR.get_display_name(s_uid, group_uid=group_uid_for_name),
             "is_system_tip": is_system_tip
         }
@@ -1289,7 +2630,28 @@ async def handle_get_chat_history(websocket, data):
                  msg_obj['title'] = member_info.get('title')
         history.append(msg_obj)
         
-    await send_json(websocket, {"type": "chat_history", "history": history, "prepend": prepend, "is_date_jump": bool(from_ts)})
+    text_cache.close()
+    return history, prepend
+
+async def handle_search(websocket, data):
+    """全文检索; 索引正在构建时, 构建进度以 search_index_status 消息推送给该客户端, 直到构建结束。"""
+    loop = asyncio.get_running_loop()
+    def listener(status):
+        asyncio.run_coroutine_threadsafe(send_json(websocket, {"type": "search_index_status", "status": status}), loop)
+        if status['state'] != 'building': SEARCH_INDEX.remove_listener(listener)
+    try:
+        result = await _run_in_db_executor(search_chat_history, data.get("params", {}), listener)
+    except ValueError as e:
+        await send_json(websocket, {"type": "search_error", "message": str(e)}); return
+    await send_json(websocket, {"type": "search_results", **result})
+
+async def handle_get_chat_stats(websocket, data):
+    """会话统计; 与 search 相同, 参数放在消息的 params 字段中。"""
+    try:
+        stats = await _run_in_db_executor(get_chat_stats, data.get("params", {}))
+    except ValueError as e:
+        await send_json(websocket, {"type": "chat_stats_error", "message": str(e)}); return
+    await send_json(websocket, {"type": "chat_stats", "stats": stats})
 
 async def handle_save_config(websocket, data):
     new_config = data.get("config")
@@ -1299,55 +2661,108 @@ async def handle_save_config(websocket, data):
         PROFILE_MGR.load_non_friends(CONFIG_MGR)
         await handle_get_initial_data(websocket)
 
-async def handle_start_export(websocket, data): await asyncio.get_running_loop().run_in_executor(None, run_export_task_ws, asyncio.get_running_loop(), websocket, data.get("params", {}))
-async def handle_export_extra_group_data(websocket, data): await asyncio.get_running_loop().run_in_executor(None, run_export_extra_task, asyncio.get_running_loop(), websocket, data)
-async def handle_start_raw_export(websocket, data): await asyncio.get_running_loop().run_in_executor(None, run_raw_export_task, asyncio.get_running_loop(), websocket, data.get("params", {}))
+async def _run_in_db_executor(func, *args):
+    """在线程池中执行需要读取数据库的任务；任务结束后归还该线程占用的数据库连接。"""
+    def task():
+        pool = DB_POOL
+        try: return func(*args)
+        finally:
+            # 任务期间工作目录可能被切换: 归还旧连接池的连接, 也归还任务中途从新连接池取得的连接
+            if pool: pool.release()
+            if DB_POOL and DB_POOL is not pool: DB_POOL.release()
+    return await asyncio.get_running_loop().run_in_executor(None, task)
+
+async def handle_start_export(websocket, data): await _run_in_db_executor(run_export_task_ws, asyncio.get_running_loop(), websocket, data.get("params", {}))
+async def handle_export_extra_group_data(websocket, data): await _run_in_db_executor(run_export_extra_task, asyncio.get_running_loop(), websocket, data)
+async def handle_start_raw_export(websocket, data): await _run_in_db_executor(run_raw_export_task, asyncio.get_running_loop(), websocket, data.get("params", {}))
+
+def _conversation_query(chat_type, peer_id, columns, time_conditions=(), descending=False, limit=None):
+    """
+    构造读取单个会话消息的 SQL，返回 (sql, params)。
+    time_conditions 为 [(比较运算符, 时间戳)] 形式的时间条件，如 [('>=', start_ts)]。
+    伴随索引可用时按 (peer, ts) 在索引中定位 rowid 再回表读取，否则直接查询消息表。
+    """
+    table_name, peer_col = (TABLE_NAME_GROUP, COL_GROUP_ID_UID) if chat_type == 'group' else (TABLE_NAME_C2C, COL_C2C_PEER_UID)
+    direction = "DESC" if descending else "ASC"
+    params = [peer_id] + [value for _, value in time_conditions]
+    index_table = MESSAGE_INDEX.table_for(table_name) if MESSAGE_INDEX else None
+    if index_table:
+        where = " AND ".join(["i.peer = ?"] + [f"i.ts {op} ?" for op, _ in time_conditions])
+        query = (f"SELECT {', '.join(f'm.`{c}`' for c in columns)} FROM {index_table} AS i CROSS JOIN {table_name} AS m ON m.rowid = i.rid "
+                 f"WHERE {where} ORDER BY i.ts {direction}, i.rid {direction}")
+    else:
+        where = " AND ".join([f"`{peer_col}` = ?"] + [f"`{COL_TIMESTAMP}` {op} ?" for op, _ in time_conditions])
+        query = f"SELECT {', '.join(f'`{c}`' for c in columns)} FROM {table_name} WHERE {where} ORDER BY `{COL_TIMESTAMP}` {direction}"
+    if limit: query += f" LIMIT {int(limit)}"
+    return query, params
+
+def _export_time_conditions(start_ts, end_ts):
+    conditions = []
+    if start_ts and start_ts > 0: conditions.append(('>=', start_ts))
+    if end_ts and end_ts > 0: conditions.append(('<=', end_ts))
+    return conditions
+
+def _query_conversation_rows(chat_type, peer_id, start_ts, end_ts, resume=None):
+    """
+    按时间顺序读取单个会话的消息行 (ts, sender, peer, content)。
+    resume 为增量导出状态时每行末尾附带 rowid, 且只读取上次导出的最后一个时间戳及之后的消息。
+    """
+    peer_col = COL_GROUP_ID_UID if chat_type == 'group' else COL_C2C_PEER_UID
+    columns = [COL_TIMESTAMP, COL_SENDER_UID, peer_col, COL_MSG_CONTENT]
+    time_conditions = _export_time_conditions(start_ts, end_ts)
+    if resume is not None:
+        columns.append('rowid')
+        if resume.get('last_ts') is not None: time_conditions.append(('>=', resume['last_ts']))
+    query, params = _conversation_query(chat_type, peer_id, columns, time_conditions)
+    cur = DB_POOL.get().cursor()
+    cur.execute(query, params)
+    return _iter_cursor_rows(cur)
 
 # --- Export Tasks ---
-def export_one_on_one(config, friend_uid, scope_info, send_status, out_dir=None):
-    """导出一个好友的一对一聊天记录, 返回文件路径或None。"""
+def export_one_on_one(config, friend_uid, scope_info, send_status, out_dir=None, rows=None):
+    """导出一个好友的一对一聊天记录, 返回文件路径或None。rows 为批量导出时已按会话切分好的消息行。"""
     profile_mgr, start_ts, end_ts = config['profile_mgr'], config['start_ts'], config['end_ts']
     friend_display_name = profile_mgr.get_display_name(friend_uid)
     
     send_status(f"正在处理: {friend_display_name}...")
     
-    query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_C2C_PEER_UID}`, `{COL_MSG_CONTENT}` FROM {TABLE_NAME_C2C}"
-    clauses = [f"`{COL_C2C_PEER_UID}` = ?"]
-    params = [friend_uid]
-
-    if start_ts and start_ts > 0:
-        clauses.append(f"`{COL_TIMESTAMP}` >= ?")
-        params.append(start_ts)
-    if end_ts and end_ts > 0:
-        clauses.append(f"`{COL_TIMESTAMP}` <= ?")
-        params.append(end_ts)
-    query += f" WHERE {' AND '.join(clauses)} ORDER BY `{COL_TIMESTAMP}` ASC"
-    
-    cur = DB_CON.cursor()
-    cur.execute(query, params)
-    rows = cur.fetchall()
+    output_dir = out_dir or os.path.join(OUTPUT_DIR, "Individual")
+    state_store = config.get('incremental_state')
+    state_key = state_store.key_for(config, 'c2c', friend_uid, output_dir) if state_store else None
+    resume = state_store.get(state_key) if state_store else None
+    previous_path = resume.get('layout', {}).get('path') if resume else None
+
+    if rows is None:
+        rows = _query_conversation_rows('c2c', friend_uid, start_ts, end_ts, resume)
+    first_row, rows = _peek_rows(rows)
     
-    if not rows:
+    if first_row is None:
+        if previous_path:
+            send_status(f"处理完成: {friend_display_name} -> 没有新消息, 沿用 \"{os.path.abspath(previous_path)}\"")
+            return previous_path
         send_status(f"处理完成: {friend_display_name} -> 指定时间内无聊天记录。")
         return None
 
-    output_dir = out_dir or os.path.join(OUTPUT_DIR, "Individual")
     os.makedirs(output_dir, exist_ok=True)
-    filename = profile_mgr.get_filename(friend_uid, config['run_timestamp'], config.get('export_format', 'md'))
-    path = os.path.join(output_dir, filename)
+    filename = profile_mgr.get_filename(friend_uid, config['run_timestamp'], config.get('export_format', 'md'), config.get('compression'))
+    path = previous_path or os.path.join(output_dir, filename)
         
     process_config = {**config, 'is_timeline': False}
-    count, written_path = process_and_write(path, rows, profile_mgr, process_config, scope_info)
+    count, written_path = process_and_write(path, rows, profile_mgr, process_config, scope_info, resume)
+    if state_store and resume.get('layout'): state_store.put(state_key, resume)
     
     if count > 0:
-        send_status(f"处理完成: {friend_display_name} -> 共导出 {count} 条消息到 \"{os.path.abspath(path)}\"")
+        send_status(f"处理完成: {friend_display_name} -> 共导出 {count} 条{'新' if previous_path else ''}消息到 \"{os.path.abspath(written_path)}\"")
         return written_path
+    elif previous_path:
+        send_status(f"处理完成: {friend_display_name} -> 没有新的有效消息, 沿用 \"{os.path.abspath(previous_path)}\"")
+        return previous_path
     else:
         send_status(f"处理完成: {friend_display_name} -> 指定时间内无有效消息可导出。")
         return None
 
-def export_group_chat(config, group_uid, scope_info, send_status, output_dir_base=None):
-    """导出一个群聊的聊天记录, 返回文件路径或None。"""
+def export_group_chat(config, group_uid, scope_info, send_status, output_dir_base=None, rows=None):
+    """导出一个群聊的聊天记录, 返回文件路径或None。rows 为批量导出时已按会话切分好的消息行。"""
     profile_mgr, start_ts, end_ts = config['profile_mgr'], config['start_ts'], config['end_ts']
     group_info = profile_mgr.chat_groups.get(str(group_uid), {})
     group_name = group_info.get('name', group_uid)
@@ -1355,48 +2770,103 @@ def export_group_chat(config, group_uid, scope_info, send_status, output_dir_bas
     
     send_status(f"正在处理群聊: {group_name} ({group_uin})...")
     
-    query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_GROUP_ID_UID}`, `{COL_MSG_CONTENT}` FROM {TABLE_NAME_GROUP}"
-    clauses = [f"`{COL_GROUP_ID_UID}` = ?"]
-    params = [group_uid]
-    
-    if start_ts and start_ts > 0:
-        clauses.append(f"`{COL_TIMESTAMP}` >= ?"); params.append(start_ts)
-    if end_ts and end_ts > 0:
-        clauses.append(f"`{COL_TIMESTAMP}` <= ?"); params.append(end_ts)
-    query += f" WHERE {' AND '.join(clauses)} ORDER BY `{COL_TIMESTAMP}` ASC"
-
-    cur = DB_CON.cursor()
-    cur.execute(query, params)
-    rows = cur.fetchall()
+    base_dir = output_dir_base or OUTPUT_DIR
+    output_dir = os.path.join(base_dir, "Individual", "Groups")
+    state_store = config.get('incremental_state')
+    state_key = state_store.key_for(config, 'group', group_uid, output_dir) if state_store else None
+    resume = state_store.get(state_key) if state_store else None
+    previous_path = resume.get('layout', {}).get('path') if resume else None
+
+    if rows is None:
+        rows = _query_conversation_rows('group', group_uid, start_ts, end_ts, resume)
+    first_row, rows = _peek_rows(rows)
     
-    if not rows:
+    if first_row is None:
+        if previous_path:
+            send_status(f"处理完成: {group_name} -> 没有新消息, 沿用 \"{os.path.abspath(previous_path)}\"")
+            return previous_path
         send_status(f"处理完成: {group_name} -> 指定时间内无聊天记录。")
         return None
     
-    base_dir = output_dir_base or OUTPUT_DIR
-    output_dir = os.path.join(base_dir, "Individual", "Groups")
     os.makedirs(output_dir, exist_ok=True)
     
     safe_name = re.sub(r'[\\/*?:"<>|]', '_', str(group_name))
-    filename = f"群聊_{safe_name}_{group_uin}{config['run_timestamp']}.{config.get('export_format', 'md')}"
-    path = os.path.join(output_dir, filename)
+    filename = f"群聊_{safe_name}_{group_uin}{config['run_timestamp']}{_output_extension(config.get('export_format', 'md'), config.get('compression'))}"
+    path = previous_path or os.path.join(output_dir, filename)
 
     process_config = {**config, 'is_timeline': False}
-    count, written_path = process_and_write(path, rows, profile_mgr, process_config, scope_info)
+    count, written_path = process_and_write(path, rows, profile_mgr, process_config, scope_info, resume)
+    if state_store and resume.get('layout'): state_store.put(state_key, resume)
 
     if count > 0:
-        send_status(f"处理完成: {group_name} -> 共导出 {count} 条消息到 \"{os.path.abspath(path)}\"")
+        send_status(f"处理完成: {group_name} -> 共导出 {count} 条{'新' if previous_path else ''}消息到 \"{os.path.abspath(written_path)}\"")
         return written_path
+    elif previous_path:
+        send_status(f"处理完成: {group_name} -> 没有新的有效消息, 沿用 \"{os.path.abspath(previous_path)}\"")
+        return previous_path
     else:
         send_status(f"处理完成: {group_name} -> 指定时间内无有效消息可导出。")
         return None
 
 
-def export_timeline(config, friend_uids, group_uids, scope_info, send_status, output_dir_base=None):
-    """执行全局时间线导出, 返回文件路径或None。"""
-    send_status("正在执行“全局时间线”导出...")
+def _target_filter(peer_expr, uids, select_all=False):
+    """
+    构造会话过滤条件, 返回 (条件列表, 参数列表)。
+    目标集合以单个 JSON 数组参数传入并由 json_each 展开, 不受 SQLite 变量个数上限影响;
+    调用方显式指定了全部会话 (select_all) 时不再过滤。
+    """
+    if select_all: return [], []
+    return [f"{peer_expr} IN (SELECT value FROM json_each(?))"], [json.dumps(list(dict.fromkeys(uids)), ensure_ascii=False)]
+
+def _iter_partitioned_rows(chat_type, uids, start_ts, end_ts, select_all=False):
+    """
+    单次查询按 (peer, ts) 顺序读取整张消息表, 产出 (peer, rows) 形式的会话分区。
+    有伴随索引时沿索引顺序回表 (同一会话的 rowid 基本递增, 回表读取大体是顺序的);
+    没有索引时对消息表做一次全表扫描, 由 SQLite 排序后按会话切分, 不再逐个会话查询。
+    """
+    table_name, peer_col = (TABLE_NAME_GROUP, COL_GROUP_ID_UID) if chat_type == 'group' else (TABLE_NAME_C2C, COL_C2C_PEER_UID)
+    index_table = MESSAGE_INDEX.table_for(table_name) if MESSAGE_INDEX else None
+    peer_expr, ts_expr, rid_expr = ("i.peer", "i.ts", "i.rid") if index_table else (f"m.`{peer_col}`", f"m.`{COL_TIMESTAMP}`", "m.rowid")
+    clauses, params = _target_filter(peer_expr, uids, select_all)
+    for op, value in _export_time_conditions(start_ts, end_ts):
+        clauses.append(f"{ts_expr} {op} ?"); params.append(value)
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    columns = ', '.join(f'm.`{c}`' for c in (COL_TIMESTAMP, COL_SENDER_UID, peer_col, COL_MSG_CONTENT))
+    source = f"{index_table} AS i CROSS JOIN {table_name} AS m ON m.rowid = i.rid" if index_table else f"{table_name} AS m"
+    cur = DB_POOL.get().cursor()
+    cur.execute(f"SELECT {columns} FROM {source} {where_sql} ORDER BY {peer_expr}, {ts_expr}, {rid_expr}", params)
+    return itertools.groupby(_iter_cursor_rows(cur), key=lambda row: row[2])
+
+def export_individual_bulk(config, friend_uids, group_uids, send_status, friend_out_dir, output_dir_base=None):
+    """
+    批量独立导出: 每张消息表只扫描一次, 按会话切分后依次写入各自的文件, 返回生成的文件路径列表。
+    扫描结果按会话连续到达, 同一时间只有一个输出文件处于打开状态。
+    """
     start_ts, end_ts = config['start_ts'], config['end_ts']
-    
+    exported_files = []
+
+    def export_one(chat_type, uid, rows=None):
+        if chat_type == 'group':
+            return export_group_chat(config, uid, {'type': 'group', 'group_uid': uid}, send_status, output_dir_base=output_dir_base, rows=rows)
+        return export_one_on_one(config, uid, {'type': 'individual', 'friend_uid': uid}, send_status, out_dir=friend_out_dir(uid), rows=rows)
+
+    for chat_type, uids in (('c2c', friend_uids), ('group', group_uids)):
+        if not uids: continue
+        remaining = dict.fromkeys(uids)
+        partitions = _iter_partitioned_rows(chat_type, uids, start_ts, end_ts, chat_type == 'group' and config.get('all_groups', False))
+        for peer_id, rows in partitions:
+            if peer_id not in remaining: continue
+            del remaining[peer_id]
+            file_path = export_one(chat_type, peer_id, rows)
+            if file_path: exported_files.append(file_path)
+        # 扫描中未出现的会话即为指定时间内无消息
+        for uid in remaining:
+            file_path = export_one(chat_type, uid, iter(()))
+            if file_path: exported_files.append(file_path)
+    return exported_files
+
+def _iter_timeline_union(friend_uids, group_uids, start_ts, end_ts, all_groups=False):
+    """将所有会话 UNION ALL 后按时间戳统一排序, SQLite 需要先排序完整结果集才能返回第一行。"""
     base_queries = []
     params = []
     
@@ -1408,35 +2878,66 @@ def export_timeline(config, friend_uids, group_uids, scope_info, send_status, ou
     if end_ts and end_ts > 0:
         time_clauses.append(f"`{COL_TIMESTAMP}` <= ?")
         time_params.append(end_ts)
-    time_where_sql = f"AND {' AND '.join(time_clauses)}" if time_clauses else ""
 
     if friend_uids:
-        placeholders = ', '.join('?' for _ in friend_uids)
-        c2c_query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_C2C_PEER_UID}`, `{COL_MSG_CONTENT}`, 'c2c' as chat_type FROM {TABLE_NAME_C2C} WHERE `{COL_C2C_PEER_UID}` IN ({placeholders}) {time_where_sql}"
+        peer_clauses, peer_params = _target_filter(f"`{COL_C2C_PEER_UID}`", friend_uids)
+        where_sql = f"WHERE {' AND '.join(peer_clauses + time_clauses)}" if peer_clauses or time_clauses else ""
+        c2c_query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_C2C_PEER_UID}`, `{COL_MSG_CONTENT}`, 'c2c' as chat_type FROM {TABLE_NAME_C2C} {where_sql}"
         base_queries.append(c2c_query)
-        params.extend(friend_uids)
+        params.extend(peer_params)
         params.extend(time_params)
 
     if group_uids:
-        placeholders = ', '.join('?' for _ in group_uids)
-        group_query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_GROUP_ID_UID}`, `{COL_MSG_CONTENT}`, 'group' as chat_type FROM {TABLE_NAME_GROUP} WHERE `{COL_GROUP_ID_UID}` IN ({placeholders}) {time_where_sql}"
+        peer_clauses, peer_params = _target_filter(f"`{COL_GROUP_ID_UID}`", group_uids, all_groups)
+        where_sql = f"WHERE {' AND '.join(peer_clauses + time_clauses)}" if peer_clauses or time_clauses else ""
+        group_query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_GROUP_ID_UID}`, `{COL_MSG_CONTENT}`, 'group' as chat_type FROM {TABLE_NAME_GROUP} {where_sql}"
         base_queries.append(group_query)
-        params.extend(group_uids)
+        params.extend(peer_params)
         params.extend(time_params)
     
-    if not base_queries:
-        send_status("未选择任何会话，时间线导出中止。"); return None
-
     full_query = " UNION ALL ".join(base_queries)
     full_query += f" ORDER BY `{COL_TIMESTAMP}` ASC"
     
-    cur = DB_CON.cursor()
+    cur = DB_POOL.get().cursor()
     cur.execute(full_query, params)
-    rows = cur.fetchall()
+    return _iter_cursor_rows(cur)
+
+def _iter_timeline_merge(friend_uids, group_uids, start_ts, end_ts, all_groups=False):
+    """
+    为每个会话打开一个按时间排序的游标, 用堆做多路归并, 按时间戳顺序逐行产出。
+    内存占用与会话数量成正比, 与消息总数无关; 时间戳相同时按好友/群聊、rowid 排序。
+    """
+    con = DB_POOL.get()
+    time_conditions = _export_time_conditions(start_ts, end_ts)
+
+    def conversation_rows(order, chat_type, peer_id):
+        peer_col = COL_GROUP_ID_UID if chat_type == 'group' else COL_C2C_PEER_UID
+        query, params = _conversation_query(chat_type, peer_id, [COL_TIMESTAMP, COL_SENDER_UID, peer_col, COL_MSG_CONTENT, 'rowid'], time_conditions)
+        cur = con.cursor()
+        cur.execute(query, params)
+        for row in _iter_cursor_rows(cur, _MERGE_FETCH_SIZE):
+            yield row[0] or 0, order, row[4], row[:4] + (chat_type,)
+
+    sources = [conversation_rows(0, 'c2c', uid) for uid in dict.fromkeys(friend_uids)]
+    sources += [conversation_rows(1, 'group', uid) for uid in dict.fromkeys(group_uids)]
+    for *_, row in heapq.merge(*sources):
+        yield row
+
+def export_timeline(config, friend_uids, group_uids, scope_info, send_status, output_dir_base=None):
+    """执行全局时间线导出, 返回文件路径或None。"""
+    send_status("正在执行“全局时间线”导出...")
+    start_ts, end_ts = config['start_ts'], config['end_ts']
+    
+    if not friend_uids and not group_uids:
+        send_status("未选择任何会话，时间线导出中止。"); return None
+
+    engine = config['export_config'].get('timeline_engine', 'merge')
+    iter_rows = _iter_timeline_union if engine == 'union' else _iter_timeline_merge
+    first_row, rows = _peek_rows(iter_rows(friend_uids, group_uids, start_ts, end_ts, config.get('all_groups', False)))
     
-    if not rows: send_status("查询完成，但在指定范围内未能获取任何记录。"); return None
+    if first_row is None: send_status("查询完成，但在指定范围内未能获取任何记录。"); return None
         
-    ext = f".{config.get('export_format', 'md')}"
+    ext = _output_extension(config.get('export_format', 'md'), config.get('compression'))
     base_dir = output_dir_base or OUTPUT_DIR
     timeline_dir = os.path.join(base_dir, "Timeline")
     os.makedirs(timeline_dir, exist_ok=True)
@@ -1448,19 +2949,133 @@ def export_timeline(config, friend_uids, group_uids, scope_info, send_status, ou
     count, written_path = process_and_write(path, rows, PROFILE_MGR, process_config, scope_info)
     
     if count > 0:
-        send_status(f"处理完成！共导出 {count} 条有效消息到 {os.path.abspath(path)}")
+        send_status(f"处理完成！共导出 {count} 条有效消息到 {os.path.abspath(written_path)}")
         return written_path
     else:
         send_status("处理完成，但在指定范围内未发现可导出的有效消息。")
         return None
 
 
+_ARCHIVE_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE users (uid TEXT PRIMARY KEY, qq TEXT, nickname TEXT, remark TEXT, is_friend INTEGER, friend_group TEXT);
+CREATE TABLE conversations (
+    id INTEGER PRIMARY KEY, chat_type TEXT NOT NULL, peer_uid TEXT NOT NULL, peer_number TEXT, name TEXT,
+    message_count INTEGER, first_ts INTEGER, last_ts INTEGER, UNIQUE (chat_type, peer_uid));
+CREATE TABLE group_members (
+    conversation_id INTEGER NOT NULL, uid TEXT NOT NULL, qq TEXT, nickname TEXT, card_name TEXT, join_time INTEGER,
+    last_speak_time INTEGER, is_admin INTEGER, is_member INTEGER, level INTEGER, title TEXT, PRIMARY KEY (conversation_id, uid));
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL, ts INTEGER NOT NULL, date TEXT, time TEXT,
+    sender_uid TEXT, sender_name TEXT, msg_type INTEGER, msg_type_name TEXT, text TEXT,
+    reply_ts INTEGER, reply_sender TEXT, reply_text TEXT, media TEXT, segments TEXT);
+"""
+_ARCHIVE_INDEXES = """
+CREATE INDEX idx_messages_conversation_ts ON messages (conversation_id, ts);
+CREATE INDEX idx_messages_sender ON messages (sender_uid, ts);
+CREATE INDEX idx_messages_type ON messages (msg_type, conversation_id);
+"""
+
+def _message_type(parts):
+    """消息的类型 (MSG_TYPE_MAP 的键): 取第一个非引用片段的类型, 只有引用时为引用 (7)。"""
+    first = next((p for p in parts if not isinstance(p, ReplySegment)), None)
+    if first is None: return 7
+    if isinstance(first, MediaSegment): return first.kind
+    if isinstance(first, GrayTipSegment): return 8
+    return 1
+
+def _archive_message_row(conversation_id, record, names):
+    """将一条解析记录转为 messages 表的一行。"""
+    ts, s_uid, p_uid, chat_type, parts = record
+    main_text, _ = _split_message_parts(parts)
+    reply = next((p for p in parts if isinstance(p, ReplySegment)), None)
+    msg_type = _message_type(parts)
+    media = [[p.kind, p.text] for p in parts if isinstance(p, MediaSegment)]
+    sender = names.sender(s_uid, p_uid if chat_type == 'group' else None)
+    date, time_str = TIMESTAMP_FORMATTER.split(ts)
+    return (conversation_id, ts, date, time_str, s_uid or None, sender if sender != "N/A" else None, msg_type, MSG_TYPE_MAP.get(msg_type),
+            main_text, reply.ts if reply else None, reply.sender if reply else None, reply.origin if reply else None,
+            json.dumps(media, ensure_ascii=False) if media else None, json.dumps([p.to_json() for p in parts], ensure_ascii=False))
+
+def export_archive_db(config, friend_uids, group_uids, send_status, output_dir_base=None):
+    """
+    将所选会话解码后写入一个新的 SQLite 归档库, 返回文件路径或None。
+    归档库包含会话、用户资料、群成员快照与逐条消息 (渲染后的文本、引用原文、媒体信息和可还原的片段 JSON),
+    之后的统计分析直接查询归档库即可, 不必再解析导出的文本或重新解码 protobuf。
+    消息按批 executemany 写入, 每个会话一个事务, 索引在全部写入后再建立。先写入临时文件, 完成后再改为正式文件名。
+    """
+    profile_mgr, start_ts, end_ts = config['profile_mgr'], config['start_ts'], config['end_ts']
+    names = profile_mgr.name_table(config['name_style'], config['name_format'])
+    archive_dir = os.path.join(output_dir_base or OUTPUT_DIR, "Archive")
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{_ARCHIVE_FILENAME_BASE}_{len(friend_uids)}人_{len(group_uids)}群{config['run_timestamp']}.db")
+    temp_path = path + ".part"
+    if os.path.exists(temp_path): os.remove(temp_path)
+
+    con = sqlite3.connect(temp_path)
+    try:
+        con.execute("PRAGMA journal_mode = OFF"); con.execute("PRAGMA synchronous = OFF")
+        con.executescript(_ARCHIVE_SCHEMA)
+        with con:
+            con.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ('generated_at', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+                ('my_uid', profile_mgr.my_uid), ('my_qq', str(profile_mgr.my_qq)),
+                ('name_style', config['name_style']), ('name_format', config['name_format']),
+                ('start_ts', str(start_ts or '')), ('end_ts', str(end_ts or '')),
+                ('msg_db_fingerprint', _db_fingerprint(DB_PATH, config['export_config'].get('cache_validation', 'fast')))])
+            con.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", (
+                (uid, str(u.get('qq', '')), u.get('nickname'), u.get('remark'), int(bool(u.get('is_friend'))),
+                 profile_mgr.friend_groups.get(u.get('group_id', -1)) if u.get('is_friend') else None)
+                for uid, u in profile_mgr.all_users.items()))
+
+        total = 0
+        for chat_type, uids in (('c2c', friend_uids), ('group', group_uids)):
+            for uid in uids:
+                if chat_type == 'group':
+                    group_info = profile_mgr.chat_groups.get(str(uid), {})
+                    name, number = group_info.get('name', uid), group_info.get('uin')
+                else:
+                    name, number = profile_mgr.get_display_name(uid), profile_mgr.all_users.get(uid, {}).get('qq')
+                send_status(f"正在写入归档: {name}...")
+                records = _iter_decoded_records(_query_conversation_rows(chat_type, uid, start_ts, end_ts), profile_mgr, {**config, 'is_timeline': False}, is_group=chat_type == 'group')
+                with con:
+                    conversation_id = con.execute("INSERT INTO conversations (chat_type, peer_uid, peer_number, name) VALUES (?, ?, ?, ?)",
+                                                  (chat_type, uid, str(number) if number else None, name)).lastrowid
+                    if chat_type == 'group':
+                        con.executemany("INSERT INTO group_members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                            (conversation_id, m['uid'], str(m.get('qq') or ''), m.get('nickname'), m.get('card_name'), m.get('join_time'),
+                             m.get('last_speak_time'), int(bool(m.get('is_admin'))), int(bool(m.get('is_member'))), m.get('level'), m.get('title'))
+                            for m in group_info.get('members', {}).values()))
+                    count, first_ts, last_ts = 0, None, None
+                    while True:
+                        batch = [_archive_message_row(conversation_id, record, names) for record in itertools.islice(records, _ARCHIVE_INSERT_BATCH)]
+                        if not batch: break
+                        con.executemany("INSERT INTO messages (conversation_id, ts, date, time, sender_uid, sender_name, msg_type, msg_type_name, text, "
+                                        "reply_ts, reply_sender, reply_text, media, segments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                        if first_ts is None: first_ts = batch[0][1]
+                        last_ts, count = batch[-1][1], count + len(batch)
+                    con.execute("UPDATE conversations SET message_count = ?, first_ts = ?, last_ts = ? WHERE id = ?", (count, first_ts, last_ts, conversation_id))
+                total += count
+                send_status(f"处理完成: {name} -> 归档 {count} 条消息。")
+
+        send_status("正在为归档库建立索引...")
+        con.executescript(_ARCHIVE_INDEXES)
+        con.execute("ANALYZE")
+    except BaseException:
+        con.close()
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+    con.close()
+    os.replace(temp_path, path)
+    send_status(f"归档完成！共写入 {total} 条消息到 \"{os.path.abspath(path)}\"")
+    return path
+
 def export_custom_format(config, targets, send_status, output_dir_base=None):
     """执行自定义格式导出, 返回生成的文件路径列表。"""
     profile_mgr = config['profile_mgr']
     start_ts, end_ts = config['start_ts'], config['end_ts']
     custom_fields = config['custom_fields']
-    export_format = config['export_format'].replace('-custom', '') # json or csv
+    export_format = config['export_format'].replace('-custom', '') # json, jsonl or csv
     parse_protobuf_fields = config.get('parse_protobuf_fields', False)
     
     if not custom_fields: send_status("错误：未提供自定义导出的字段列表。"); return []
@@ -1486,7 +3101,7 @@ def export_custom_format(config, targets, send_status, output_dir_base=None):
             target_name = group_info.get('name', target_id)
             group_uin = group_info.get('uin', '未知群号')
             safe_name = re.sub(r'[\\/*?:"<>|]', '_', str(target_name))
-            filename = f"群聊_{safe_name}_{group_uin}{config['run_timestamp']}.{export_format}"
+            filename = f"群聊_{safe_name}_{group_uin}{config['run_timestamp']}{_output_extension(export_format, config.get('compression'))}"
             output_dir = os.path.join(base_dir, "Custom", "Groups")
         else: # friend
             if group_info_fields:
@@ -1494,7 +3109,7 @@ def export_custom_format(config, targets, send_status, output_dir_base=None):
                 continue
             table_name, peer_col = TABLE_NAME_C2C, COL_C2C_PEER_UID
             target_name = profile_mgr.get_display_name(target_id)
-            filename = profile_mgr.get_filename(target_id, config['run_timestamp'], export_format)
+            filename = profile_mgr.get_filename(target_id, config['run_timestamp'], export_format, config.get('compression'))
             output_dir = os.path.join(base_dir, "Custom", "Friends")
 
         send_status(f"正在处理自定义导出: {target_name}...")
@@ -1507,46 +3122,56 @@ def export_custom_format(config, targets, send_status, output_dir_base=None):
         if end_ts and end_ts > 0 and '40050' in fields_to_query: clauses.append(f"`{COL_TIMESTAMP}` <= ?"); params.append(end_ts)
         query += f" WHERE {' AND '.join(clauses)} ORDER BY `{COL_TIMESTAMP}` ASC"
         
-        cur = DB_CON.cursor(); cur.execute(query, params); rows = cur.fetchall()
+        cur = DB_POOL.get().cursor(); cur.execute(query, params)
+        first_row, rows = _peek_rows(_iter_cursor_rows(cur))
 
-        if not rows: send_status(f"处理完成: {target_name} -> 指定时间内无聊天记录。"); continue
+        if first_row is None: send_status(f"处理完成: {target_name} -> 指定时间内无聊天记录。"); continue
+        text_cache = MessageTextCache(config['export_config'].get('reply_cache_max_bytes', _TEXT_CACHE_MAX_BYTES))
+        conversation = ('group' if is_group else 'c2c', target_id)
             
-        rows_as_dicts = [dict(zip(fields_to_query, row)) for row in rows]
-        
-        for row_dict in rows_as_dicts:
-            if 'placeholder' in row_dict: del row_dict['placeholder']
-            sender_uid = row_dict.get('40020')
-            if parse_protobuf_fields and '40800' in row_dict and isinstance(row_dict['40800'], bytes):
-                content, timestamp = row_dict['40800'], row_dict.get('40050', 0)
-                parsed_parts = decode_message_content(content, timestamp, profile_mgr, 'default', '', config['export_config'])
-                row_dict['40800'] = " ".join(str(p) for p in parsed_parts).replace('[%\\n%]', '\n') if parsed_parts else "[内容解析失败]"
-
-            if is_group and group_info_fields and sender_uid:
-                group_info = profile_mgr.chat_groups.get(str(target_id))
-                if group_info and 'members' in group_info:
-                    member_info = group_info['members'].get(sender_uid)
-                    if member_info:
-                        field_map = {
-                            '1000': 'uid', '1002': 'qq', '20002': 'nickname',
-                            '64003': 'card_name', '64007': 'join_time', '64008': 'last_speak_time',
-                            '64010': 'is_admin', '64016': 'is_member', '64035': 'level',
-                            '64023': 'title'
-                        }
-                        for field_code in group_info_fields:
-                            if field_code in field_map:
-                                row_dict[field_code] = member_info.get(field_map.get(field_code))
-
-        final_rows = [{key: row.get(key) for key in custom_fields} for row in rows_as_dicts]
+        def iter_final_rows(rows):
+            for row in rows:
+                row_dict = dict(zip(fields_to_query, row))
+                if 'placeholder' in row_dict: del row_dict['placeholder']
+                sender_uid = row_dict.get('40020')
+                if parse_protobuf_fields and '40800' in row_dict and isinstance(row_dict['40800'], bytes):
+                    content, timestamp = row_dict['40800'], row_dict.get('40050', 0)
+                    parsed_parts = decode_message_content(content, timestamp, profile_mgr, 'default', '', config['export_config'], text_cache=text_cache, conversation=conversation)
+                    if parsed_parts: _remember_message_text(text_cache, conversation, timestamp, parsed_parts)
+                    row_dict['40800'] = " ".join(p.render() for p in parsed_parts) if parsed_parts else "[内容解析失败]"
+
+                if is_group and group_info_fields and sender_uid:
+                    group_info = profile_mgr.chat_groups.get(str(target_id))
+                    if group_info and 'members' in group_info:
+                        member_info = group_info['members'].get(sender_uid)
+                        if member_info:
+                            field_map = {
+                                '1000': 'uid', '1002': 'qq', '20002': 'nickname',
+                                '64003': 'card_name', '64007': 'join_time', '64008': 'last_speak_time',
+                                '64010': 'is_admin', '64016': 'is_member', '64035': 'level',
+                                '64023': 'title'
+                            }
+                            for field_code in group_info_fields:
+                                if field_code in field_map:
+                                    row_dict[field_code] = member_info.get(field_map.get(field_code))
+                yield {key: row_dict.get(key) for key in custom_fields}
+
+        final_rows = iter_final_rows(rows)
         os.makedirs(output_dir, exist_ok=True)
         path = os.path.join(output_dir, filename)
 
         try:
-            with open(path, "w", encoding="utf-8-sig", newline='') as f:
-                count = _write_json(f, final_rows) if export_format == 'json' else _write_csv(f, final_rows, custom_fields)
+            encoding = 'utf-8' if export_format == 'jsonl' else 'utf-8-sig'
+            with _open_export_file(path, config.get('compression'), config['export_config'], encoding) as f:
+                if export_format == 'json': count = _write_json(f, final_rows)
+                elif export_format == 'jsonl': count = _write_jsonl(f, final_rows)
+                else: count = _write_csv(f, final_rows, custom_fields)
             send_status(f"处理完成: {target_name} -> 共导出 {count} 条记录到 \"{os.path.abspath(path)}\"")
             written_files.append(path)
         except Exception as e:
             send_status(f"错误: 写入文件 {filename} 时失败: {e}")
+        finally:
+            text_cache.close()
             
     return written_files
 
@@ -1642,45 +3267,76 @@ def run_export_logic(params, status_callback, source="Unknown"):
         mode, targets, time_range, export_format = params.get("mode"), params.get("targets", []), params.get('time_range', {}), params.get('export_format', 'md')
         
         final_export_format = export_format or CONFIG_MGR.config.get('export_format', 'md')
+        final_export_format, compression = _split_format_compression(final_export_format, CONFIG_MGR.config.get('compression'))
+        if compression and final_export_format == 'html-sharded':
+            hybrid_status_update("提示: 分片HTML需要浏览器直接读取分片文件, 本次不压缩输出。")
+            compression = None
+        if compression and final_export_format == 'sqlite':
+            hybrid_status_update("提示: 归档数据库需要随机读写, 本次不压缩输出。")
+            compression = None
+        compression = _check_compression(compression, hybrid_status_update)
 
         config = {
             "start_ts": time_range.get('start'), "end_ts": time_range.get('end'),
             "name_style": CONFIG_MGR.config.get('name_style', 'default'), "name_format": CONFIG_MGR.config.get('name_format', ''),
             "profile_mgr": PROFILE_MGR, "run_timestamp": run_timestamp, 
             "export_config": CONFIG_MGR.config,
-            "export_format": final_export_format,
+            "export_format": final_export_format, "compression": compression,
             "custom_fields": params.get('custom_fields'),
-            "parse_protobuf_fields": params.get('parse_protobuf_fields', True)
+            "parse_protobuf_fields": params.get('parse_protobuf_fields', True),
+            "decode_workers": params.get('decode_workers'), "decode_chunk_size": params.get('decode_chunk_size'),
+            "all_groups": params.get('all_groups', False),  # 调用方以 all 指定了全部群聊, 查询时不再按群过滤
+            "incremental_state": None
         }
+
+        if params.get('incremental', False):
+            if mode == 'individual' and final_export_format in ('md', 'txt', 'html') and not compression and EXPORT_STATE:
+                config['incremental_state'] = EXPORT_STATE
+                hybrid_status_update("增量模式: 只导出各会话上次导出之后的新消息, 并续写到已有文件。")
+            else:
+                hybrid_status_update("提示: 增量模式仅支持 individual 模式未压缩的 md/txt/html 导出, 本次将完整导出。")
         
-        if final_export_format in ['json-custom', 'csv-custom']:
+        if final_export_format in ['json-custom', 'jsonl-custom', 'csv-custom']:
              if not config.get('custom_fields'):
-                 hybrid_status_update("错误: 使用 json-custom 或 csv-custom 格式时必须提供 --custom-fields 参数。")
+                 hybrid_status_update("错误: 使用 json-custom、jsonl-custom 或 csv-custom 格式时必须提供 --custom-fields 参数。")
                  return []
              hybrid_status_update(f"即将以自定义格式 ({final_export_format}) 导出 {len(targets)} 个会话...")
              paths = export_custom_format(config, targets, hybrid_status_update, output_dir_base=output_dir_base)
              if paths: exported_files.extend(paths)
+        elif final_export_format == 'sqlite':
+            friend_uids = [t['id'] for t in targets if t['type'] == 'friend']
+            group_uids = [t['id'] for t in targets if t['type'] == 'group']
+            hybrid_status_update(f"即将把 {len(friend_uids)} 个私聊和 {len(group_uids)} 个群聊导出到归档数据库...")
+            file_path = export_archive_db(config, friend_uids, group_uids, hybrid_status_update, output_dir_base=output_dir_base)
+            if file_path: exported_files.append(file_path)
         elif mode == 'individual':
             friend_uids = [t['id'] for t in targets if t['type'] == 'friend']
             group_uids = [t['id'] for t in targets if t['type'] == 'group']
             hybrid_status_update(f"即将以独立文件模式导出 {len(friend_uids)} 个私聊和 {len(group_uids)} 个群聊...")
             
-            if friend_uids:
-                base_friend_dir = os.path.join(output_dir_base, "Individual", "Friends")
+            base_friend_dir = os.path.join(output_dir_base, "Individual", "Friends")
+            def friend_out_dir(uid):
+                if not params.get('create_group_dirs', False): return base_friend_dir
+                user_info = PROFILE_MGR.all_users.get(uid, {})
+                if not user_info.get('is_friend'): gname = "_非好友_"
+                else: gname = PROFILE_MGR.friend_groups.get(user_info.get('group_id', -1), f"分组_{user_info.get('group_id', -1)}")
+                safe_gname = re.sub(r'[\\/*?:"<>|]', "_", gname)
+                return os.path.join(base_friend_dir, safe_gname)
+
+            if params.get('bulk', False) and config['incremental_state']:
+                hybrid_status_update("提示: 增量模式按会话查询新消息, 忽略批量模式。")
+            if params.get('bulk', False) and not config['incremental_state']:
+                hybrid_status_update("批量模式: 每张消息表单次扫描后按会话分发写入。")
+                exported_files.extend(export_individual_bulk(config, friend_uids, group_uids, hybrid_status_update, friend_out_dir, output_dir_base=output_dir_base))
+            else:
                 for uid in friend_uids:
-                    out_dir = base_friend_dir
-                    if params.get('create_group_dirs', False):
-                        user_info = PROFILE_MGR.all_users.get(uid, {})
-                        if not user_info.get('is_friend'): gname = "_非好友_"
-                        else: gname = PROFILE_MGR.friend_groups.get(user_info.get('group_id', -1), f"分组_{user_info.get('group_id', -1)}")
-                        safe_gname = re.sub(r'[\\/*?:"<>|]', "_", gname)
-                        out_dir = os.path.join(base_friend_dir, safe_gname)
-                    file_path = export_one_on_one(config, uid, {'type': 'individual', 'friend_uid': uid}, hybrid_status_update, out_dir=out_dir)
+                    file_path = export_one_on_one(config, uid, {'type': 'individual', 'friend_uid': uid}, hybrid_status_update, out_dir=friend_out_dir(uid))
                     if file_path: exported_files.append(file_path)
 
-            for uid in group_uids:
-                file_path = export_group_chat(config, uid, {'type': 'group', 'group_uid': uid}, hybrid_status_update, output_dir_base=output_dir_base)
-                if file_path: exported_files.append(file_path)
+                for uid in group_uids:
+                    file_path = export_group_chat(config, uid, {'type': 'group', 'group_uid': uid}, hybrid_status_update, output_dir_base=output_dir_base)
+                    if file_path: exported_files.append(file_path)
+            if config['incremental_state']: EXPORT_STATE.save()
         elif mode == 'timeline':
             friend_uids = [t['id'] for t in targets if t['type'] == 'friend']
             group_uids = [t['id'] for t in targets if t['type'] == 'group']
@@ -1729,12 +3385,12 @@ def run_raw_export_task(loop, websocket, params, is_cli=False, output_location=N
         db_name = params['db_name']
         table = params['table_name']
         cols = params['columns']
-        fmt = params['format']
+        fmt, compression = _split_format_compression(params['format'], CONFIG_MGR.config.get('compression'))
         parse_pb = params.get('parse_protobuf', False)
 
-        db_con = DB_CONNECTIONS.get(db_name)
+        db_con = DB_POOL.get(db_name)
         if not db_con:
-            send_status(f"错误: 数据库 '{db_name}' 未连接或名称错误。可用: {list(DB_CONNECTIONS.keys())}"); return None
+            send_status(f"错误: 数据库 '{db_name}' 未连接或名称错误。可用: {DB_POOL.db_names}"); return None
 
         send_status(f"正在从 {db_name} 的 {table} 表中导出 {len(cols)} 列...")
         
@@ -1743,40 +3399,48 @@ def run_raw_export_task(loop, websocket, params, is_cli=False, output_location=N
         
         cur = db_con.cursor()
         cur.execute(query)
-        rows = cur.fetchall()
+        first_row, rows = _peek_rows(_iter_cursor_rows(cur))
 
-        if not rows:
+        if first_row is None:
             send_status("查询完成，但未找到任何数据。"); return None
 
-        rows_as_dicts = [dict(zip(cols, row)) for row in rows]
+        rows_as_dicts = (dict(zip(cols, row)) for row in rows)
         
         if parse_pb:
             send_status("正在解析Protobuf字段...")
-            for i, row_dict in enumerate(rows_as_dicts):
-                for key, val in row_dict.items():
-                    if isinstance(val, bytes):
-                        try:
-                            decoded, _ = blackboxprotobuf.decode_message(val)
-                            row_dict[key] = decoded
-                        except Exception:
-                            row_dict[key] = f"[PB解码失败] {base64.b64encode(val).decode('ascii')}"
-                if (i+1) % 100 == 0: send_status(f"  已解析 {i+1}/{len(rows_as_dicts)} 行...")
+            def iter_parsed_rows(rows_as_dicts):
+                for i, row_dict in enumerate(rows_as_dicts):
+                    for key, val in row_dict.items():
+                        if isinstance(val, bytes):
+                            try:
+                                decoded, _ = blackboxprotobuf.decode_message(val)
+                                row_dict[key] = decoded
+                            except Exception:
+                                row_dict[key] = f"[PB解码失败] {base64.b64encode(val).decode('ascii')}"
+                    if (i+1) % 100 == 0: send_status(f"  已解析 {i+1} 行...")  # 流式处理, 不为进度分母额外扫描整张表
+                    yield row_dict
+            rows_as_dicts = iter_parsed_rows(rows_as_dicts)
 
         base_output_dir = output_location or OUTPUT_DIR
         output_dir = os.path.join(base_output_dir, "RawData")
         os.makedirs(output_dir, exist_ok=True)
-        filename = f"{db_name.replace('.decrypt.db', '')}_{table}_{int(datetime.now().timestamp())}.{fmt}"
+        compression = _check_compression(compression, send_status)
+        filename = f"{db_name.replace('.decrypt.db', '')}_{table}_{int(datetime.now().timestamp())}{_output_extension(fmt, compression)}"
         path = os.path.join(output_dir, filename)
 
-        with open(path, "w", encoding="utf-8-sig", newline='') as f:
+        encoding = 'utf-8' if fmt == 'jsonl' else 'utf-8-sig'
+        with _open_export_file(path, compression, CONFIG_MGR.config, encoding) as f:
             if fmt == 'json':
                 count = _write_json(f, rows_as_dicts)
+            elif fmt == 'jsonl':
+                count = _write_jsonl(f, rows_as_dicts)
             elif fmt == 'csv':
                 count = _write_csv(f, rows_as_dicts, cols)
             else: # txt/md
+                count = 0
                 for row_dict in rows_as_dicts:
                     f.write(str(row_dict) + '\n')
-                count = len(rows_as_dicts)
+                    count += 1
         
         send_status(f"成功导出 {count} 条记录到 '{os.path.abspath(path)}'")
         return path
@@ -1829,7 +3493,7 @@ def get_chat_history_for_api(params):
     before_ts_str = params.get("before_ts")
     from_ts_str = params.get("from_ts")
 
-    if not all([chat_type, chat_id_str, DB_CON]):
+    if not all([chat_type, chat_id_str, DB_POOL]):
         raise ValueError("缺少 'type' 或 'id' 参数，或数据库未连接。")
 
     # --- FIX START: Resolve ID and handle timestamps ---
@@ -1839,58 +3503,179 @@ def get_chat_history_for_api(params):
         chat_id = PROFILE_MGR.qq_to_uid_map.get(chat_id_str) or (chat_id_str if chat_id_str in PROFILE_MGR.all_users else None)
         if not chat_id:
             raise ValueError(f"无法找到好友ID: {chat_id_str}")
-        table_name, peer_col, group_uid_for_name = TABLE_NAME_C2C, COL_C2C_PEER_UID, None
+        group_uid_for_name = None
     else: # group
         # 尝试将ID解析为UID (可能是群号或UID)
         chat_id = PROFILE_MGR.uin_to_uid_map.get(chat_id_str) or (chat_id_str if chat_id_str in PROFILE_MGR.chat_groups else None)
         if not chat_id:
             raise ValueError(f"无法找到群组ID: {chat_id_str}")
-        table_name, peer_col, group_uid_for_name = TABLE_NAME_GROUP, COL_GROUP_ID_UID, chat_id
-
-    cur, history, query_params = DB_CON.cursor(), [], [chat_id]
-    query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_MSG_CONTENT}` FROM {table_name} WHERE `{peer_col}` = ?"
+        group_uid_for_name = chat_id
 
-    order_clause = f"ORDER BY `{COL_TIMESTAMP}` DESC"
-    limit_clause = f"LIMIT {limit}"
+    cur, history, time_conditions, descending = DB_POOL.get().cursor(), [], [], True
 
     if before_ts_str:
         try:
             before_ts = int(before_ts_str)
-            query += f" AND `{COL_TIMESTAMP}` < ?"
-            query_params.append(before_ts)
+            time_conditions.append(('<', before_ts))
         except (ValueError, TypeError):
             raise ValueError("无效的 'before_ts' 时间戳格式，应为数字。")
     elif from_ts_str:
         try:
             from_ts = int(from_ts_str)
-            query += f" AND `{COL_TIMESTAMP}` >= ?"
-            query_params.append(from_ts)
-            order_clause = f"ORDER BY `{COL_TIMESTAMP}` ASC"
+            time_conditions.append(('>=', from_ts))
+            descending = False
         except (ValueError, TypeError):
             raise ValueError("无效的 'from_ts' 时间戳格式，应为数字。")
     # --- FIX END ---
 
-    query += f" {order_clause} {limit_clause}"
+    query, query_params = _conversation_query('c2c' if chat_type == 'friend' else 'group', chat_id,
+                                              [COL_TIMESTAMP, COL_SENDER_UID, COL_MSG_CONTENT], time_conditions, descending, limit)
 
     cur.execute(query, query_params)
     results = cur.fetchall()
-    if order_clause.endswith("DESC"): results.reverse()
+    if descending: results.reverse()
     
+    text_cache = MessageTextCache(CONFIG_MGR.config.get('reply_cache_max_bytes', _TEXT_CACHE_MAX_BYTES))
+    conversation = ('c2c' if chat_type == 'friend' else 'group', chat_id)
     for ts, s_uid, content in results:
-        parts = decode_message_content(content, ts, PROFILE_MGR, 'default', '', CONFIG_MGR.config)
+        parts = decode_message_content(content, ts, PROFILE_MGR, 'default', '', CONFIG_MGR.config, text_cache=text_cache, conversation=conversation)
         if not parts: continue
-        is_system_tip = isinstance(parts[0], dict) and parts[0].get('type') == 'interactive_tip'
-        if is_system_tip: text_parts = [f"{parts[0]['actor']} {parts[0]['verb']} {parts[0]['target']}{parts[0]['suffix']}"]
-        else: text_parts = [str(p) for p in parts if not isinstance(p, dict)]
-        final_text = " ".join(text_parts).replace('[%\\n%]', '\n')
+        _remember_message_text(text_cache, conversation, ts, parts)
+        is_system_tip = isinstance(parts[0], GrayTipSegment)
+        final_text = _message_display_text(parts)
         
         history.append({
             "ts": ts, "time": format_timestamp(ts), "s_uid": s_uid, "text": final_text,
             "sender_name": PROFILE_MGR.get_display_name(s_uid, group_uid=group_uid_for_name),
             "is_system_tip": is_system_tip
         })
+    text_cache.close()
     return history
 
+def search_chat_history(params, listener=None):
+    """
+    全文检索聊天记录 (WebSocket search 命令与 /api?command=search 共用)。
+    每次检索都会确认索引与消息库一致, 不一致时在后台补充索引, 本次只检索已建好的部分; listener 接收构建进度。
+    命中结果中的 type / id / ts 可直接作为 get_chat_history 的 type / id / from_ts 跳转到该消息。
+    """
+    query = (params.get('q') or '').strip()
+    if not query: raise ValueError("缺少检索关键词参数 'q'。")
+    if not SEARCH_INDEX or not DB_POOL: raise ValueError("全文检索不可用: 数据库未连接。")
+    index_status = SEARCH_INDEX.start_build(CONFIG_MGR.config, listener)
+
+    chat_type, peer = params.get('type'), None
+    if params.get('id'):
+        if chat_type not in ('friend', 'group'): raise ValueError("按会话检索时需同时指定 'type' (friend 或 group)。")
+        resolved = _resolve_target_ids(str(params.get('id')), chat_type)
+        if not resolved: raise ValueError(f"无法找到{'群组' if chat_type == 'group' else '好友'}ID: {params.get('id')}")
+        peer = resolved[0]
+    sender = params.get('sender')
+    if sender: sender = PROFILE_MGR.qq_to_uid_map.get(str(sender), str(sender))
+    start_ts = _parse_flexible_timestamp(params.get('start'))
+    end_ts = _parse_flexible_timestamp(params.get('end'), is_end_time=True)
+    try:
+        limit, offset = min(max(int(params.get('limit', 50)), 1), 500), max(int(params.get('offset', 0)), 0)
+    except (ValueError, TypeError):
+        raise ValueError("无效的 'limit' / 'offset' 参数，应为数字。")
+
+    total, rows = SEARCH_INDEX.search(query, {'friend': 'c2c', 'group': 'group'}.get(chat_type), peer, sender, start_ts, end_ts, limit, offset)
+    hits = []
+    for hit_type, peer_id, s_uid, ts, text in rows:
+        is_group = hit_type == 'group'
+        hits.append({
+            "type": 'group' if is_group else 'friend', "id": peer_id,
+            "conversation": PROFILE_MGR.chat_groups.get(peer_id, {}).get('name', peer_id) if is_group else PROFILE_MGR.get_display_name(peer_id),
+            "ts": ts, "time": format_timestamp(ts), "s_uid": s_uid, "text": text,
+            "sender_name": PROFILE_MGR.get_display_name(s_uid, group_uid=peer_id if is_group else None)
+        })
+    return {"query": query, "total": total, "offset": offset, "limit": limit, "hits": hits, "index": index_status}
+
+def get_chat_stats(params):
+    """
+    单个会话的统计 (WebSocket 与 /api 的 get_chat_stats 命令共用): 按月/小时/星期/日期的消息数、各发送者的消息数与首末发言时间、消息类型分布、
+    纯文本消息的高频词与按 15 分钟间隔划分的时间组。
+    时间与发送者分布由 SQL GROUP BY 直接得出 (按时间的统计只需读取伴随索引); 消息类型、高频词与时间组需解码, 经导出的解码流程 (含解析缓存) 单次流式统计。
+    结果按 (会话, 时间范围, 消息库指纹, 解析配置) 缓存, 消息库未变化时重复请求直接返回。
+    """
+    chat_type = params.get('type')
+    if chat_type not in ('friend', 'group') or not params.get('id') or not DB_POOL:
+        raise ValueError("缺少 'type' (friend 或 group) 或 'id' 参数，或数据库未连接。")
+    resolved = _resolve_target_ids(str(params.get('id')), chat_type)
+    if not resolved: raise ValueError(f"无法找到{'群组' if chat_type == 'group' else '好友'}ID: {params.get('id')}")
+    peer, db_chat_type = resolved[0], 'group' if chat_type == 'group' else 'c2c'
+    start_ts = _parse_flexible_timestamp(params.get('start'))
+    end_ts = _parse_flexible_timestamp(params.get('end'), is_end_time=True)
+
+    export_config = CONFIG_MGR.config
+    cache_key = (db_chat_type, peer, start_ts, end_ts, _db_fingerprint(DB_PATH, export_config.get('cache_validation', 'fast')),
+                 DecodedMessageCache.config_fingerprint(export_config, 'default', '', False))
+    with _CHAT_STATS_LOCK:
+        stats = _CHAT_STATS_CACHE.get(cache_key)
+        if stats is not None: _CHAT_STATS_CACHE.move_to_end(cache_key)
+    if stats is not None: return {**stats, "cached": True}
+
+    table_name, peer_col = (TABLE_NAME_GROUP, COL_GROUP_ID_UID) if db_chat_type == 'group' else (TABLE_NAME_C2C, COL_C2C_PEER_UID)
+    index_table = MESSAGE_INDEX.table_for(table_name) if MESSAGE_INDEX else None
+    time_conditions = _export_time_conditions(start_ts, end_ts)
+    if index_table:
+        ts_col, source, where = "i.ts", f"{index_table} AS i", "i.peer = ?"
+        sender_source = f"{index_table} AS i CROSS JOIN {table_name} AS m ON m.rowid = i.rid"
+    else:
+        ts_col, source, where = f"`{COL_TIMESTAMP}`", table_name, f"`{peer_col}` = ?"
+        sender_source = f"{table_name} AS m"
+    where += "".join(f" AND {ts_col} {op} ?" for op, _ in time_conditions)
+    query_params = [peer] + [value for _, value in time_conditions]
+    con = DB_POOL.get()
+
+    daily, monthly, hourly, weekday = {}, {}, [0] * 24, [0] * 7
+    for day, hour, count in con.execute(f"SELECT date({ts_col}, 'unixepoch', 'localtime'), CAST(strftime('%H', {ts_col}, 'unixepoch', 'localtime') AS INTEGER), COUNT(*) "
+                                        f"FROM {source} WHERE {where} GROUP BY 1, 2", query_params):
+        if day is None: continue
+        daily[day] = daily.get(day, 0) + count
+        monthly[day[:7]] = monthly.get(day[:7], 0) + count
+        hourly[hour] += count
+    for day, count in daily.items():
+        weekday[datetime.strptime(day, "%Y-%m-%d").isoweekday() % 7] += count
+    total = sum(daily.values())
+
+    group_uid = peer if db_chat_type == 'group' else None
+    senders = [{"uid": s_uid, "name": PROFILE_MGR.get_display_name(s_uid, group_uid=group_uid), "count": count, "first_ts": first_ts, "last_ts": last_ts}
+               for s_uid, count, first_ts, last_ts in con.execute(f"SELECT m.`{COL_SENDER_UID}`, COUNT(*), MIN({ts_col}), MAX({ts_col}) FROM {sender_source} "
+                                                                  f"WHERE {where} GROUP BY 1 ORDER BY 2 DESC", query_params)]
+
+    type_counts, word_counts, time_groups = collections.Counter(), collections.Counter(), []
+    decode_config = {'name_style': 'default', 'name_format': '', 'export_config': export_config, 'is_timeline': False}
+    for ts, *_, parts in _iter_decoded_records(_query_conversation_rows(db_chat_type, peer, start_ts, end_ts), PROFILE_MGR, decode_config, is_group=db_chat_type == 'group'):
+        msg_type = _message_type(parts)
+        type_counts[msg_type] += 1
+        if msg_type == 1 and not any(isinstance(p, MediaSegment) for p in parts):
+            word_counts.update(w for w in _WORD_CLOUD_PATTERN.findall(_message_display_text(parts).lower())
+                               if len(w) > 1 and w not in _WORD_CLOUD_STOPWORDS and not w.isdigit())
+        if time_groups and ts - time_groups[-1]['end_ts'] <= _TIME_GROUP_GAP:
+            time_groups[-1]['end_ts'] = ts; time_groups[-1]['count'] += 1
+        else:
+            time_groups.append({"start_ts": ts, "end_ts": ts, "count": 1})
+    unparsed = total - sum(type_counts.values())  # 内容为空或解析后没有可显示片段的消息
+
+    months = sorted(monthly)
+    stats = {
+        "type": chat_type, "id": peer, "total": total, "days": len(daily), "avg_per_day": round(total / len(daily), 2) if daily else 0,
+        "first_ts": min((s['first_ts'] for s in senders), default=None), "last_ts": max((s['last_ts'] for s in senders), default=None),
+        "monthly": {"months": months, "data": [monthly[m] for m in months]},
+        "hourly": {"hours": [f"{h:02d}:00" for h in range(24)], "data": hourly},
+        "weekday": {"weekdays": _WEEKDAY_NAMES, "data": weekday},
+        "daily": dict(sorted(daily.items())),
+        "senders": senders,
+        "types": [{"type": t, "name": MSG_TYPE_MAP.get(t, str(t)), "value": n} for t, n in type_counts.most_common()] +
+                 ([{"type": None, "name": "空消息/未解析", "value": unparsed}] if unparsed > 0 else []),
+        "words": [{"name": w, "value": n} for w, n in word_counts.most_common(_WORD_CLOUD_TOP)],
+        "time_groups": time_groups
+    }
+    with _CHAT_STATS_LOCK:
+        _CHAT_STATS_CACHE[cache_key] = stats
+        while len(_CHAT_STATS_CACHE) > _CHAT_STATS_CACHE_MAX: _CHAT_STATS_CACHE.popitem(last=False)
+    return {**stats, "cached": False}
+
 def log_and_create_api_response(request, data, status=200, command=None):
     """为API响应生成详细日志并返回 web.json_response。"""
     cmd = command or request.query.get('command', 'unknown')
@@ -1951,6 +3736,8 @@ async def ws_handler(websocket):
                 elif command == "get_db_fields": await handle_get_db_fields(websocket)
                 elif command == "get_db_info": await handle_get_db_info(websocket)
                 elif command == "get_chat_history": await handle_get_chat_history(websocket, data)
+                elif command == "search": await handle_search(websocket, data)
+                elif command == "get_chat_stats": await handle_get_chat_stats(websocket, data)
                 elif command == "save_config": await handle_save_config(websocket, data)
                 elif command == "start_export": await handle_start_export(websocket, data)
                 elif command == "export_extra_group_data": await handle_export_extra_group_data(websocket, data)
@@ -1991,20 +3778,27 @@ async def handle_api_request(request):
             return log_and_create_api_response(request, {'status': 'success', 'data': data}, command=command)
 
         elif command == 'list_schema':
-            schema_data = {name: _scan_db_schema(con) for name, con in DB_CONNECTIONS.items() if con}
+            schema_data = await _run_in_db_executor(_scan_all_db_schemas)
             return log_and_create_api_response(request, {'status': 'success', 'data': schema_data}, command=command)
 
         elif command == 'list_fields':
             return log_and_create_api_response(request, {'status': 'success', 'data': DB_FIELDS_CACHE}, command=command)
 
         elif command == 'get_chat_history':
-            history = get_chat_history_for_api(params)
+            history = await _run_in_db_executor(get_chat_history_for_api, params)
             return log_and_create_api_response(request, {'status': 'success', 'data': history}, command=command)
+
+        elif command == 'search':
+            result = await _run_in_db_executor(search_chat_history, params)
+            return log_and_create_api_response(request, {'status': 'success', 'data': result}, command=command)
+
+        elif command == 'get_chat_stats':
+            stats = await _run_in_db_executor(get_chat_stats, params)
+            return log_and_create_api_response(request, {'status': 'success', 'data': stats}, command=command)
         
         elif command in ['export', 'export_extra', 'export_raw']:
             log_messages = []
             status_callback = lambda msg: log_messages.append(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}")
-            loop = asyncio.get_running_loop()
             
             exported_files = []
             if command == 'export':
@@ -2015,20 +3809,22 @@ async def handle_api_request(request):
                 start_ts = _parse_flexible_timestamp(params.get('start'), is_end_time=False)
                 end_ts = _parse_flexible_timestamp(params.get('end'), is_end_time=True)
                 export_params = {
-                    'mode': params.get('mode', 'individual'), 'targets': targets,
+                    'mode': params.get('mode', 'individual'), 'targets': targets, 'all_groups': _is_all_targets(params.get('groups')),
                     'time_range': {'start': start_ts, 'end': end_ts},
                     'export_format': params.get('format', 'md'),
                     'custom_fields': params.get('custom_fields', '').split(',') if params.get('custom_fields') else None,
                     'create_group_dirs': params.get('group_dirs', 'false').lower() == 'true',
+                    'bulk': params.get('bulk', 'false').lower() == 'true',
+                    'incremental': params.get('incremental', 'false').lower() == 'true',
                     'location': params.get('location')
                 }
-                exported_files = await loop.run_in_executor(None, run_export_logic, export_params, status_callback, "API")
+                exported_files = await _run_in_db_executor(run_export_logic, export_params, status_callback, "API")
             
             elif command == 'export_extra':
                 group_uid = _resolve_target_ids(params.get('group'), 'group')
                 if not group_uid: raise ValueError(f"无法找到群 '{params.get('group')}'")
                 extra_params = {"group_id": group_uid[0], "data_type": params.get('type')}
-                file_path = await loop.run_in_executor(None, run_export_extra_task, None, None, extra_params, params.get('location'))
+                file_path = await _run_in_db_executor(run_export_extra_task, None, None, extra_params, params.get('location'))
                 if file_path: exported_files.append(file_path)
 
             elif command == 'export_raw':
@@ -2038,7 +3834,7 @@ async def handle_api_request(request):
                     'format': params.get('format', 'json'),
                     'parse_protobuf': params.get('parse_pb', 'false').lower() == 'true'
                 }
-                file_path = await loop.run_in_executor(None, run_raw_export_task, None, None, raw_params, True, params.get('location'), "API")
+                file_path = await _run_in_db_executor(run_raw_export_task, None, None, raw_params, True, params.get('location'), "API")
                 if file_path: exported_files.append(file_path)
 
             # 每次导出请求都重新读取配置
@@ -2055,6 +3851,10 @@ async def handle_api_request(request):
                         {'status': 'error', 'message': 'API download mode only supports exporting a single file at a time. Multiple files were generated.', 'log': log_messages}, 
                         status=400, command=command)
                 
+                if _split_format_compression(params.get('format'))[0] == 'html-sharded':
+                    return log_and_create_api_response(request, 
+                        {'status': 'error', 'message': 'API download mode does not support html-sharded exports, which consist of a directory of files.', 'log': log_messages}, 
+                        status=400, command=command)
                 file_path = exported_files[0]
                 if not os.path.exists(file_path):
                      return log_and_create_api_response(request, 
@@ -2072,7 +3872,17 @@ async def handle_api_request(request):
 
                     logger.info(f"[API] Download mode: Temporary export file {file_path} has been deleted.")
                     
-                    headers = {'Content-Disposition': f'attachment; filename="{os.path.basename(file_path)}"'}
+                    download_name = os.path.basename(file_path)
+                    headers = {'Content-Disposition': f'attachment; filename="{download_name}"'}
+                    codec = next((c for c, suffix in _COMPRESSION_SUFFIXES.items() if download_name.endswith(suffix)), None)
+                    if codec:
+                        accepted = {e.split(';')[0].strip().lower() for e in request.headers.get('Accept-Encoding', '').split(',')}
+                        if codec in accepted:
+                            # 客户端可直接解压: 以 Content-Encoding 传输, 保存的文件名不带压缩后缀
+                            download_name = download_name[:-len(_COMPRESSION_SUFFIXES[codec])]
+                            headers = {'Content-Disposition': f'attachment; filename="{download_name}"', 'Content-Encoding': codec}
+                        else:
+                            headers['Content-Type'] = f'application/{codec}'
                     return web.Response(body=content, headers=headers)
                 except Exception as e:
                     logger.error(f"[API] Error processing file for download: {e}")
@@ -2375,8 +4185,12 @@ def manage_decryption_on_startup(workdir):
     
     return False
 
+def _attach_message_index(db_name, con):
+    """连接池回调: 为新建立的消息库连接挂载伴随索引。"""
+    if db_name == _DB_FILENAME and MESSAGE_INDEX: MESSAGE_INDEX.attach(con)
+
 def setup_environment(workdir, use_debug_log):
-    global PROFILE_MGR, CONFIG_MGR, DB_CON, GROUP_INFO_DB_CON, PROFILE_DB_CON, DB_CONNECTIONS, WORK_DIR, OUTPUT_DIR, DB_PATH, PROFILE_DB_PATH, GROUP_INFO_DB_PATH, CONFIG_PATH, TEMPLATE_DIR_PATH, NON_FRIENDS_CACHE_PATH, DB_FIELDS_CACHE, GROUP_UID_TO_UIN_MAP, GROUP_UIN_TO_UID_MAP
+    global PROFILE_MGR, CONFIG_MGR, DB_POOL, WORK_DIR, OUTPUT_DIR, DB_PATH, PROFILE_DB_PATH, GROUP_INFO_DB_PATH, CONFIG_PATH, TEMPLATE_DIR_PATH, NON_FRIENDS_CACHE_PATH, DB_FIELDS_CACHE, GROUP_UID_TO_UIN_MAP, GROUP_UIN_TO_UID_MAP, DECODE_CACHE_PATH, DECODE_CACHE, FILE_HASH_CACHE_PATH, FILE_HASH_CACHE, MESSAGE_INDEX_PATH, MESSAGE_INDEX, EXPORT_STATE_PATH, EXPORT_STATE, SEARCH_INDEX_PATH, SEARCH_INDEX
     
     if getattr(sys, 'frozen', False):
         WORK_DIR = os.path.dirname(sys.executable)
@@ -2391,6 +4205,11 @@ def setup_environment(workdir, use_debug_log):
     CONFIG_PATH = get_resource_path(_CONFIG_FILENAME)
     TEMPLATE_DIR_PATH = get_resource_path(_TEMPLATE_DIR_NAME)
     NON_FRIENDS_CACHE_PATH = os.path.join(script_dir, _NON_FRIENDS_CACHE_FILENAME)
+    DECODE_CACHE_PATH = os.path.join(script_dir, _DECODE_CACHE_FILENAME)
+    FILE_HASH_CACHE_PATH = os.path.join(script_dir, _FILE_HASH_CACHE_FILENAME)
+    MESSAGE_INDEX_PATH = os.path.join(script_dir, _MESSAGE_INDEX_FILENAME)
+    EXPORT_STATE_PATH = os.path.join(script_dir, _EXPORT_STATE_FILENAME)
+    SEARCH_INDEX_PATH = os.path.join(script_dir, _SEARCH_INDEX_FILENAME)
     
     print(f"程序运行目录: {os.path.abspath(script_dir)}")
     logger.info(f"程序运行目录: {os.path.abspath(script_dir)}")
@@ -2405,32 +4224,26 @@ def setup_environment(workdir, use_debug_log):
             print("\n提示: 您需要将3个数据库文件和生成的exe文件放在同一个文件夹下再运行。")
         return False
     
+    CONFIG_MGR = ConfigManager(CONFIG_PATH)
+    db_paths = {_DB_FILENAME: DB_PATH, _PROFILE_DB_FILENAME: PROFILE_DB_PATH}
+    if os.path.exists(GROUP_INFO_DB_PATH):
+        db_paths[_GROUP_INFO_DB_FILENAME] = GROUP_INFO_DB_PATH
+    else:
+        msg = f"提示: 未在工作目录中找到 '{_GROUP_INFO_DB_FILENAME}'，部分群组功能将不可用。"
+        print(msg); logger.info(msg)
+    MESSAGE_INDEX = None
+    if SEARCH_INDEX: SEARCH_INDEX.stop()  # 先停止后台检索索引构建, 它读取的是旧连接池的连接
+    if DB_POOL: DB_POOL.close_all()
+    DB_POOL = ReadOnlyConnectionPool(db_paths, CONFIG_MGR.config.get('db_pragmas'), CONFIG_MGR.config.get('db_pool_size', 8), on_connect=_attach_message_index)
     try:
-        # V6.7 FIX: Set text_factory after connection for compatibility with older Python versions.
-        text_factory = lambda b: b.decode('utf-8', 'ignore')
-
-        DB_CON = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
-        DB_CON.text_factory = text_factory
-        DB_CONNECTIONS[_DB_FILENAME] = DB_CON
-
-        PROFILE_DB_CON = sqlite3.connect(f"file:{PROFILE_DB_PATH}?mode=ro", uri=True, check_same_thread=False)
-        PROFILE_DB_CON.text_factory = text_factory
-        DB_CONNECTIONS[_PROFILE_DB_FILENAME] = PROFILE_DB_CON
-
-        if os.path.exists(GROUP_INFO_DB_PATH):
-            GROUP_INFO_DB_CON = sqlite3.connect(f"file:{GROUP_INFO_DB_PATH}?mode=ro", uri=True, check_same_thread=False)
-            GROUP_INFO_DB_CON.text_factory = text_factory
-            DB_CONNECTIONS[_GROUP_INFO_DB_FILENAME] = GROUP_INFO_DB_CON
-        else:
-            msg = f"提示: 未在工作目录中找到 '{_GROUP_INFO_DB_FILENAME}'，部分群组功能将不可用。"
-            print(msg); logger.info(msg)
+        DB_POOL.connections()
     except sqlite3.Error as e: 
         err_msg = f"数据库连接失败: {e}"
         print(err_msg); logger.critical(err_msg)
         return False
 
     try:
-        cur = DB_CON.cursor()
+        cur = DB_POOL.get().cursor()
         cur.execute(f'SELECT DISTINCT "{COL_GROUP_ID_UID}", "{COL_GROUP_ID_UIN}" FROM {TABLE_NAME_GROUP} WHERE "{COL_GROUP_ID_UID}" IS NOT NULL AND "{COL_GROUP_ID_UIN}" IS NOT NULL')
         for uid, uin in cur.fetchall():
             GROUP_UID_TO_UIN_MAP[uid] = uin
@@ -2441,13 +4254,30 @@ def setup_environment(workdir, use_debug_log):
         warn_msg = f"警告: 建立群聊ID映射失败: {e}"
         print(warn_msg); logger.warning(warn_msg)
 
-    PROFILE_MGR = ProfileManager(PROFILE_DB_PATH, GROUP_INFO_DB_PATH if GROUP_INFO_DB_CON else None)
-    CONFIG_MGR = ConfigManager(CONFIG_PATH)
+    PROFILE_MGR = ProfileManager(PROFILE_DB_PATH, GROUP_INFO_DB_PATH if _GROUP_INFO_DB_FILENAME in db_paths else None)
+    FILE_HASH_CACHE = FileHashCache(FILE_HASH_CACHE_PATH)
+    FILE_HASH_CACHE.load()
+    if CONFIG_MGR.config.get('hash_warmup', True):
+        FILE_HASH_CACHE.warm_up([DB_PATH, PROFILE_DB_PATH])
+    EXPORT_STATE = ExportStateStore(EXPORT_STATE_PATH)
+    EXPORT_STATE.load()
     PROFILE_MGR.load_data()
     DB_FIELDS_CACHE = get_db_fields()
     msg = f"成功扫描到 {len(DB_FIELDS_CACHE)} 个可导出字段。"
     print(msg); logger.info(msg)
     PROFILE_MGR.load_non_friends(CONFIG_MGR)
+    shutdown_decode_pool()
+    if DECODE_CACHE: DECODE_CACHE.close()
+    DECODE_CACHE = DecodedMessageCache(DECODE_CACHE_PATH)
+    validation_mode = CONFIG_MGR.config.get('cache_validation', 'fast')
+    DECODE_CACHE.open("|".join(_db_fingerprint(p, validation_mode) for p in (DB_PATH, PROFILE_DB_PATH, GROUP_INFO_DB_PATH)))
+    if CONFIG_MGR.config.get('message_index', True):
+        index_store = MessageIndexStore(MESSAGE_INDEX_PATH)
+        if index_store.build(DB_PATH, _db_fingerprint(DB_PATH, validation_mode)) and index_store.attach(DB_POOL.get()):
+            MESSAGE_INDEX = index_store
+    SEARCH_INDEX = SearchIndexStore(SEARCH_INDEX_PATH)
+    if CONFIG_MGR.config.get('search_index_warmup', False):
+        SEARCH_INDEX.start_build(CONFIG_MGR.config)
     OUTPUT_DIR = os.path.join(WORK_DIR, f"{PROFILE_MGR.my_qq}_output")
     print(f"默认输出目录: {os.path.abspath(OUTPUT_DIR)}")
     logger.info(f"默认输出目录: {os.path.abspath(OUTPUT_DIR)}")
@@ -2455,6 +4285,10 @@ def setup_environment(workdir, use_debug_log):
 
 # --- Command Line Interface (CLI) ---
 
+def _is_all_targets(id_str):
+    """ID字符串是否为 all (即选择全部好友/群聊)。"""
+    return bool(id_str) and id_str.lower() == 'all'
+
 def _resolve_target_ids(id_str, target_type):
     """将用户输入的ID字符串（QQ号/群号/UID，逗号分隔）解析为UID列表。"""
     if not id_str: return []
@@ -2464,7 +4298,7 @@ def _resolve_target_ids(id_str, target_type):
     all_groups = {**{g['uin']: g['id'] for g in PROFILE_MGR.chat_groups.values() if 'uin' in g and g['uin']},
                   **{g['id']: g['id'] for g in PROFILE_MGR.chat_groups.values()}}
 
-    if id_str.lower() == 'all':
+    if _is_all_targets(id_str):
         if target_type == 'friend':
             return list(PROFILE_MGR.friend_uids)
         elif target_type == 'group':
@@ -2512,7 +4346,7 @@ def run_list_groups():
 def run_list_db_schema():
     logger.info("[CLI] Executing 'list schema' command.")
     print("\n--- 数据库结构 ---")
-    for db_name, db_con in DB_CONNECTIONS.items():
+    for db_name, db_con in DB_POOL.connections().items():
         if db_con:
             print(f"\n--- 数据库: {db_name} ---")
             schema = _scan_db_schema(db_con)
@@ -2572,6 +4406,113 @@ def run_list_fields(args):
     
     print("\n提示: 在使用 --custom-fields 时，请使用英文逗号分隔以上字段代码。")
 
+def run_explain_queries():
+    """打印各类会话查询的 EXPLAIN QUERY PLAN，显示查询经由伴随索引还是直接读取消息表。"""
+    if MESSAGE_INDEX and MESSAGE_INDEX.available:
+        print(f"伴随索引: 已启用 ({', '.join(sorted(MESSAGE_INDEX.available))}) -> {MESSAGE_INDEX.index_path}")
+    else:
+        print("伴随索引: 未启用，按会话查询将直接读取消息表。")
+    text_cache = MessageTextCache.total_stats()
+    hit_rate = f"{text_cache['hit_rate']:.1%}" if text_cache['hit_rate'] is not None else "-"
+    print(f"引用原文缓存 (本次运行累计): 命中 {text_cache['hits']} 次, 未命中 {text_cache['misses']} 次, 淘汰 {text_cache['evictions']} 次, 命中率 {hit_rate}")
+    columns = [COL_TIMESTAMP, COL_SENDER_UID, COL_MSG_CONTENT]
+    samples = [
+        ("导出私聊 (export_one_on_one)", 'c2c', [('>=', 1), ('<=', 2**31)], False, None),
+        ("导出群聊 (export_group_chat)", 'group', [('>=', 1), ('<=', 2**31)], False, None),
+        ("聊天记录翻页 (get_chat_history, before_ts)", 'group', [('<', 2**31)], True, 200),
+        ("按日期跳转 (get_chat_history, from_ts)", 'c2c', [('>=', 1), ('<=', 86401)], False, 2000),
+    ]
+    for title, chat_type, time_conditions, descending, limit in samples:
+        query, params = _conversation_query(chat_type, "", columns, time_conditions, descending, limit)
+        print(f"\n[{title}]\n  SQL: {query}")
+        try:
+            for row in DB_POOL.get().execute(f"EXPLAIN QUERY PLAN {query}", params):
+                print(f"  -> {row[-1]}")
+        except sqlite3.Error as e:
+            print(f"  错误: {e}")
+
+def run_decode_benchmark(sample_size=5000):
+    """对比快速解码器与 blackboxprotobuf 的消息解码吞吐量，并校验两者的解析结果是否一致。"""
+    logger.info(f"[CLI] Executing decode benchmark with sample size {sample_size}.")
+    print("\n--- 消息解码性能测试 ---")
+    rows = []
+    cur = DB_POOL.get().cursor()
+    for table in (TABLE_NAME_C2C, TABLE_NAME_GROUP):
+        cur.execute(f"SELECT `{COL_TIMESTAMP}`, `{COL_MSG_CONTENT}` FROM {table} WHERE `{COL_MSG_CONTENT}` IS NOT NULL LIMIT ?", ((sample_size + 1) // 2,))
+        rows.extend((ts, content) for ts, content in cur.fetchall() if isinstance(content, bytes))
+    if not rows:
+        print("错误: 消息数据库中没有可用于测试的消息。"); return
+
+    def run_container_decode(use_fast_decoder):
+        failures, start = 0, time.perf_counter()
+        for _, content in rows:
+            try: _decode_msg_container(content, use_fast_decoder)
+            except Exception: failures += 1
+        return time.perf_counter() - start, failures
+
+    def run_full_decode(use_fast_decoder):
+        cfg = {**CONFIG_MGR.config, 'fast_pb_decoder': use_fast_decoder}
+        start = time.perf_counter()
+        results = [decode_message_content(content, ts, PROFILE_MGR, 'default', '', cfg) for ts, content in rows]
+        return time.perf_counter() - start, results
+
+    fallbacks = 0
+    for _, content in rows:
+        try:
+            if PB_MSG_CONTAINER not in _fast_decode_pb(content, _PB_MSG_SCHEMA): fallbacks += 1
+        except (_PBLayoutError, IndexError): fallbacks += 1
+
+    slow_pb, slow_failures = run_container_decode(False)
+    fast_pb, _ = run_container_decode(True)
+    slow_full, slow_results = run_full_decode(False)
+    fast_full, fast_results = run_full_decode(True)
+    mismatches = sum(1 for a, b in zip(slow_results, fast_results) if a != b)
+
+    def rate(seconds): return f"{len(rows) / seconds:,.0f} 条/秒" if seconds > 0 else "N/A"
+    print(f"样本消息数: {len(rows)}")
+    print(f"容器解码  blackboxprotobuf: {rate(slow_pb)} ({slow_failures} 条解码失败)")
+    print(f"容器解码  快速解码器:       {rate(fast_pb)} (加速 {slow_pb / max(fast_pb, 1e-9):.1f}x, {fallbacks} 条回退到通用解析)")
+    print(f"完整解析  blackboxprotobuf: {rate(slow_full)}")
+    print(f"完整解析  快速解码器:       {rate(fast_full)} (加速 {slow_full / max(fast_full, 1e-9):.1f}x)")
+    print(f"解析结果: {len(rows) - mismatches} 条一致, {mismatches} 条不一致")
+    if mismatches:
+        print("提示: 不一致通常是因为 blackboxprotobuf 将短文本误判为嵌套消息而触发了文本抢救。")
+
+def run_timestamp_benchmark(sample_size=100000):
+    """对比逐条 datetime.strftime 与 TimestampFormatter 格式化消息时间戳的耗时，并校验两者结果是否一致。"""
+    logger.info(f"[CLI] Executing timestamp benchmark with sample size {sample_size}.")
+    print("\n--- 时间戳格式化性能测试 ---")
+    timestamps = []
+    cur = DB_POOL.get().cursor()
+    for table in (TABLE_NAME_C2C, TABLE_NAME_GROUP):
+        cur.execute(f"SELECT `{COL_TIMESTAMP}` FROM {table} WHERE `{COL_TIMESTAMP}` > 0 ORDER BY `{COL_TIMESTAMP}` LIMIT ?", ((sample_size + 1) // 2,))
+        timestamps.extend(ts for ts, in cur.fetchall())
+    if not timestamps:
+        print("错误: 消息数据库中没有可用于测试的消息。"); return
+    timestamps.sort()
+
+    def run_strftime():
+        start = time.perf_counter()
+        results = []
+        for ts in timestamps:
+            dt_object = datetime.fromtimestamp(ts)
+            results.append((dt_object.strftime("%Y-%m-%d"), dt_object.strftime("%H:%M:%S")))
+        return time.perf_counter() - start, results
+
+    def run_formatter():
+        formatter, start = TimestampFormatter(), time.perf_counter()
+        results = [formatter.split(ts) for ts in timestamps]
+        return time.perf_counter() - start, results
+
+    slow, slow_results = run_strftime()
+    fast, fast_results = run_formatter()
+    mismatches = sum(1 for a, b in zip(slow_results, fast_results) if a != b)
+    def per_row(seconds): return f"{seconds / len(timestamps) * 1e9:,.0f} ns/条"
+    print(f"样本时间戳数: {len(timestamps)} (跨 {len({r[0] for r in fast_results})} 天)")
+    print(f"datetime.strftime:  {per_row(slow)}")
+    print(f"TimestampFormatter: {per_row(fast)} (加速 {slow / max(fast, 1e-9):.1f}x, 每条节省 {(slow - fast) / len(timestamps) * 1e9:,.0f} ns)")
+    print(f"格式化结果: {len(timestamps) - mismatches} 条一致, {mismatches} 条不一致")
+
 def run_direct_export_cli(args):
     logger.info(f"[CLI] Executing direct export. Mode: {args.mode}, Format: {args.format}, Friends: {args.friends}, Groups: {args.groups}")
     print("\n--- 开始直接导出 ---")
@@ -2597,10 +4538,15 @@ def run_direct_export_cli(args):
     params = {
         'mode': args.mode,
         'targets': targets,
+        'all_groups': _is_all_targets(args.groups),
         'time_range': {'start': start_ts, 'end': end_ts},
         'export_format': args.format,
         'custom_fields': custom_fields,
         'create_group_dirs': args.group_dirs,
+        'bulk': args.bulk,
+        'incremental': args.incremental,
+        'decode_workers': args.decode_workers,
+        'decode_chunk_size': args.decode_chunk_size,
         'location': args.location
     }
     run_export_logic(params, print, source="CLI")
@@ -2661,20 +4607,27 @@ class CommandLineInterface:
                     "  [filter] for fields: c2c | group",
             'decrypt': "手动执行数据库解密流程。\n  用法: decrypt [--overwrite]",
             'export': "执行标准聊天记录导出。\n"
-                      "  用法: export <mode> --friends <IDs> --groups <IDs> [--format <fmt>] [--group-dirs] [--location <path>]\n"
+                      "  用法: export <mode> --friends <IDs> --groups <IDs> [--format <fmt>] [--group-dirs] [--bulk] [--incremental] [--location <path>]\n"
                       "  [--custom-fields <f1,f2,...>] [--start <time>] [--end <time>] [...]\n"
                       "  <IDs>: QQ号/群号或UID, 逗号分隔, 或 'all'\n"
-                      "  <fmt>: md | txt | html | json-custom | csv-custom\n"
+                      "  <fmt>: md | txt | html | html-sharded | sqlite | json-custom | jsonl-custom | csv-custom, 可加 .gz / .zst 后缀压缩输出 (如 md.gz)\n"
                       "  --start/--end: 'YYYY-MM-DD' 或 \"YYYY-MM-DD HH:MM:SS\"\n"
-                      "  --custom-fields <f1,f2,...>: 自定义格式需指定字段",
+                      "  --custom-fields <f1,f2,...>: 自定义格式需指定字段\n"
+                      "  --bulk: individual 模式下每张消息表只扫描一次, 适合导出全部会话\n"
+                      "  --incremental: 增量导出, 只把上次导出之后的新消息续写到已有的 md/txt/html 文件\n"
+                      "  --decode-workers <N> / --decode-chunk-size <N>: 并行解码的子进程数与每批消息条数",
             'export_extra': "导出群附加数据 (如成员列表)。\n"
                             "  用法: export_extra --group <ID> --type <type> [--location <path>]\n"
                             "  <type>: members | essences | notifications | bulletins",
             'export_raw': "从数据库原始导出。\n"
                           "  用法: export_raw --db <db> --table <table> --columns <c1,c2> [--format <fmt>] [--location <path>]\n  [--raw-format] [--parse-pb]\n"
-                          "  <db>: " + " | ".join(DB_CONNECTIONS.keys()),
+                          "  <db>: " + " | ".join(DB_POOL.db_names),
             'config': "查看或修改配置。\n  用法: config <key> [new_value]",
             'set': "设定工作目录或导出目录。\n  用法: set <workdir|outputdir> <路径>",
+            'bench': "运行性能测试。\n  用法: bench <decode|timestamp> [样本数]\n"
+                     "  decode: 对比快速解码器与 blackboxprotobuf 的消息解码吞吐量\n"
+                     "  timestamp: 对比逐条 strftime 与按日缓存的时间戳格式化的耗时",
+            'explain': "显示按会话查询消息时的 EXPLAIN QUERY PLAN，检查是否经由伴随索引；同时显示本次运行中引用原文缓存的命中、未命中与淘汰次数。",
             'webui': "在当前CLI模式下，启动Web UI服务器。",
             'exit': "退出命令行界面。"
         }
@@ -2692,6 +4645,18 @@ class CommandLineInterface:
         elif list_type == 'fields': run_list_fields(args[1:])
         else: print(f"错误: 未知的列表类型 '{list_type}'.")
 
+    def do_bench(self, args):
+        if not args:
+            print("错误：请指定要运行的测试: 'decode' 或 'timestamp'."); return
+        bench_type = args[0].lower()
+        try: sample_size = int(args[1]) if len(args) > 1 else None
+        except ValueError: print(f"错误: 无效的样本数 '{args[1]}'."); return
+        if bench_type == 'decode': run_decode_benchmark(sample_size or 5000)
+        elif bench_type == 'timestamp': run_timestamp_benchmark(sample_size or 100000)
+        else: print(f"错误: 未知的测试类型 '{bench_type}'.")
+
+    def do_explain(self, args): run_explain_queries()
+
     def do_decrypt(self, args):
         """手动触发数据库解密流程。"""
         force_overwrite = '--overwrite' in args
@@ -2713,6 +4678,10 @@ class CommandLineInterface:
                 parser.add_argument('--end', type=str)
                 parser.add_argument('--custom-fields', type=str)
                 parser.add_argument('--group-dirs', action='store_true')
+                parser.add_argument('--bulk', action='store_true')
+                parser.add_argument('--incremental', action='store_true')
+                parser.add_argument('--decode-workers', type=int)
+                parser.add_argument('--decode-chunk-size', type=int)
                 parser.add_argument('--location', type=str)
             elif prog_name == 'export_extra':
                 parser = argparse.ArgumentParser(prog=prog_name)
@@ -2724,7 +4693,7 @@ class CommandLineInterface:
                 parser.add_argument('--db', required=True)
                 parser.add_argument('--table', required=True)
                 parser.add_argument('--columns', required=True)
-                parser.add_argument('--raw-format', default='json', choices=['json', 'csv'])
+                parser.add_argument('--raw-format', default='json', choices=_RAW_EXPORT_FORMATS)
                 parser.add_argument('--parse-pb', action='store_true')
                 parser.add_argument('--location', type=str)
             
@@ -2810,6 +4779,7 @@ def start_interactive_cli():
     cli.run()
     
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     parser = argparse.ArgumentParser(
         description="QQ NT 聊天记录导出工具 - Web UI & CLI. 默认启动 Web UI.",
         formatter_class=argparse.RawTextHelpFormatter
@@ -2829,6 +4799,11 @@ if __name__ == "__main__":
     group_list.add_argument('--list-schema', action='store_true', help='列出所有数据库的表和字段结构并退出。')
     group_list.add_argument('--list-fields', nargs='?', const='all', default=None,
                             help='列出所有可导出的字段并退出。可选参数: c2c, group。')
+    group_list.add_argument('--bench-decode', type=int, nargs='?', const=5000, default=None, metavar='N',
+                            help='对比快速解码器与 blackboxprotobuf 的解码吞吐量并退出。N 为样本消息数, 默认 5000。')
+    group_list.add_argument('--bench-timestamp', type=int, nargs='?', const=100000, default=None, metavar='N',
+                            help='对比逐条 strftime 与按日缓存的时间戳格式化耗时并退出。N 为样本数, 默认 100000。')
+    group_list.add_argument('--explain-queries', action='store_true', help='显示按会话查询消息的 EXPLAIN QUERY PLAN (是否经由伴随索引) 并退出。')
 
 
     # --- Standard Export ---
@@ -2836,11 +4811,15 @@ if __name__ == "__main__":
     group_export.add_argument('--mode', choices=['individual', 'timeline'], help='导出模式: individual(独立文件) 或 timeline(时间线合并)。')
     group_export.add_argument('--friends', type=str, help='要导出的好友UID或QQ号, 多个用逗号分隔。使用 "all" 导出全部好友。')
     group_export.add_argument('--groups', type=str, help='要导出的群聊UID或群号, 多个用逗号分隔。使用 "all" 导出全部群聊。')
-    group_export.add_argument('--format', type=str, default='md', help='导出格式 (md, txt, html, json-custom, csv-custom)。默认: md。')
+    group_export.add_argument('--format', type=str, default='md', help='导出格式 (md, txt, html, html-sharded, sqlite, json-custom, jsonl-custom, csv-custom), 可加 .gz / .zst 后缀压缩输出 (如 md.gz)。默认: md。')
     group_export.add_argument('--start', type=str, help="开始时间 (格式: 'YYYY-MM-DD' 或 'YYYY-MM-DD HH:MM:SS')。")
     group_export.add_argument('--end', type=str, help="结束时间 (格式: 'YYYY-MM-DD' 或 'YYYY-MM-DD HH:MM:SS')。")
-    group_export.add_argument('--custom-fields', type=str, help="自定义导出格式(json-custom, csv-custom)所需的字段, 逗号分隔。")
+    group_export.add_argument('--custom-fields', type=str, help="自定义导出格式(json-custom, jsonl-custom, csv-custom)所需的字段, 逗号分隔。")
     group_export.add_argument('--group-dirs', action='store_true', help='为每个好友分组创建独立的导出文件夹 (仅限 individual 模式)。')
+    group_export.add_argument('--bulk', action='store_true', help='批量模式: 沿伴随索引单次扫描每张消息表, 按会话分发写入 (仅限 individual 模式)。')
+    group_export.add_argument('--incremental', action='store_true', help='增量导出: 只把各会话上次导出之后的新消息续写到已有文件 (仅限 individual 模式的 md/txt/html)。')
+    group_export.add_argument('--decode-workers', type=int, help='并行解码的子进程数, 覆盖配置项 decode_workers。0 或 1 表示不使用子进程。')
+    group_export.add_argument('--decode-chunk-size', type=int, help='每个解码子进程任务包含的消息条数, 覆盖配置项 decode_chunk_size。')
 
 
     # --- Advanced Export ---
@@ -2853,7 +4832,7 @@ if __name__ == "__main__":
     group_adv_export.add_argument('--db', type=str, help='[原始导出] 目标数据库文件名 (如 nt_msg.decrypt.db)。')
     group_adv_export.add_argument('--table', type=str, help='[原始导出] 目标数据表名。')
     group_adv_export.add_argument('--columns', type=str, help='[原始导出] 要导出的列名, 逗号分隔。')
-    group_adv_export.add_argument('--raw-format', default='json', choices=['json', 'csv'], help='[原始导出] 原始数据导出格式。默认: json。')
+    group_adv_export.add_argument('--raw-format', default='json', choices=_RAW_EXPORT_FORMATS, help='[原始导出] 原始数据导出格式, 可加 .gz / .zst 后缀压缩输出。默认: json。')
     group_adv_export.add_argument('--parse-pb', action='store_true', help='[原始导出] 尝试解析Protobuf二进制字段。')
     
     # --- Web Server & Common ---
@@ -2878,7 +4857,7 @@ if __name__ == "__main__":
 
     action_args = [
         args.cli, args.list_friends, args.list_groups, args.list_schema, 
-        args.list_fields, args.mode, args.export_extra, args.export_raw
+        args.list_fields, args.bench_decode, args.bench_timestamp, args.explain_queries, args.mode, args.export_extra, args.export_raw
     ]
     is_direct_action = any(arg for arg in action_args if arg is not None and arg is not False)
 
@@ -2944,6 +4923,9 @@ if __name__ == "__main__":
         elif args.list_groups: run_list_groups()
         elif args.list_schema: run_list_db_schema()
         elif args.list_fields is not None: run_list_fields([args.list_fields])
+        elif args.bench_decode is not None: run_decode_benchmark(args.bench_decode)
+        elif args.bench_timestamp is not None: run_timestamp_benchmark(args.bench_timestamp)
+        elif args.explain_queries: run_explain_queries()
         elif args.mode: run_direct_export_cli(args)
         elif args.export_extra:
             if not all([args.group, args.type]):
@@ -2957,7 +4939,8 @@ if __name__ == "__main__":
             run_raw_export_cli(ns)
         elif args.cli: start_interactive_cli()
     
-    for con in DB_CONNECTIONS.values():
-        if con: con.close()
+    shutdown_decode_pool()
+    if DB_POOL: DB_POOL.close_all()
+    if DECODE_CACHE: DECODE_CACHE.close()
     msg = "数据库连接已关闭。程序退出。"
     print(msg); logger.info(msg)